@@ -0,0 +1,762 @@
+import asyncio
+import json
+import sys
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+import paho.mqtt.client as mqtt
+import psycopg2
+from psycopg2 import extensions
+import socketio
+from gateway import (
+    Gateway, load_device_map, route_join, DEVICE_MAP,
+    postgres_host, postgres_port, postgres_db, postgres_user, postgres_password,
+)
+from db import Database, DatabaseUnavailable, PG_POOL_MAX, PG_STATEMENT_TIMEOUT_MS, BACKOFF_MIN, BACKOFF_MAX
+from pg_writer import BatchWriter, SQL_ERRORS
+from broadcast import Broadcaster, subscription_args, room_name
+from grafana import grafana_plan, grafana_response, bucketed_results, fill_results, seed_points
+from spool import Spool, SPOOL_ENABLED
+from http_ingest import BadPayload, parse_records, HTTP_MAX_BODY
+from compression import COMPRESSION_TICK
+from streaming import page_args, history_etag, etag_matches, history_body, wants_gzip, gzip_chunks
+from workers import ShardedWorkers
+from log import get_logger, topic_log
+from metrics import REGISTRY, HTTP_SECONDS, WRITER_QUEUE, DB_IN_USE, ROWS_INSERTED, stage_start, stage_done
+
+try:
+    from aiohttp import web
+except ImportError:     # ใช้เฉพาะโหมดนี้ → โหมด thread ปกติไม่ต้องติดตั้ง
+    web = None
+
+# ---------------------------
+# asyncio run mode
+# ---------------------------
+# event loop เดียวดูแลทั้งหมด ไม่มี thread ของ paho / Werkzeug / BatchWriter:
+#   - MQTT: paho ผ่าน socket callback (on_socket_open/close/register_write) → loop_read / loop_write
+#           บน add_reader / add_writer ของ loop, loop_misc ทุก 1 วินาที (keepalive)
+#   - Socket.IO: socketio.AsyncServer บน aiohttp
+#   - PostgreSQL: connection แบบ async ของ psycopg2 (poll() + add_reader/add_writer ไม่ block loop)
+# decoder / router / HistoryStore / Broadcaster ใช้ตัวเดียวกับ gateway.py
+# HTTP route เดิม (/api/data, /query, /io_log, ...) เป็น coroutine ของ aiohttp
+#
+#   pip install aiohttp
+#   python aio_gateway.py devices/all.json
+#
+# ข้อจำกัด: connection แบบ async เป็น autocommit → 1 batch = INSERT หลายแถวใน statement เดียว
+#           spool replay (COPY) ยังใช้ thread + connection ปกติ 1 ตัว เฉพาะตอนมีข้อมูลค้างใน spool
+
+MQTT_MISC_INTERVAL = 1.0
+MQTT_RECONNECT_MAX = 30.0
+
+log = get_logger("aio")
+
+
+def json_dumps(data):
+    return json.dumps(data, default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v))
+
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=json_dumps)
+
+
+# ---------------------------
+# psycopg2 async connections
+# ---------------------------
+async def wait(conn):
+    # รอจน operation ของ connection แบบ async เสร็จ (แทน psycopg2.extras.wait_select ที่ block)
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"bad poll state: {state}")
+        fd = conn.fileno()
+        ready = loop.create_future()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+async def execute(conn, sql, params=None):
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    await wait(conn)
+    return cursor
+
+
+async def fetch(conn, sql, params=None):
+    cursor = await execute(conn, sql, params)
+    return cursor.fetchall()
+
+
+async def insert_values(conn, sql, template, rows):
+    # เหมือน execute_values แต่ execute แล้วรอแบบ async (execute_values เรียก execute ติดกันหลายครั้งไม่ได้)
+    cursor = conn.cursor()
+    values = b",".join(cursor.mogrify(template, row) for row in rows)
+    head, tail = sql.split("%s", 1)     # "... VALUES %s [ON CONFLICT ...]"
+    cursor.execute(head.encode() + values + tail.encode())
+    await wait(conn)
+    return cursor       # RETURNING → cursor.fetchall()
+
+
+class AsyncDatabase:
+    # pool แบบเดียวกับ db.Database แต่เป็น connection async ของ psycopg2 (ใช้ใน event loop เท่านั้น)
+    def __init__(self, maxconn=PG_POOL_MAX, statement_timeout_ms=PG_STATEMENT_TIMEOUT_MS, **connect_kwargs):
+        self.maxconn = maxconn
+        self.statement_timeout_ms = statement_timeout_ms
+        self.connect_kwargs = connect_kwargs
+        self.idle = []
+        self._slots = None
+        self._backoff = BACKOFF_MIN
+        self._retry_at = 0.0
+        self.stats = {"in_use": 0, "checkouts": 0, "reconnects": 0, "failed_connects": 0, "discarded": 0}
+
+    async def _connect(self):
+        if time.monotonic() < self._retry_at:
+            raise DatabaseUnavailable(f"PostgreSQL unavailable, retrying in {self._retry_at - time.monotonic():.1f}s")
+        try:
+            conn = psycopg2.connect(async_=True, **self.connect_kwargs)
+            await wait(conn)
+            if self.statement_timeout_ms:
+                await execute(conn, "SET statement_timeout = %s", (int(self.statement_timeout_ms),))
+        except psycopg2.Error as e:
+            self.stats["failed_connects"] += 1
+            self._retry_at = time.monotonic() + self._backoff
+            log.error("❌ PostgreSQL connection failed (retry in %.0fs): %s", self._backoff, e)
+            self._backoff = min(self._backoff * 2, BACKOFF_MAX)
+            raise DatabaseUnavailable(str(e)) from e
+        self._backoff = BACKOFF_MIN
+        self.stats["reconnects"] += 1
+        return conn
+
+    @asynccontextmanager
+    async def connection(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.maxconn)
+        async with self._slots:
+            conn = None
+            while self.idle and conn is None:
+                conn = self.idle.pop()
+                if conn.closed:
+                    conn = None
+            if conn is None:
+                conn = await self._connect()
+            self.stats["in_use"] += 1
+            self.stats["checkouts"] += 1
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                conn.close()
+                self.stats["discarded"] += 1
+                raise
+            finally:
+                self.stats["in_use"] -= 1
+                if not conn.closed:
+                    self.idle.append(conn)
+
+    def close(self):
+        for conn in self.idle:
+            conn.close()
+        self.idle = []
+
+    def snapshot(self):
+        return {**self.stats, "idle": len(self.idle), "max": self.maxconn}
+
+
+# ---------------------------
+# Batched writer บน event loop
+# ---------------------------
+class AsyncBatchWriter(BatchWriter):
+    # ใช้ buffer / register / spool / stats ของ BatchWriter แต่ flush เป็น task บน loop แทน thread
+    # flush ค้างพร้อมกันเกิน max_inflight (database ช้า) → batch ใหม่ลง spool ทันทีแทนการรอคิวยาว
+    def __init__(self, db, batch_size=500, flush_interval=1.0, spool=None, max_inflight=None):
+        super().__init__(db, batch_size, flush_interval, spool=spool)
+        self.max_inflight = max_inflight or db.maxconn * 2
+        self.inflight = set()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run_async())
+        return self
+
+    async def stop_async(self):
+        if self._task:
+            self._task.cancel()
+        for table in self.buffers:
+            self._flush(table)
+        if self.inflight:
+            await asyncio.gather(*self.inflight, return_exceptions=True)
+
+    def put(self, table, row, topic=None):
+        if table not in self.tables:
+            log.warning("⚠️ BatchWriter: table %s is not registered, ignoring...", table)
+            return False
+        if self._duplicate(table, row, topic):
+            return True
+        self._count(queued=1)
+        self._buffer(table, row, topic)
+        return True
+
+    def depth(self):
+        return sum(len(b) for b in self.buffers.values())
+
+    async def _run_async(self):
+        while True:
+            await asyncio.sleep(self._next_timeout())
+            self._flush_due()
+
+    def _flush(self, table):
+        # เรียกจาก _buffer / _flush_due ของ BatchWriter → แค่สร้าง task
+        rows, topics = self._take_unique(table)
+        if not rows:
+            return
+        if len(self.inflight) >= self.max_inflight:
+            self._unavailable(table, rows, topics, "too many flushes in flight")
+            return
+        task = asyncio.get_running_loop().create_task(self._flush_async(table, rows, topics))
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    async def _flush_async(self, table, rows, topics):
+        columns, sql, template = self.tables[table]
+        returning = self.conflicts.get(table, (None, False, False))[2]
+        started = time.perf_counter()
+        inserted, updated = rows, []
+        one_by_one = False
+        try:
+            async with self.db.connection() as conn:
+                try:
+                    t = stage_start()
+                    committed_at = time.monotonic()     # autocommit: INSERT = commit
+                    cursor = await insert_values(conn, sql, template, rows)
+                    if returning:
+                        inserted, updated = self._inserted(table, rows, cursor.fetchall())
+                    stage_done("insert", t)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except psycopg2.Error as sql_err:
+                    log.error("❌ SQL Error flushing %d rows into %s: %s", len(rows), table, sql_err)
+                    self._count(errors=1)
+                    SQL_ERRORS.inc(table)
+                    committed_at = time.monotonic()
+                    one_by_one = True
+                    rows, updated = await self._insert_one_by_one_async(conn, table, rows, topics)
+                    await self._rollup_async(conn, table, rows, updated)
+                    self._committed(table, rows, committed_at, updated)
+                    return
+                await self._rollup_async(conn, table, inserted, updated)
+        except (DatabaseUnavailable, psycopg2.Error) as e:
+            if not one_by_one:      # ทีละแถว: แถวที่เหลือลง spool ไปแล้วใน _insert_one_by_one_async
+                self._unavailable(table, rows, topics, e)
+            return
+        self._flushed(table, rows, topics, (time.perf_counter() - started) * 1000, committed_at, inserted, updated)
+
+    async def _insert_one_by_one_async(self, conn, table, rows, topics):
+        # → (แถวที่ insert ใหม่, แถวที่ทับแถวเดิม) ไม่นับแถวที่ชน key
+        columns, sql, template = self.tables[table]
+        returning = self.conflicts.get(table, (None, False, False))[2]
+        ok, replaced = [], []
+        committed_at = time.monotonic()
+        for i, (row, topic) in enumerate(zip(rows, topics)):
+            try:
+                cursor = await insert_values(conn, sql, template, [row])
+                inserted, updated = [row], []
+                if returning:
+                    inserted, updated = self._inserted(table, inserted, cursor.fetchall())
+                elif cursor.rowcount == 0:
+                    inserted = []     # ON CONFLICT DO NOTHING ข้ามแถวนี้
+                    self._count(conflicts=1)
+                ok += inserted
+                replaced += updated
+                if inserted or updated:
+                    ROWS_INSERTED.inc(topic, table)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # connection หลุดกลางทาง → แถวที่ commit แล้วไปต่อตามปกติ, spool เฉพาะแถวนี้เป็นต้นไป
+                self._count(flushed_rows=len(ok) + len(replaced))
+                self._committed(table, ok, committed_at, replaced)
+                if self.rollups and (ok or replaced):
+                    self.rollups.failed(table, e)
+                self._unavailable(table, rows[i:], topics[i:], e)
+                raise
+            except psycopg2.Error as sql_err:
+                log.error("❌ SQL Error inserting into %s: %s", table, sql_err)
+                self._count(dropped=1)
+                SQL_ERRORS.inc(table)
+        self._count(flushed_rows=len(ok) + len(replaced))     # เฉพาะแถวที่ insert / update จริง
+        return ok, replaced
+
+    async def _rollup_async(self, conn, table, rows, updated=()):
+        # connection async เป็น autocommit → rollup ตามหลังแถวดิบ (ไม่ได้อยู่ transaction เดียวกันแบบ BatchWriter)
+        if not self.rollups or not (rows or updated):
+            return
+        try:
+            for sql, template, values in self.rollups.statements(table, rows, updated):
+                if values is None:
+                    await execute(conn, sql, template)
+                else:
+                    await insert_values(conn, sql, template, values)
+            self.rollups.committed(table)
+        except psycopg2.Error as e:
+            # แถวดิบ commit ไปแล้ว → ห้ามให้ไปลง spool ซ้ำ; connection เสียก็ปิดทิ้งเฉยๆ
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                conn.close()
+            self.rollups.failed(table, e)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return {**stats, "queue_depth": self.depth(), "inflight": len(self.inflight)}
+
+
+# ---------------------------
+# Socket.IO (AsyncServer)
+# ---------------------------
+class AsyncBroadcaster(Broadcaster):
+    # logic เดิมของ Broadcaster (coalesce / delta / room / client ช้า) แต่ I/O เป็น coroutine
+    # → emit / enter_room ต่อคิวไว้ใน outbox แล้ว flush() await ตามลำดับ
+    def __init__(self, sio, **kwargs):
+        super().__init__(sio, **kwargs)
+        self.outbox = []
+        self._flush_task = None
+        self._flush_lock = None
+
+    @property
+    def server(self):
+        return self.socketio
+
+    def _emit(self, event, data, to, skip_sid=None):
+        self.outbox.append(("emit", event, data, to, skip_sid))
+        self._schedule_flush()
+
+    def _enter(self, sid, keys):
+        for event, device in keys:
+            self.outbox.append(("enter", sid, event, device, None))
+        self._schedule_flush()
+
+    def _leave(self, sid, keys):
+        for event, device in keys:
+            self.outbox.append(("leave", sid, event, device, None))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        # lock → enter_room / snapshot / frame ออกตามลำดับที่ต่อคิวไว้ แม้มีหลาย flush พร้อมกัน
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        sio = self.socketio
+        async with self._flush_lock:
+            while self.outbox:
+                outbox, self.outbox = self.outbox, []
+                for op, a, b, c, d in outbox:
+                    if op == "emit":
+                        await sio.emit(a, b, to=c, skip_sid=d)
+                    elif op == "enter":
+                        await sio.enter_room(a, room_name(b, c), namespace="/")
+                    else:
+                        await sio.leave_room(a, room_name(b, c), namespace="/")
+
+    def start(self):
+        if self.hz > 0 and not self._started:
+            self._started = True
+            self.socketio.start_background_task(self._run_async)
+        return self
+
+    async def _run_async(self):
+        interval = 1.0 / self.hz
+        while True:
+            await self.socketio.sleep(interval)
+            try:
+                self.tick()
+                await self.flush()
+            except Exception as e:
+                log.error("❌ Error in broadcast tick: %s", e)
+
+
+# ---------------------------
+# paho บน event loop
+# ---------------------------
+class MqttAsyncio:
+    # ตาม examples/loop_asyncio.py ของ paho: loop เรียก loop_read/loop_write เมื่อ socket พร้อม
+    # connect / reconnect (DNS + TCP handshake) block → ทำใน executor ไม่ให้ค้าง event loop
+    #   callback ของ socket จึงอาจถูกเรียกจาก thread อื่น → ลงทะเบียนกับ loop ผ่าน call_soon_threadsafe
+    def __init__(self, client, loop, on_connected=None):
+        self.client = client
+        self.loop = loop
+        self.on_connected = on_connected
+        self.misc = None
+        self.reconnect_delay = 1.0
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._opened, sock)
+
+    def _opened(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._closed, sock)
+
+    def _closed(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def connect(self, host, port, keepalive):
+        await self.loop.run_in_executor(None, self.client.connect, host, port, keepalive)
+
+    def on_connect(self, client, userdata, flags, rc):
+        self.reconnect_delay = 1.0
+        if self.on_connected:
+            self.on_connected()
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            log.warning("⚠️ MQTT disconnected (rc=%s), reconnecting...", rc)
+            self.loop.call_soon_threadsafe(self.loop.create_task, self.reconnect())
+
+    async def misc_loop(self):
+        # keepalive PING / retry ของ paho
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(MQTT_MISC_INTERVAL)
+            except asyncio.CancelledError:
+                break
+
+    async def reconnect(self):
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                return
+            except OSError as e:
+                log.error("❌ MQTT reconnect failed (retry in %.0fs): %s", self.reconnect_delay, e)
+                self.reconnect_delay = min(self.reconnect_delay * 2, MQTT_RECONNECT_MAX)
+
+
+# ---------------------------
+# Gateway
+# ---------------------------
+class AsyncGateway(Gateway):
+    def __init__(self, device_map):
+        if web is None:
+            raise SystemExit("asyncio mode needs aiohttp: pip install aiohttp")
+        super().__init__(device_map)
+        self.workers = ShardedWorkers(self.handle, workers=0)   # loop เดียว → handle() ตรงๆ
+        WRITER_QUEUE.set_function(self.writer.depth)
+        DB_IN_USE.set_function(lambda: self.db.stats["in_use"])
+
+    def _init_server(self):
+        @web.middleware
+        async def metrics_middleware(request, handler):
+            started = time.perf_counter()
+            response = await handler(request)
+            resource = request.match_info.route.resource
+            rule = resource.canonical if resource is not None else "<unmatched>"
+            if rule != "/metrics":
+                HTTP_SECONDS.observe(time.perf_counter() - started, rule, request.method, str(response.status))
+            return response
+
+        self.app = None
+        self.web = web.Application(middlewares=[metrics_middleware], client_max_size=HTTP_MAX_BODY)
+        self.socketio = socketio.AsyncServer(async_mode="aiohttp", cors_allowed_origins="*")
+        self.socketio.attach(self.web)
+        self.broadcaster = AsyncBroadcaster(self.socketio)
+
+    def _init_storage(self):
+        connect_kwargs = dict(
+            host=postgres_host, port=postgres_port, database=postgres_db,
+            user=postgres_user, password=postgres_password,
+        )
+        self.db = AsyncDatabase(**connect_kwargs)
+        self.spool = Spool() if SPOOL_ENABLED else None
+        # replay ใช้ COPY และ schema ใช้ DDL นอก transaction ซึ่ง connection async ทำไม่ได้
+        # → connection ปกติ 1 ตัวใน thread ของ spool / schema (ต่อเมื่อใช้ครั้งแรก)
+        self.replay_db = Database(minconn=1, maxconn=1, **connect_kwargs)
+        self.writer = AsyncBatchWriter(self.db, spool=self.spool)
+
+    # ---------------------------
+    # HTTP / Socket.IO (coroutine)
+    # ---------------------------
+    def _register_routes(self):
+        app = self.web
+        sio = self.socketio
+
+        async def index(request):
+            return web.Response(text="✅ MQTT + PostgreSQL Gateway Running (asyncio)")
+
+        async def get_data(request):
+            since, limit, device, ndjson = page_args(request.query)
+            etag = history_etag(self.history, since, limit, device, ndjson)
+            if etag_matches(request.headers.get("If-None-Match"), etag):
+                return web.Response(status=304, headers={"ETag": etag})
+            chunks, headers, content_type = history_body(self.history, since, limit, device, ndjson)
+            headers.update({"ETag": etag, "Content-Type": content_type})
+            if wants_gzip(request.headers.get("Accept-Encoding")):
+                chunks = gzip_chunks(chunks)
+                headers.update({"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+            response = web.StreamResponse(headers=headers)
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            for chunk in chunks:
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+        async def get_history_info(request):
+            return json_response(self.history.info())
+
+        async def get_writer_stats(request):
+            return json_response(self.writer.snapshot())
+
+        async def get_db_stats(request):
+            return json_response(self.db.snapshot())
+
+        async def get_broadcast_stats(request):
+            return json_response(self.broadcaster.snapshot())
+
+        async def get_spool_stats(request):
+            return json_response(self.spool.snapshot() if self.spool else {"enabled": False})
+
+        async def get_schema_stats(request):
+            return json_response(self.schema.snapshot() if self.schema else {"enabled": False})
+
+        async def get_latest(request):
+            return json_response(self.latest.snapshot())
+
+        async def get_latest_device(request):
+            device = request.match_info["device"]
+            tags = self.latest.device(device)
+            if tags is None:
+                return json_response({"status": "error", "message": f"unknown device {device}"}, 404)
+            return json_response(tags)
+
+        async def get_query_cache_stats(request):
+            return json_response(self.query_cache.snapshot() if self.query_cache else {"enabled": False})
+
+        async def get_rollup_stats(request):
+            return json_response(self.rollups.snapshot() if self.rollups else {"enabled": False})
+
+        async def get_compression_stats(request):
+            return json_response(self.compression.snapshot() if self.compression else {"enabled": False})
+
+        async def get_dedup_stats(request):
+            return json_response(self.dedup.snapshot() if self.dedup else {"enabled": False})
+
+        async def log_config(request):
+            if request.method == "POST":
+                topic_log.configure(await request.json() or {})
+            return json_response(topic_log.snapshot())
+
+        async def get_routes(request):
+            return json_response([
+                {"topic": r.pattern, "decoder": r.decoder.decoder_name, "table": r.table, "event": r.event,
+                 "device_level": r.device_level, "join": route_join(r)}
+                for r in self.routes
+            ])
+
+        async def metrics(request):
+            return web.Response(text=REGISTRY.render(), content_type="text/plain")
+
+        # Grafana SimpleJSON
+        async def search(request):
+            return json_response(list(self.grafana_targets))
+
+        async def query(request):
+            try:
+                req = await request.json()
+                if self.query_cache:
+                    return json_response(await self._cached_query(req))
+                order, queries = grafana_plan(req, self.grafana_targets, self.rollups, self.grafana_fills)
+                results = {}
+                async with self.db.connection() as conn:
+                    for series, sql, params, seed in queries:
+                        rows = await fetch(conn, sql, params)
+                        seeds = seed_points(await fetch(conn, seed, params)) if seed else {}
+                        results.update(fill_results(series, bucketed_results(series, rows), params,
+                                                    self.grafana_fills, seeds))
+                return json_response(grafana_response(order, results))
+            except Exception as e:
+                log.error("❌ Error in /query: %s", e)
+                return json_response([])
+
+        async def receive_log(request, name, ingest):
+            try:
+                records = parse_records(await request.read(), request.content_type,
+                                        request.headers.get("Content-Encoding"))
+            except BadPayload as e:
+                self.http_ingest.reject()
+                log.warning("⚠️ Bad /%s body from %s: %s", name, request.remote, e)
+                return json_response({"status": "error", "message": str(e)}, 400)
+            try:
+                count = ingest(records, request.remote)
+                log.debug("📥 Received /%s POST: %d record(s)", name, count)
+                return json_response({"status": "ok", "accepted": count})
+            except Exception as e:
+                log.error("❌ Error in /%s: %s", name, e)
+                return json_response({"status": "error", "message": str(e)}, 500)
+
+        async def receive_io_log(request):
+            return await receive_log(request, "io_log", self.http_ingest.io_log)
+
+        async def receive_sys_log(request):
+            return await receive_log(request, "sys_log", self.http_ingest.sys_log)
+
+        async def get_http_ingest_stats(request):
+            return json_response(self.http_ingest.snapshot())
+
+        async def get_sys_log(request):
+            return json_response(list(self.sys_log_events))
+
+        app.router.add_get("/", index)
+        app.router.add_get("/api/data", get_data)
+        app.router.add_get("/api/tpm", get_data)
+        app.router.add_get("/api/history", get_history_info)
+        app.router.add_get("/api/writer", get_writer_stats)
+        app.router.add_get("/api/db", get_db_stats)
+        app.router.add_get("/api/broadcast", get_broadcast_stats)
+        app.router.add_get("/api/spool", get_spool_stats)
+        app.router.add_get("/api/schema", get_schema_stats)
+        app.router.add_get("/api/rollups", get_rollup_stats)
+        app.router.add_get("/api/compression", get_compression_stats)
+        app.router.add_get("/api/dedup", get_dedup_stats)
+        app.router.add_get("/api/query_cache", get_query_cache_stats)
+        app.router.add_get("/api/latest", get_latest)
+        app.router.add_get("/api/latest/{device:.+}", get_latest_device)
+        app.router.add_get("/api/http_ingest", get_http_ingest_stats)
+        app.router.add_route("*", "/api/log", log_config)
+        app.router.add_get("/api/routes", get_routes)
+        app.router.add_get("/metrics", metrics)
+        app.router.add_post("/search", search)
+        app.router.add_post("/query", query)
+        app.router.add_post("/io_log", receive_io_log)
+        app.router.add_post("/sys_log", receive_sys_log)
+        app.router.add_get("/sys_log", get_sys_log)
+
+        @sio.event
+        async def connect(sid, environ):
+            log.info("🌐 Client connected (%s)", sid)
+            self.broadcaster.connect(sid)
+            self.broadcaster.emit_to(sid, "latest", self.latest.snapshot())
+            await self.broadcaster.flush()
+
+        @sio.event
+        async def disconnect(sid):
+            log.info("🔌 Client disconnected (%s)", sid)
+            self.broadcaster.forget(sid)
+
+        @sio.event
+        async def subscribe(sid, data):
+            event, device = subscription_args(data)
+            self.broadcaster.subscribe(sid, event, device)
+            await self.broadcaster.flush()
+            return {"status": "ok", "event": event, "device": device}
+
+        @sio.event
+        async def unsubscribe(sid, data):
+            event, device = subscription_args(data)
+            self.broadcaster.unsubscribe(sid, event, device)
+            await self.broadcaster.flush()
+            return {"status": "ok", "event": event, "device": device}
+
+    # ---------------------------
+    # Start
+    # ---------------------------
+    def _subscribe(self):
+        # เรียกทุกครั้งที่ connect (รวม reconnect) → subscription กลับมาเอง
+        topics = self.topic_patterns()
+        self.client.subscribe([(t, 0) for t in topics])
+        log.info("✅ Subscribed to %d topic patterns (%d routes).", len(topics), len(self.routes))
+
+    async def _cached_query(self, req):
+        # เหมือน QueryCache.query() แต่ยิง SQL ผ่าน connection async (และไม่ checkout เลยถ้า hit ทั้งหมด)
+        plan = self.query_cache.plan(req, self.grafana_targets, self.rollups, self.grafana_fills)
+        results, snapshots = [], []
+        try:
+            if plan.queries:
+                async with self.db.connection() as conn:
+                    for sql, params, *_ in plan.queries:
+                        snapshots.append(time.monotonic())
+                        results.append(await fetch(conn, sql, params))
+        except Exception:
+            plan.fail()
+            raise
+        return plan.finish(results, snapshots)
+
+    async def _flush_held(self):
+        # แถวที่ compression ถือไว้ → writer ตาม heartbeat (บน loop เพราะ AsyncBatchWriter.put สร้าง task)
+        while True:
+            await asyncio.sleep(COMPRESSION_TICK)
+            self.compression.flush_due(self.writer)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        mqtt_loop = MqttAsyncio(self.client, loop, on_connected=self._subscribe)
+        if self.schema:
+            await loop.run_in_executor(None, self.schema.start, self.replay_db)
+        if self.rollups:
+            await loop.run_in_executor(None, self.rollups.load, self.replay_db)
+        self.writer.start()
+        if self.compression:
+            loop.create_task(self._flush_held())
+        self.broadcaster.start()
+        if self.spool:
+            self.spool.start(self.replay_db)
+
+        runner = web.AppRunner(self.web)
+        await runner.setup()
+        port = self.device_map.get("port", 4000)
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        log.info("✅ asyncio gateway listening on :%d", port)
+
+        cfg = self.device_map.get("mqtt", {})
+        if cfg.get("username"):
+            self.client.username_pw_set(cfg["username"], cfg.get("password"))
+        await mqtt_loop.connect(cfg.get("host", "127.0.0.1"), cfg.get("port", 1883), cfg.get("keepalive", 60))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.client.disconnect()
+            if self.compression:
+                self.compression.flush_all(self.writer)
+            await self.writer.stop_async()
+            if self.spool:
+                self.spool.stop()
+            if self.schema:
+                self.schema.stop()
+            self.db.close()
+            await runner.cleanup()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+def main(path=None):
+    path = path or (sys.argv[1] if len(sys.argv) > 1 else DEVICE_MAP)
+    AsyncGateway(load_device_map(path)).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import json
+import time
+from datetime import datetime
+from decoders import get_decoder, parse_wise_time
+
+# ---------------------------
+# Decode microbenchmark
+# ---------------------------
+# วัด msg/s ของแต่ละ decoder ตั้งแต่ payload bytes → แถวที่จะ insert
+# (json.loads + decoder เหมือนใน Gateway.on_message ไม่รวม DB / Socket.IO)
+#
+#   python bench_decode.py -n 200000
+
+SAMPLES = {
+    "wise4012_io": ("wise4012_8C8046", {
+        "s": 1, "t": "2025-05-30T04:23:00Z", "q": 192, "c": 0,
+        "di1": True, "di2": False, "di3": False, "di4": True, "do1": False, "do2": True,
+    }),
+    "device_status": ("Advantech/74FE488C8046/Device_Status", {
+        "status": "connect", "name": "WISE-4012", "macid": "74FE488C8046", "ipaddr": "192.168.1.20",
+    }),
+    "wise4210_io": ("Advantech/00D0C9FFF8E5/C9FFFFFFF08D/data", {
+        "s": 1, "t": "2025-05-30T04:23:00Z", "q": 192, "c": 0, "rssi": -61,
+        "di1": 1, "di2": 0, "di3": 0, "di4": 1, "di5": 0, "di6": 0, "do1": 0, "do2": 1,
+    }),
+    "wise4210": ("Advantech/00D0C9FFF8E5/C9FFFFFFF08D/data", {
+        "s": 1, "t": "2025-05-30T04:23:01Z", "q": 192, "c": 0,
+        "p1v00r0000x00": 249, "p1v00r0000x01": 607,
+    }),
+    "ecu1251": ("data/device_id", {
+        "d": [{"tag": "wise4210:temp", "value": 249.00}, {"tag": "wise4210:hum", "value": 607.00}],
+        "ts": "2025-05-30T04:23:00Z",
+    }),
+    "wise2200": ("wise2200/0001", {
+        "RtuRegister0-0": {"Data": 251, "Status": 0},
+        "RtuRegister0-1": {"Data": 603, "Status": 0},
+        "Device": {"Time": 1748579000},
+    }),
+}
+
+
+def bench(fn, n):
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WISE payload decode benchmark")
+    parser.add_argument("-n", type=int, default=100000, help="messages per decoder")
+    args = parser.parse_args()
+
+    print(f"{'decoder':<16}{'msg/s':>12}{'µs/msg':>10}")
+    for name, (topic, data) in SAMPLES.items():
+        payload = json.dumps(data).encode()
+        decode = get_decoder("wise4210" if name == "wise4210_io" else name)
+        state = decode.state()
+        elapsed = bench(lambda: decode(topic, json.loads(payload), state), args.n)
+        print(f"{name:<16}{args.n / elapsed:>12,.0f}{elapsed / args.n * 1e6:>10.2f}")
+
+    # เทียบ timestamp parser: "cold" = เวลาไม่ซ้ำกับ message ก่อนหน้า (ไม่โดน cache)
+    times = [f"2025-05-30T04:{m:02d}:{sec:02d}Z" for m in range(60) for sec in range(60)]
+    it = iter(times * (args.n // len(times) + 1))
+    hot = times[0]
+    for label, fn in [
+        ("strptime", lambda: datetime.strptime(next(it), "%Y-%m-%dT%H:%M:%SZ")),
+        ("parse (cold)", lambda: parse_wise_time(next(it))),
+        ("parse (same s)", lambda: parse_wise_time(hot)),
+    ]:
+        it = iter(times * (args.n // len(times) + 1))
+        elapsed = bench(fn, args.n)
+        print(f"{label:<16}{args.n / elapsed:>12,.0f}{elapsed / args.n * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
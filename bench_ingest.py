@@ -0,0 +1,377 @@
+import argparse
+import contextlib
+import heapq
+import json
+import os
+import random
+import resource
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from gateway import Gateway, load_device_map
+
+# ---------------------------
+# End-to-end ingest benchmark
+# ---------------------------
+# สร้าง traffic เหมือน device จริงแต่ละ family แล้วส่งเข้า Gateway.on_message ตัวจริง
+#   FakeBroker   = thread เดียวแบบ network thread ของ paho ส่ง message ตามเวลาที่กำหนด (devices × rate)
+#                  เข้า on_message → ShardedWorkers (MQTT_WORKERS=0 = ทำงานบน thread เดียวกันแบบเดิม)
+#   FakeDatabase = บันทึก INSERT/commit แทน PostgreSQL (ยังผ่าน execute_values + mogrify ตามจริง)
+#                  หรือ --db pg ใช้ PostgreSQL จาก .env
+# รายงาน msg/s ที่รับได้จริง, latency ของ on_message และ end-to-end (กำหนดส่ง → commit) p50/p99, RSS ที่โตขึ้น
+#
+#   python bench_ingest.py --devices 20 --rate 10 --duration 30
+#   python bench_ingest.py --devices 50 --rate 0 --duration 10      # rate 0 = ส่งเร็วที่สุด
+#   python bench_ingest.py --families wise4210,wise2200 --db pg
+
+FAMILIES = ("wise4012", "wise4210", "ecu1251", "wise2200")
+
+
+def wise_time(now=None):
+    return (now or datetime.now(timezone.utc)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def mac(prefix, i):
+    return f"{prefix}{i:06X}"
+
+
+# ---------------------------
+# Synthetic devices
+# ---------------------------
+# generator ต่อ device → (topic, payload dict) ทีละ message ตามลำดับที่ device จริง publish
+def wise4012_device(rng, i):
+    m = mac("74FE48", i)
+    yield f"Advantech/{m}/Device_Status", {
+        "status": "connect", "name": "WISE-4012", "macid": m, "ipaddr": f"192.168.1.{i % 250 + 1}",
+    }
+    c = 0
+    while True:
+        c += 1
+        payload = {"s": 1, "t": wise_time(), "q": 192, "c": c}
+        payload.update({f"di{k}": rng.random() < 0.5 for k in range(1, 5)})
+        payload.update({f"do{k}": rng.random() < 0.5 for k in range(1, 3)})
+        yield f"wise4012_{m[-6:]}", payload
+
+
+def wise4210_device(rng, i):
+    topic = f"Advantech/00D0C9FFF8E5/{mac('C9FFFF', i)}/data"
+    temp, hum = 250.0, 600.0
+    c = 0
+    while True:
+        c += 1
+        io = {"s": 1, "t": wise_time(), "q": 192, "c": c, "rssi": rng.randint(-90, -40)}
+        io.update({f"di{k}": rng.randint(0, 1) for k in range(1, 7)})
+        io.update({f"do{k}": rng.randint(0, 1) for k in range(1, 3)})
+        yield topic, io
+        temp += rng.uniform(-2, 2)
+        hum += rng.uniform(-5, 5)
+        yield topic, {"s": 1, "t": wise_time(), "q": 192, "c": c,
+                      "p1v00r0000x00": round(temp), "p1v00r0000x01": round(hum)}
+
+
+def ecu1251_device(rng, i):
+    topic = f"data/ecu{i:04d}"
+    temp, hum = 250.0, 600.0
+    while True:
+        temp += rng.uniform(-2, 2)
+        hum += rng.uniform(-5, 5)
+        yield topic, {
+            "d": [{"tag": "wise4210:temp", "value": round(temp, 2)},
+                  {"tag": "wise4210:hum", "value": round(hum, 2)}],
+            "ts": wise_time(),
+        }
+
+
+def wise2200_device(rng, i):
+    topic = f"wise2200/{i:04d}"
+    temp, hum = 250, 600
+    n = 0
+    while True:
+        if n % 10 == 0:
+            # frame สถานะ radio (rssi / devaddr) มาเป็นระยะ ไม่มี RtuRegister
+            yield topic, {"rssi": rng.randint(-110, -60), "devaddr": f"{i:08X}", "datetime": wise_time()}
+        n += 1
+        temp += rng.randint(-2, 2)
+        hum += rng.randint(-5, 5)
+        yield topic, {
+            "RtuRegister0-0": {"Data": temp, "Status": 0},
+            "RtuRegister0-1": {"Data": hum, "Status": 0},
+            "Device": {"Time": int(time.time())},
+        }
+
+
+GENERATORS = {
+    "wise4012": wise4012_device,
+    "wise4210": wise4210_device,
+    "ecu1251": ecu1251_device,
+    "wise2200": wise2200_device,
+}
+
+
+# device map: route เดิมของ all.json + route ต่อ WISE-4012 (topic ไม่มี wildcard ให้ใช้ เหมือนของจริง)
+def bench_device_map(families, devices):
+    device_map = load_device_map("devices/all.json")
+    routes = [r for r in device_map["routes"]
+              if r["decoder"] not in ("wise4012_io", "device_status")]
+    if "wise4012" in families:
+        for i in range(devices):
+            m = mac("74FE48", i)
+            routes.append({"topic": f"wise4012_{m[-6:]}", "decoder": "wise4012_io",
+                           "table": "iotdata.wise4012_bench", "event": "mqtt_data"})
+            routes.append({"topic": f"Advantech/{m}/Device_Status", "decoder": "device_status",
+                           "table": "iotdata.wise4012_connection_log", "event": "wise4012_connection_log"})
+    return {**device_map, "routes": routes}
+
+
+# ---------------------------
+# Recording fake PostgreSQL
+# ---------------------------
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self.pending = []     # แถวของ statement ที่กำลังประกอบ (สำหรับ RETURNING)
+        self.returning = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, template, args):
+        if isinstance(args, dict):
+            self.pending.append(args)
+            return (template % {k: repr(v) for k, v in args.items()}).encode()
+        return (template % tuple(repr(v) for v in args)).encode()
+
+    def execute(self, sql, args=None):
+        self.connection.db.record(sql)
+        text = sql if isinstance(sql, str) else sql.decode(errors="replace")
+        _, found, columns = text.rpartition("RETURNING ")
+        keys = [c.strip() for c in columns.split(",")] if found else []
+        # ถือว่าทุกแถว insert ได้ (ไม่มีแถวชน key)
+        self.returning = [tuple(row.get(c) for c in keys) for row in self.pending]
+        self.pending = []
+
+    def fetchall(self):
+        return self.returning
+
+
+class FakeConnection:
+    encoding = "UTF8"
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.commits += 1
+        if self.db.commit_ms:
+            time.sleep(self.db.commit_ms / 1000)
+
+    def rollback(self):
+        pass
+
+
+class FakeDatabase:
+    def __init__(self, commit_ms=0.0):
+        self.commit_ms = commit_ms    # จำลองเวลา fsync ของ commit
+        self.stats = {"in_use": 0}
+        self.statements = 0
+        self.rows = 0
+        self.bytes = 0
+        self.commits = 0
+        self.lock = threading.Lock()
+
+    def record(self, sql):
+        if isinstance(sql, str):
+            sql = sql.encode()
+        with self.lock:
+            self.statements += 1
+            self.rows += sql.count(b"),(") + 1
+            self.bytes += len(sql)
+
+    @contextlib.contextmanager
+    def connection(self, statement_timeout_ms=None, timeout=None):
+        self.stats["in_use"] += 1
+        try:
+            yield FakeConnection(self)
+        finally:
+            self.stats["in_use"] -= 1
+
+    def snapshot(self):
+        return {"statements": self.statements, "rows": self.rows, "bytes": self.bytes, "commits": self.commits}
+
+
+# ---------------------------
+# Broker stand-in
+# ---------------------------
+class FakeBroker:
+    def __init__(self, on_message, families, devices, rate, seed=1):
+        self.on_message = on_message
+        self.rate = rate
+        self.devices = []
+        rng = random.Random(seed)
+        for family in families:
+            for i in range(devices):
+                self.devices.append(GENERATORS[family](rng, i))
+        self.handler_s = []
+        self.delivered = 0
+        self.behind_s = 0.0   # ส่งช้ากว่ากำหนดสูงสุด (handler ตามไม่ทัน)
+        self.due = {}         # id(payload) → เวลาที่ message ควรถูกส่ง (ใช้วัด end-to-end)
+
+    def run(self, duration):
+        started = self.started = time.perf_counter()
+        period = 1.0 / self.rate if self.rate > 0 else 0.0
+        # (เวลาที่ต้องส่ง, ลำดับ device) — เริ่มแบบกระจาย phase เหมือน device จริง
+        schedule = [(started + period * n / len(self.devices), n) for n in range(len(self.devices))]
+        heapq.heapify(schedule)
+        stop_at = started + duration
+        while schedule:
+            due, n = heapq.heappop(schedule)
+            now = time.perf_counter()
+            if period:
+                if due >= stop_at:
+                    break
+                if due > now:
+                    time.sleep(due - now)
+                    now = time.perf_counter()
+                self.behind_s = max(self.behind_s, now - due)
+            elif now >= stop_at:
+                break
+            else:
+                due = now
+
+            topic, payload = next(self.devices[n])
+            msg = SimpleNamespace(topic=topic, payload=json.dumps(payload).encode(), qos=0, retain=False)
+            self.due[id(msg.payload)] = due
+            t = time.perf_counter()
+            self.on_message(None, None, msg)
+            self.handler_s.append(time.perf_counter() - t)
+            self.delivered += 1
+            heapq.heappush(schedule, (due + period, n))
+        return time.perf_counter() - started
+
+
+# ---------------------------
+# Measurement helpers
+# ---------------------------
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def track_end_to_end(gw, broker):
+    # จำเวลาที่ message ควรถูกส่งต่อแถว → วัดตอน _flush commit เสร็จ
+    # (payload → worker thread → แถว: ส่งต่อเวลาผ่าน thread-local ของ worker)
+    sent = {}
+    latencies = []
+    current = threading.local()
+    handler, put, flush = gw.workers.handler, gw.writer.put, gw.writer._flush
+
+    def tracked_handler(topic, payload):
+        current.due = broker.due.pop(id(payload), None)
+        return handler(topic, payload)
+
+    def tracked_put(table, row, topic=None):
+        if getattr(current, "due", None) is not None:
+            sent[id(row)] = current.due
+        return put(table, row, topic)
+
+    def tracked_flush(table):
+        ids = [id(row) for row in gw.writer.buffers[table]]
+        flush(table)
+        now = time.perf_counter()
+        for i in ids:
+            due = sent.pop(i, None)
+            if due is not None:
+                latencies.append(now - due)
+
+    gw.workers.handler = tracked_handler
+    gw.writer.put = tracked_put
+    gw.writer._flush = tracked_flush
+    return latencies
+
+
+def mb(n):
+    return n / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WISE gateway ingest benchmark")
+    parser.add_argument("--devices", type=int, default=10, help="devices per family")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages/s per device (0 = as fast as possible)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--families", default=",".join(FAMILIES), help="comma-separated: " + ",".join(FAMILIES))
+    parser.add_argument("--db", choices=("fake", "pg"), default="fake", help="recording fake or PostgreSQL from .env")
+    parser.add_argument("--commit-ms", type=float, default=0.0, help="simulated commit latency for --db fake")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="also report Python heap growth (slower)")
+    args = parser.parse_args()
+
+    families = [f for f in args.families.split(",") if f]
+    unknown = set(families) - set(FAMILIES)
+    if unknown:
+        parser.error(f"unknown families: {', '.join(sorted(unknown))}")
+
+    gw = Gateway(bench_device_map(families, args.devices))
+    if args.db == "fake":
+        gw.db = gw.writer.db = FakeDatabase(args.commit_ms)
+    broker = FakeBroker(gw.on_message, families, args.devices, args.rate, args.seed)
+    latencies = track_end_to_end(gw, broker)
+
+    gw.writer.start()
+    gw.workers.start()
+    gw.broadcaster.start()
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = rss_bytes()
+
+    elapsed = broker.run(args.duration)
+    gw.workers.drain()            # รอ shard ทำงานที่ค้างให้หมดก่อนสรุป (writer.stop drain คิวของ writer)
+    processed = time.perf_counter() - broker.started
+    gw.writer.stop(timeout=30)
+
+    rss_after = rss_bytes()
+    writer = gw.writer.snapshot()
+    total = len(broker.devices)
+    print(f"devices        {total} ({args.devices} × {', '.join(families)}), "
+          f"target {'max' if args.rate <= 0 else f'{args.rate * total:,.0f} msg/s'}")
+    workers = gw.workers.snapshot()
+    print(f"delivered      {broker.delivered:,} messages in {elapsed:.2f} s → {broker.delivered / elapsed:,.0f} msg/s")
+    print(f"processed      {workers['processed'] if workers['workers'] else broker.delivered:,} messages "
+          f"in {processed:.2f} s by {workers['workers'] or 'inline'} workers, {workers['dropped']:,} dropped "
+          f"(max shard depth {max([s['max_depth'] for s in workers['shards']], default=0)})")
+    if args.rate > 0:
+        print(f"max lag        {broker.behind_s * 1000:.1f} ms behind schedule")
+    print(f"rows           {writer['flushed_rows']:,} inserted, {writer['dropped']:,} dropped, "
+          f"{writer['flushes']:,} batches")
+    print(f"on_message     p50 {percentile(broker.handler_s, 50) * 1e6:,.0f} µs   "
+          f"p99 {percentile(broker.handler_s, 99) * 1e6:,.0f} µs")
+    print(f"end-to-end     p50 {percentile(latencies, 50) * 1000:,.1f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:,.1f} ms   (due → commit)")
+    print(f"RSS            {mb(rss_before):.1f} → {mb(rss_after):.1f} MB "
+          f"(+{mb(rss_after - rss_before):.1f} MB, history {mb(gw.history.info()['bytes_total']):.1f} MB)")
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"python heap    +{mb(current):.1f} MB (peak {mb(peak):.1f} MB)")
+    if args.db == "fake":
+        print(f"fake db        {gw.db.snapshot()}")
+
+
+if __name__ == '__main__':
+    main()
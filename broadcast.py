@@ -0,0 +1,282 @@
+import os
+import threading
+import time
+from log import get_logger
+from metrics import SOCKETIO_FRAMES, stage_start, stage_done
+
+# ---------------------------
+# Coalesced Socket.IO broadcast
+# ---------------------------
+# แทน socketio.emit() ทุก message: รวมค่าล่าสุดต่อ device ไว้ แล้วส่ง 1 frame ต่อ event ต่อ tick
+#   frame = {"t": epoch ms, "devices": {device: {field ที่เปลี่ยนจาก frame ก่อน: ค่า}}}
+# → จำนวน frame ขึ้นกับ BROADCAST_HZ ไม่ใช่ความถี่ที่ device publish
+#
+# client ที่ตามไม่ทัน (engine.io queue ค้างเกิน BROADCAST_MAX_BACKLOG packet)
+# จะถูกข้ามใน tick นั้น แล้วได้ delta ที่รวมไว้ (เฉพาะค่าล่าสุด) เมื่อ queue ลดลง
+# BROADCAST_HZ=0 → emit ทุก message เป็น payload เดิม (row ทั้งแถว ไม่ห่อ frame, ไม่ส่ง snapshot ตอน connect)
+#   = รูปแบบเดียวกับ socketio.emit("mqtt_data", row) ก่อนมี broadcaster → dashboard เดิมใช้ได้ไม่ต้องแก้
+# client ที่อยู่ทั้ง room ของ device และ room "*" ได้แต่ละ update ครั้งเดียว
+#
+# room ต่อ (event, device): client ส่ง
+#   socket.emit("subscribe",   {"event": "mqtt_data", "device": "dev9"})   // device "*" = ทุก device
+#   socket.emit("unsubscribe", {"event": "mqtt_data", "device": "dev9"})
+# แล้วจะได้เฉพาะ frame ของ device นั้น + ค่าล่าสุดทันทีตอน subscribe
+# client ที่ยังไม่ subscribe อะไรเลยได้ทุก event/device (BROADCAST_DEFAULT_ALL=1) เพื่อให้ dashboard เดิมยังใช้ได้
+
+BROADCAST_HZ = float(os.getenv("BROADCAST_HZ", 10))
+BROADCAST_MAX_BACKLOG = int(os.getenv("BROADCAST_MAX_BACKLOG", 16))
+BROADCAST_DEFAULT_ALL = os.getenv("BROADCAST_DEFAULT_ALL", "1") == "1"
+ALL_DEVICES = "*"
+
+_MISSING = object()
+log = get_logger("broadcast")
+
+
+def room_name(event, device):
+    return f"{event}:{device}"
+
+
+# payload ของ subscribe / unsubscribe → (event, device)
+def subscription_args(data):
+    data = data or {}
+    if isinstance(data, str):
+        data = {"device": data}
+    return data.get("event", "mqtt_data"), str(data.get("device", ALL_DEVICES))
+
+
+def merge_changes(into, changes):
+    for device, fields in changes.items():
+        into.setdefault(device, {}).update(fields)
+
+
+class Broadcaster:
+    def __init__(self, socketio, hz=BROADCAST_HZ, max_backlog=BROADCAST_MAX_BACKLOG,
+                 default_all=BROADCAST_DEFAULT_ALL):
+        self.socketio = socketio
+        self.hz = hz
+        self.max_backlog = max_backlog
+        self.default_all = default_all
+        self.events = set()    # event ที่เคยมี publish (ใช้กับ client ที่ subscribe ทั้งหมด)
+        self.subscriptions = {}  # sid → {(event, device)}; None = ทุกอย่าง (default_all)
+        self.lock = threading.Lock()
+        self.pending = {}      # event → {device: fields รวมตั้งแต่ tick ก่อน}
+        self.last_sent = {}    # event → {device: state ล่าสุดที่ส่งไปแล้ว}
+        self.lagging = {}      # sid → {event → {device: fields}} ที่ค้างส่ง
+        self.stats = {"published": 0, "coalesced": 0, "frames": 0, "skipped_clients": 0, "ticks": 0}
+        self._started = False
+
+    def start(self):
+        if self.hz > 0 and not self._started:
+            self._started = True
+            self.socketio.start_background_task(self._run)
+        return self
+
+    def publish(self, event, device, row):
+        self.stats["published"] += 1
+        if event not in self.events:
+            self._new_event(event)
+        if self.hz <= 0:
+            self.emit_device(event, device, row)
+            with self.lock:
+                self.last_sent.setdefault(event, {})[device] = dict(row)
+            return
+        with self.lock:
+            devices = self.pending.setdefault(event, {})
+            if device in devices:
+                self.stats["coalesced"] += 1
+                devices[device].update(row)
+            else:
+                devices[device] = dict(row)
+
+    # ---------------------------
+    # Rooms / subscriptions
+    # ---------------------------
+    def connect(self, sid):
+        with self.lock:
+            self.subscriptions[sid] = None if self.default_all else set()
+        if self.default_all:
+            self._enter(sid, [(event, ALL_DEVICES) for event in self.known_events()])
+            if self.hz > 0:
+                self.send_snapshot(sid)
+
+    def subscribe(self, sid, event, device):
+        with self.lock:
+            subs = self.subscriptions.get(sid)
+            if subs is None:
+                # subscribe ครั้งแรก → เลิกรับทุกอย่างแบบ default แล้วรับเฉพาะที่ขอ
+                subs = self.subscriptions[sid] = set()
+                self._leave(sid, [(e, ALL_DEVICES) for e in self.events])
+            subs.add((event, device))
+        self._enter(sid, [(event, device)])
+        self.send_snapshot(sid, [(event, device)])
+
+    def unsubscribe(self, sid, event, device):
+        with self.lock:
+            subs = self.subscriptions.get(sid)
+            if subs:
+                subs.discard((event, device))
+        self._leave(sid, [(event, device)])
+
+    def _new_event(self, event):
+        # event ใหม่ → client แบบ default (รับทุกอย่าง) ต้องเข้า room "*" ของ event นี้ด้วย
+        with self.lock:
+            if event in self.events:
+                return
+            self.events.add(event)
+            default_sids = [sid for sid, subs in self.subscriptions.items() if subs is None]
+        for sid in default_sids:
+            self._enter(sid, [(event, ALL_DEVICES)])
+
+    def forget(self, sid):
+        with self.lock:
+            self.lagging.pop(sid, None)
+            self.subscriptions.pop(sid, None)
+
+    def wants(self, sid, event, device):
+        subs = self.subscriptions.get(sid)
+        return subs is None or (event, device) in subs or (event, ALL_DEVICES) in subs
+
+    def known_events(self):
+        with self.lock:
+            return list(self.events)
+
+    def all_device_sids(self, event):
+        # เรียกโดยถือ lock อยู่แล้ว ; sid ที่อยู่ใน room "*" ของ event (ได้ frame รวมอยู่แล้ว)
+        return [sid for sid, subs in self.subscriptions.items()
+                if subs is None or (event, ALL_DEVICES) in subs]
+
+    # ---------------------------
+    # Socket.IO I/O (AsyncBroadcaster ใน aio_gateway.py override ส่วนนี้)
+    # ---------------------------
+    @property
+    def server(self):
+        return self.socketio.server
+
+    def _emit(self, event, data, to, skip_sid=None):
+        self.socketio.emit(event, data, to=to, skip_sid=skip_sid)
+
+    def _enter(self, sid, keys):
+        for event, device in keys:
+            self.server.enter_room(sid, room_name(event, device), namespace="/")
+
+    def _leave(self, sid, keys):
+        for event, device in keys:
+            self.server.leave_room(sid, room_name(event, device), namespace="/")
+
+    # ส่งค่าล่าสุดให้ client (ทั้งหมดที่ subscribe อยู่ หรือเฉพาะ keys) → frame ต่อจากนี้เป็น delta
+    def send_snapshot(self, sid, keys=None):
+        with self.lock:
+            frames = {}
+            for event, devices in self.last_sent.items():
+                for device, state in devices.items():
+                    if keys is None:
+                        ok = self.wants(sid, event, device)
+                    else:
+                        ok = (event, device) in keys or (event, ALL_DEVICES) in keys
+                    if ok and state:
+                        frames.setdefault(event, {})[device] = dict(state)
+        for event, devices in frames.items():
+            if self.hz > 0:
+                self._emit(event, self.frame(devices), to=sid)
+            else:
+                for row in devices.values():
+                    self._emit(event, row, to=sid)
+
+    def emit_to(self, sid, event, data):
+        self._emit(event, data, to=sid)
+
+    def emit_device(self, event, device, row, skip_sid=None):
+        # BROADCAST_HZ=0: row เดิม → room ของ device นั้น + room "*" ของ event
+        # to เป็น list → socketio รวม participant ของทุก room ก่อนส่ง (sid ที่อยู่ทั้งสอง room ได้ครั้งเดียว)
+        self._emit(event, row, to=[room_name(event, device), room_name(event, ALL_DEVICES)], skip_sid=skip_sid)
+
+    def frame(self, devices):
+        return {"t": int(time.time() * 1000), "devices": devices}
+
+    # ---------------------------
+    # Tick loop
+    # ---------------------------
+    def _run(self):
+        interval = 1.0 / self.hz
+        while True:
+            self.socketio.sleep(interval)
+            try:
+                self.tick()
+            except Exception as e:
+                log.error("❌ Error in broadcast tick: %s", e)
+
+    def tick(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            frames = {}
+            for event, devices in pending.items():
+                sent = self.last_sent.setdefault(event, {})
+                changes = {}
+                for device, row in devices.items():
+                    last = sent.setdefault(device, {})
+                    diff = {k: v for k, v in row.items() if last.get(k, _MISSING) != v}
+                    if diff:
+                        last.update(diff)
+                        changes[device] = diff
+                if changes:
+                    frames[event] = changes
+            everything = {event: self.all_device_sids(event) for event in frames}
+        self.stats["ticks"] += 1
+
+        if not frames and not self.lagging:
+            return
+        started = stage_start()
+        slow = self.slow_clients()
+        skip = list(slow) or None
+        for event, changes in frames.items():
+            # 1 frame ต่อ device room + 1 frame รวมสำหรับ room "*"
+            # (sid ที่อยู่ room "*" ด้วยถูกข้ามใน frame ของ device → ไม่ได้ diff เดียวกันสองครั้ง)
+            device_skip = list(slow.union(everything[event])) or None
+            for device, diff in changes.items():
+                self._emit(event, self.frame({device: diff}), to=room_name(event, device), skip_sid=device_skip)
+            self._emit(event, self.frame(changes), to=room_name(event, ALL_DEVICES), skip_sid=skip)
+            self.stats["frames"] += len(changes) + 1
+            SOCKETIO_FRAMES.inc(event, n=len(changes) + 1)
+
+        # client ที่ช้า: เก็บเฉพาะค่าล่าสุดไว้, client ที่ตามทันแล้ว: ส่งที่ค้างไปทีเดียว
+        with self.lock:
+            for sid in slow:
+                backlog = self.lagging.setdefault(sid, {})
+                for event, changes in frames.items():
+                    wanted = {d: f for d, f in changes.items() if self.wants(sid, event, d)}
+                    if wanted:
+                        merge_changes(backlog.setdefault(event, {}), wanted)
+            caught_up = [sid for sid in self.lagging if sid not in slow]
+            resend = {sid: self.lagging.pop(sid) for sid in caught_up}
+        self.stats["skipped_clients"] += len(slow)
+        for sid, backlog in resend.items():
+            for event, devices in backlog.items():
+                self._emit(event, self.frame(devices), to=sid)
+                self.stats["frames"] += 1
+                SOCKETIO_FRAMES.inc(event)
+        stage_done("emit", started)
+
+    def slow_clients(self):
+        # อ่าน queue ขาออกของ engine.io ต่อ client (ไม่มี API ตรงๆ → ถ้าอ่านไม่ได้ถือว่าไม่ช้า)
+        slow = set()
+        if self.max_backlog <= 0:
+            return slow
+        try:
+            server = self.server
+            for sid, eio_sid in list(server.manager.get_participants("/", None)):
+                sock = server.eio.sockets.get(eio_sid)
+                if sock is not None and sock.queue.qsize() > self.max_backlog:
+                    slow.add(sid)
+        except Exception:
+            pass
+        return slow
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "hz": self.hz,
+            "max_backlog": self.max_backlog,
+            "lagging_clients": len(self.lagging),
+            "clients": len(self.subscriptions),
+            "devices": sum(len(d) for d in self.last_sent.values()),
+        }
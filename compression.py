@@ -0,0 +1,257 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime
+from history import to_number
+from log import get_logger
+
+# ---------------------------
+# Report-by-exception / deadband / swinging-door ก่อนลง PostgreSQL
+# ---------------------------
+# device map (ไม่มี = เก็บทุกแถวแบบเดิม):
+#   "compression": {
+#     "iotdata.wise4210_data": {
+#       "time_column": "timestamp", "heartbeat": 300,
+#       "tags": {"di1": "change", "do1": "change",
+#                "temp": {"swinging_door": 0.2}, "humidity": {"deadband": 0.5}}
+#     }
+#   }
+# ตัดสินต่อ device (topic) ทั้งแถว: แถวถูกเก็บเมื่อ tag ใด tag หนึ่งมีนัย
+#   change        → ค่าต่างจากแถวที่เก็บล่าสุด (DI/DO)
+#   deadband      → |ค่า - ค่าที่เก็บล่าสุด| > band                        (อ่านกลับแบบ step)
+#   swinging_door → เส้นตรงจากแถวที่เก็บล่าสุด คลาดไม่เกิน deviation    (อ่านกลับแบบ linear)
+#     แถวที่ทำให้ประตูปิด → เก็บแถวก่อนหน้า (ที่ถือไว้) แล้วเริ่มประตูใหม่จากแถวนั้น
+#   heartbeat     → ไม่ได้เก็บเกิน heartbeat วินาที (เวลาของ reading) → เก็บแถวนี้
+#                   ต้อง > 0 (default COMPRESSION_HEARTBEAT) → table มีแถวของทุก device อย่างน้อยทุก heartbeat
+# เฉพาะแถวที่ลง table เท่านั้น, history / latest / Socket.IO ยังได้ทุกแถว
+# /query เติม bucket ว่างกลับเป็น step / linear ตาม tag (grafana.fill_results) เริ่มจากค่าล่าสุดก่อน window
+#
+# แถวที่ถือไว้ (แถวล่าสุดที่ยังไม่เก็บ) ถูกเก็บเมื่อ
+#   - แถวถัดไปของ device เดียวกันทำให้ประตูปิด
+#   - ไม่ได้เก็บอะไรของ device นั้นเกิน heartbeat วินาที (thread / task ตรวจทุก COMPRESSION_TICK วินาที)
+#   - ปิด process (stop / flush_all ก่อน writer หยุด)
+# → เส้นของ /query จบที่ค่าจริงล่าสุด ไม่ลากค่าที่เก็บไว้เก่าไปถึงปัจจุบัน
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") == "1"
+COMPRESSION_HEARTBEAT = float(os.getenv("COMPRESSION_HEARTBEAT", 300))
+COMPRESSION_TICK = float(os.getenv("COMPRESSION_TICK", 5))
+TAG_MODES = ("change", "deadband", "swinging_door")
+FILL_MODES = {"change": "step", "deadband": "step", "swinging_door": "linear"}
+
+EPOCH = datetime(1970, 1, 1)
+
+log = get_logger("compression")
+
+
+def row_seconds(row, time_column):
+    ts = row.get(time_column)
+    if isinstance(ts, datetime):
+        return (ts - EPOCH).total_seconds() if ts.tzinfo is None else ts.timestamp()
+    return time.time()
+
+
+def parse_tag(name, spec):
+    # "change" | {"deadband": 0.5} | {"swinging_door": 0.2} → (mode, ค่า)
+    if isinstance(spec, str):
+        spec = {spec: 0}
+    for mode in TAG_MODES:
+        if mode in spec:
+            return mode, float(spec[mode] or 0)
+    raise ValueError(f"Unknown compression for {name}: {spec} (known: {', '.join(TAG_MODES)})")
+
+
+class DeviceState:
+    __slots__ = ("archived", "archived_t", "archived_seen", "held", "topic", "doors")
+
+    def __init__(self, row, t, topic=None):
+        self.archived = row           # แถวที่เก็บล่าสุด
+        self.archived_t = t
+        self.archived_seen = time.monotonic()
+        self.held = None              # แถวล่าสุดที่ยังไม่เก็บ
+        self.topic = topic            # MQTT topic ของแถวที่ถือไว้ (metrics ของ writer)
+        self.doors = {}               # tag → [slope ต่ำสุด, slope สูงสุด] ที่ยังผ่านได้
+
+
+class Compressor:
+    def __init__(self, table, tags, time_column="timestamp", heartbeat=COMPRESSION_HEARTBEAT):
+        if not heartbeat or heartbeat <= 0:
+            raise ValueError(f"Compression of {table} needs a heartbeat > 0 seconds")
+        self.table = table
+        self.time_column = time_column
+        self.heartbeat = heartbeat
+        self.tags = {name: parse_tag(name, spec) for name, spec in tags.items()}
+        self.doors = [(name, dev) for name, (mode, dev) in self.tags.items() if mode == "swinging_door"]
+        self.devices = {}
+        self.lock = threading.Lock()   # device ต่างกันอยู่คนละ worker shard ได้
+        self.stats = {"offered": 0, "stored": 0, "flushed": 0}
+
+    def offer(self, device, row, topic=None):
+        # → แถวที่ต้องเก็บ (0, 1 หรือ 2 แถว)
+        t = row_seconds(row, self.time_column)
+        with self.lock:
+            self.stats["offered"] += 1
+            state = self.devices.get(device)
+            if state is None:
+                self.devices[device] = DeviceState(row, t, topic)
+                return self._stored([row])
+            state.topic = topic
+            broken = self._swing(state, row, t)
+            significant = self._significant(state, row) or t - state.archived_t >= self.heartbeat
+            out = []
+            if broken and state.held is not None:
+                out.append(self._archive(state, state.held))
+                self._swing(state, row, t)        # ประตูใหม่จากแถวที่เพิ่งเก็บ
+            if significant:
+                out.append(self._archive(state, row, t))
+            else:
+                state.held = row
+            return self._stored(out)
+
+    def _stored(self, rows):
+        self.stats["stored"] += len(rows)
+        return rows
+
+    def due(self, everything=False):
+        # แถวที่ถือไว้ของ device ที่ไม่ได้เก็บอะไรเกิน heartbeat วินาที (everything = ทุก device) → [(row, topic)]
+        now = time.monotonic()
+        out = []
+        with self.lock:
+            for state in self.devices.values():
+                if state.held is not None and (everything or now - state.archived_seen >= self.heartbeat):
+                    topic = state.topic
+                    out.append((self._archive(state, state.held), topic))
+            self.stats["stored"] += len(out)
+            self.stats["flushed"] += len(out)
+        return out
+
+    def _archive(self, state, row, t=None):
+        state.archived = row
+        state.archived_t = row_seconds(row, self.time_column) if t is None else t
+        state.archived_seen = time.monotonic()
+        state.held = None
+        state.doors = {}
+        return row
+
+    def _significant(self, state, row):
+        for name, (mode, band) in self.tags.items():
+            if mode == "swinging_door":
+                continue
+            value, last = row.get(name), state.archived.get(name)
+            if mode == "change":
+                if value != last:
+                    return True
+                continue
+            v, prev = to_number(value), to_number(last)
+            if v is None or prev is None or math.isnan(v) or math.isnan(prev):
+                if (v is None) != (prev is None):
+                    return True
+                continue
+            if abs(v - prev) > band:
+                return True
+        return False
+
+    def _swing(self, state, row, t):
+        # แคบประตูของทุก tag ด้วยแถวนี้ → True ถ้าแถวนี้อยู่นอกประตูของ tag ใด tag หนึ่ง
+        dt = t - state.archived_t
+        if dt <= 0:
+            return False
+        broken = False
+        for name, dev in self.doors:
+            v, v0 = to_number(row.get(name)), to_number(state.archived.get(name))
+            if v is None or v0 is None or math.isnan(v) or math.isnan(v0):
+                continue
+            door = state.doors.get(name)
+            if door is None:
+                door = state.doors[name] = [-math.inf, math.inf]
+            slope = (v - v0) / dt
+            if not door[0] <= slope <= door[1]:
+                broken = True
+            door[0] = max(door[0], (v - dev - v0) / dt)
+            door[1] = min(door[1], (v + dev - v0) / dt)
+        return broken
+
+    def fill_modes(self):
+        return {name: FILL_MODES[mode] for name, (mode, _) in self.tags.items()}
+
+    def snapshot(self):
+        with self.lock:
+            offered = self.stats["offered"]
+            return {**self.stats, "devices": len(self.devices), "heartbeat": self.heartbeat,
+                    "held": sum(1 for s in self.devices.values() if s.held is not None),
+                    "ratio": round(self.stats["stored"] / offered, 4) if offered else None}
+
+
+class CompressionSet:
+    def __init__(self, compressors=()):
+        self.compressors = {c.table: c for c in compressors}
+        self._writer = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_device_map(cls, device_map):
+        time_columns = {s["table"]: s.get("time_column", "timestamp") for s in device_map.get("grafana", [])}
+        compressors = []
+        for table, opts in device_map.get("compression", {}).items():
+            compressors.append(Compressor(
+                table, opts.get("tags", {}),
+                time_column=opts.get("time_column", time_columns.get(table, "timestamp")),
+                heartbeat=float(opts.get("heartbeat", COMPRESSION_HEARTBEAT)),
+            ))
+        return cls(compressors)
+
+    def filter(self, table, device, row, topic=None):
+        compressor = self.compressors.get(table)
+        if compressor is None:
+            return [row]
+        return compressor.offer(device, row, topic)
+
+    # ---------------------------
+    # แถวที่ถือไว้ → writer (heartbeat / ปิด process)
+    # ---------------------------
+    def flush_due(self, writer, everything=False):
+        n = 0
+        for table, compressor in self.compressors.items():
+            for row, topic in compressor.due(everything):
+                writer.put(table, row, topic)
+                n += 1
+        return n
+
+    def flush_all(self, writer):
+        n = self.flush_due(writer, everything=True)
+        if n:
+            log.info("🗜️ Flushed %d held rows before shutdown", n)
+        return n
+
+    def start(self, writer):
+        # Flask gateway: thread ตรวจ heartbeat ; aio_gateway เรียก flush_due จาก task บน loop แทน
+        self._writer = writer
+        if self.compressors:
+            self._thread = threading.Thread(target=self._run, name="compression", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        # ก่อน writer.stop (atexit เรียกกลับลำดับ) → แถวที่ถือไว้ลงคิว writer ทัน
+        self._stop.set()
+        if self._writer is not None:
+            self.flush_all(self._writer)
+
+    def _run(self):
+        while not self._stop.wait(COMPRESSION_TICK):
+            try:
+                self.flush_due(self._writer)
+            except Exception as e:
+                log.error("❌ Flushing held rows failed: %s", e)
+
+    def fills(self, grafana_targets):
+        # ชื่อ target ของ /query → "step" / "linear" (target ของ table ที่บีบอัด)
+        out = {}
+        for name, (table, column, _) in grafana_targets.items():
+            compressor = self.compressors.get(table)
+            if compressor is not None and column in compressor.tags:
+                out[name] = compressor.fill_modes()[column]
+        return out
+
+    def snapshot(self):
+        return {table: c.snapshot() for table, c in self.compressors.items()}
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool, extensions
+from log import get_logger
+
+# ---------------------------
+# PostgreSQL connection pool
+# ---------------------------
+# ใช้ร่วมกันระหว่าง thread ของ MQTT/BatchWriter และ thread ของ Flask (/query)
+# - min/max connection (ThreadedConnectionPool) + semaphore ให้รอคิวได้แทน PoolError
+# - health check ตอน checkout (connection ปิดไปแล้ว / idle นานเกิน → SELECT 1)
+# - connect ไม่ได้ → backoff แบบ exponential แล้วค่อยลองใหม่ (ไม่พังถาวรเหมือน PG_CONN เดิม)
+# - statement_timeout ต่อการ checkout
+#
+#   with db.connection() as conn:
+#       with conn.cursor() as cursor: ...
+#       conn.commit()
+
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", 1))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", 5))
+PG_STATEMENT_TIMEOUT_MS = int(os.getenv("PG_STATEMENT_TIMEOUT_MS", 10000))
+PG_CHECKOUT_TIMEOUT = float(os.getenv("PG_CHECKOUT_TIMEOUT", 5))
+HEALTH_CHECK_IDLE = 30.0      # วินาที; idle นานกว่านี้ต้อง SELECT 1 ก่อนใช้
+BACKOFF_MIN = 1.0
+BACKOFF_MAX = 30.0
+
+log = get_logger("db")
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+class Database:
+    def __init__(self, minconn=PG_POOL_MIN, maxconn=PG_POOL_MAX,
+                 statement_timeout_ms=PG_STATEMENT_TIMEOUT_MS, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.statement_timeout_ms = statement_timeout_ms
+        self.connect_kwargs = connect_kwargs
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}          # id(conn) → monotonic เวลาคืน pool ล่าสุด
+        self._timeouts = {}           # id(conn) → statement_timeout ที่ตั้งไว้
+        self._backoff = BACKOFF_MIN
+        self._retry_at = 0.0
+        self.stats = {
+            "in_use": 0, "checkouts": 0, "reconnects": 0, "failed_connects": 0,
+            "discarded": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "wait_ms_last": 0.0,
+        }
+
+    # ---------------------------
+    # Pool lifecycle / reconnect
+    # ---------------------------
+    def _ensure_pool(self):
+        if self._pool is not None:
+            return self._pool
+        with self._lock:
+            if self._pool is not None:
+                return self._pool
+            self._check_backoff()
+            try:
+                self._pool = pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.connect_kwargs)
+            except psycopg2.Error as e:
+                self._connect_failed(e)
+            log.info("✅ PostgreSQL pool ready (%d-%d connections).", self.minconn, self.maxconn)
+            self._backoff = BACKOFF_MIN
+            return self._pool
+
+    def _check_backoff(self):
+        wait = self._retry_at - time.monotonic()
+        if wait > 0:
+            raise DatabaseUnavailable(f"PostgreSQL unavailable, retrying in {wait:.1f}s")
+
+    def _connect_failed(self, e):
+        self.stats["failed_connects"] += 1
+        self._retry_at = time.monotonic() + self._backoff
+        log.error("❌ PostgreSQL connection failed (retry in %.0fs): %s", self._backoff, e)
+        self._backoff = min(self._backoff * 2, BACKOFF_MAX)
+        raise DatabaseUnavailable(str(e)) from e
+
+    def _getconn(self):
+        p = self._ensure_pool()
+        with self._lock:
+            self._check_backoff()
+            try:
+                conn = p.getconn()
+            except psycopg2.Error as e:
+                self._connect_failed(e)
+            self._backoff = BACKOFF_MIN
+            return conn
+
+    def _discard(self, conn):
+        self.stats["discarded"] += 1
+        self._last_used.pop(id(conn), None)
+        self._timeouts.pop(id(conn), None)
+        try:
+            self._pool.putconn(conn, close=True)
+        except Exception:
+            pass
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        last = self._last_used.get(id(conn))
+        if last is not None and time.monotonic() - last < HEALTH_CHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    # ---------------------------
+    # Checkout / checkin
+    # ---------------------------
+    def _checkout(self, statement_timeout_ms, timeout):
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=timeout):
+            raise DatabaseUnavailable("PostgreSQL pool exhausted")
+        conn = None
+        try:
+            while True:
+                conn = self._getconn()
+                if self._healthy(conn):
+                    break
+                self._discard(conn)
+                conn = None
+                self.stats["reconnects"] += 1
+            self._set_timeout(conn, statement_timeout_ms)
+        except Exception:
+            # SET statement_timeout ไม่ผ่าน → ทิ้ง connection ด้วย ไม่งั้น pool ค้างไว้จนเต็ม maxconn
+            if conn is not None:
+                self._discard(conn)
+            self._slots.release()
+            raise
+
+        wait_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            s = self.stats
+            s["in_use"] += 1
+            s["checkouts"] += 1
+            s["wait_ms_total"] += wait_ms
+            s["wait_ms_last"] = round(wait_ms, 2)
+            s["wait_ms_max"] = max(s["wait_ms_max"], round(wait_ms, 2))
+        return conn
+
+    def _set_timeout(self, conn, statement_timeout_ms):
+        if statement_timeout_ms is None:
+            statement_timeout_ms = self.statement_timeout_ms
+        if self._timeouts.get(id(conn)) == statement_timeout_ms:
+            return
+        with conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = %s", (statement_timeout_ms,))
+        conn.commit()
+        self._timeouts[id(conn)] = statement_timeout_ms
+
+    def _checkin(self, conn, broken):
+        with self._lock:
+            self.stats["in_use"] -= 1
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+                return
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn)
+        except Exception:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, statement_timeout_ms=None, timeout=PG_CHECKOUT_TIMEOUT):
+        conn = self._checkout(statement_timeout_ms, timeout)
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            # rollback ไม่ได้ = connection เสีย → ทิ้งไป ไม่คืนเข้า pool
+            broken = not self._reset(conn)
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    def _reset(self, conn):
+        if conn.closed:
+            return False
+        try:
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def snapshot(self):
+        s = dict(self.stats)
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / s["checkouts"], 2) if s["checkouts"] else 0.0
+        s["wait_ms_total"] = round(s["wait_ms_total"], 2)
+        s["min_size"] = self.minconn
+        s["max_size"] = self.maxconn
+        s["connected"] = self._pool is not None and time.monotonic() >= self._retry_at
+        return s
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
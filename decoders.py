@@ -0,0 +1,324 @@
+import os
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from stream_join import StreamJoin
+
+# ---------------------------
+# Payload decoders
+# ---------------------------
+# แต่ละ decoder = handler เดิมจาก wise*-postgres.py
+#   decode(topic, data, state) → list ของแถวที่จะ insert (ว่าง = ยังไม่ต้อง insert)
+#   state = decoder.state() ต่อ route (dict หรือ StreamJoin ของ decoder ที่รวมสองข้อความเป็นแถวเดียว)
+# columns = column ของ table ปลายทาง (BatchWriter.register)
+# fields  = field ตัวเลขที่เก็บใน HistoryStore
+# key     = column ที่ระบุ reading สำหรับตัดแถวซ้ำ (dedup.py) ; ignore = column ที่ไม่เทียบ (เช่นเวลาที่รับ)
+# packed  = (ช่อง di/do ตามลำดับ bit, type เดิมของช่อง) ของ decoder *_packed ที่เก็บ di/do เป็น bitmask "io"
+#
+# hot path: ไม่ใช้ strptime (ช้าที่สุดต่อ message) และไม่เรียก data.get ทีละบรรทัด
+# → parse_wise_time() แบบ fixed format + schema (column, key, default) ที่ compile ไว้ตอน import
+
+DECODERS = {}
+
+
+def decoder(name, columns, fields=(), state=dict, key=(), ignore=(), packed=None):
+    def register(fn):
+        fn.decoder_name = name
+        fn.columns = list(columns)
+        fn.fields = list(fields)
+        fn.state = state
+        fn.key = tuple(key)
+        fn.ignore = tuple(ignore)
+        fn.packed = packed
+        DECODERS[name] = fn
+        return fn
+    return register
+
+
+# "2025-05-30T04:23:00Z" (UTC) → naive datetime เหมือน strptime(..., "%Y-%m-%dT%H:%M:%SZ")
+# device หลายตัว publish วินาทีเดียวกัน → จำผลล่าสุดไว้ 1 ตัว
+_last_time = (None, None)
+
+
+def parse_wise_time(s):
+    global _last_time
+    last_s, last_dt = _last_time
+    if s == last_s:
+        return last_dt
+    if len(s) == 20 and s[10] == "T" and s[19] == "Z":
+        dt = datetime.fromisoformat(s[:19])
+    else:
+        dt = datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
+    _last_time = (s, dt)
+    return dt
+
+
+def compile_schema(fields, converted=()):
+    # fields    = [(column, key, default)]          → row[column] = data.get(key, default)
+    # converted = [(column, key, default, convert)] → row[column] = convert(data.get(key, default))
+    fields = tuple(fields)
+    converted = tuple(converted)
+
+    def extract(data):
+        get = data.get
+        row = {col: get(key, default) for col, key, default in fields}
+        for col, key, default, convert in converted:
+            row[col] = convert(get(key, default))
+        return row
+    return extract
+
+
+def pack_bits(data, keys):
+    # ช่อง di/do ของ payload → bitmask (bit i = keys[i])
+    mask = 0
+    for i, k in enumerate(keys):
+        if data.get(k):
+            mask |= 1 << i
+    return mask
+
+
+def get_decoder(name):
+    try:
+        return DECODERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown decoder: {name} (known: {', '.join(sorted(DECODERS))})")
+
+
+# ---------------------------
+# Device_Status (WISE-4012 / WISE-4210)
+# ---------------------------
+# CREATE TABLE iotdata.wise4012_connection_log / iotdata.connection_log (
+#     status VARCHAR(50),
+#     name VARCHAR(100),
+#     macid VARCHAR(50),
+#     ipaddr VARCHAR(50),
+#     timestamp TIMESTAMP
+# );
+# ไม่มี key ของ dedup: payload ไม่มีเวลา / ลำดับของ event → connect ซ้ำจริงกับ retained ที่ส่งซ้ำแยกกันไม่ได้
+@decoder("device_status", ["status", "name", "macid", "ipaddr", "timestamp"])
+def decode_device_status(topic, data, state):
+    if "status" not in data or "macid" not in data:
+        return []
+    return [{
+        "status": data.get("status"),
+        "name": data.get("name"),
+        "macid": data.get("macid"),
+        "ipaddr": data.get("ipaddr"),
+        "timestamp": datetime.utcnow()
+    }]
+
+
+# ---------------------------
+# WISE-4012 I/O
+# ---------------------------
+# CREATE TABLE iotdata.wise4012_8C8046 (   -- และ iotdata.wise4012_FEEAB5
+#     time TIMESTAMP,
+#     s INTEGER, q INTEGER, c INTEGER,
+#     di1 BOOLEAN, di2 BOOLEAN, di3 BOOLEAN, di4 BOOLEAN,
+#     do1 BOOLEAN, do2 BOOLEAN
+# );
+WISE4012_IO_KEYS = ("di1", "di2", "di3", "di4", "do1", "do2")
+extract_wise4012_io = compile_schema(
+    [("s", "s", 0), ("q", "q", 0), ("c", "c", 0)]
+    + [(k, k, False) for k in WISE4012_IO_KEYS]
+)
+
+
+@decoder(
+    "wise4012_io",
+    ["time", "s", "q", "c", "di1", "di2", "di3", "di4", "do1", "do2"],
+    ["s", "q", "c", "di1", "di2", "di3", "di4", "do1", "do2"],
+    key=("time",),      # table แยกต่อ device
+)
+def decode_wise4012_io(topic, data, state):
+    t = data.get("t")
+    row = extract_wise4012_io(data)
+    row["time"] = parse_wise_time(t) if t else datetime.utcnow()
+    return [row]
+
+
+# table แบบ packed: time, s, q, c, io SMALLINT (bit 0-3 = di1-di4, bit 4-5 = do1-do2)
+# di/do ยังอยู่ในแถว (history / latest / Socket.IO) แต่ไม่ลง table
+@decoder(
+    "wise4012_io_packed",
+    ["time", "s", "q", "c", "io"],
+    ["s", "q", "c", "di1", "di2", "di3", "di4", "do1", "do2"],
+    key=("time",), packed=(WISE4012_IO_KEYS, "boolean"),
+)
+def decode_wise4012_io_packed(topic, data, state):
+    rows = decode_wise4012_io(topic, data, state)
+    rows[0]["io"] = pack_bits(data, WISE4012_IO_KEYS)
+    return rows
+
+
+# ---------------------------
+# WISE-4210 I/O + temp/humidity (p1v00r0000x00 / x01)
+# ---------------------------
+# CREATE TABLE iotdata.wise4210_data (
+#     s INTEGER, c INTEGER, q INTEGER, rssi INTEGER,
+#     di1 INTEGER, di2 INTEGER, di3 INTEGER, di4 INTEGER, di5 INTEGER, di6 INTEGER,
+#     do1 INTEGER, do2 INTEGER,
+#     timestamp TIMESTAMP, temp FLOAT, humidity FLOAT
+# );
+WISE4210_IO_KEYS = ("di1", "di2", "di3", "di4", "di5", "di6", "do1", "do2")
+WISE4210_IO_KEY_SET = frozenset(WISE4210_IO_KEYS)
+extract_wise4210_io = compile_schema(
+    [("s", "s", 0), ("c", "c", 0), ("q", "q", 0), ("rssi", "rssi", None)],
+    [(k, k, 0, lambda v: 1 if v else 0) for k in WISE4210_IO_KEYS],
+)
+WISE4210_EMPTY_IO = {
+    "s": 0, "c": 0, "q": 0, "rssi": 0,
+    "di1": 0, "di2": 0, "di3": 0, "di4": 0, "di5": 0, "di6": 0,
+    "do1": 0, "do2": 0,
+    "timestamp": None
+}
+WISE4210_EMPTY_PACKED = {**WISE4210_EMPTY_IO, "io": 0}
+
+
+@decoder(
+    "wise4210",
+    [
+        "s", "c", "q", "rssi",
+        "di1", "di2", "di3", "di4", "di5", "di6",
+        "do1", "do2", "timestamp", "temp", "humidity",
+    ],
+    [
+        "s", "c", "q", "rssi",
+        "di1", "di2", "di3", "di4", "di5", "di6",
+        "do1", "do2", "temp", "humidity",
+    ],
+    state=StreamJoin,
+)
+def decode_wise4210(topic, data, state):
+    return wise4210_rows(topic, data, state, False)
+
+
+# table แบบ packed: di1-di6 / do1-do2 → io SMALLINT (bit 0-5 = di1-di6, bit 6-7 = do1-do2)
+@decoder(
+    "wise4210_packed",
+    ["s", "c", "q", "rssi", "io", "timestamp", "temp", "humidity"],
+    [
+        "s", "c", "q", "rssi",
+        "di1", "di2", "di3", "di4", "di5", "di6",
+        "do1", "do2", "temp", "humidity",
+    ],
+    state=StreamJoin, packed=(WISE4210_IO_KEYS, "integer"),
+)
+def decode_wise4210_packed(topic, data, state):
+    return wise4210_rows(topic, data, state, True)
+
+
+def wise4210_rows(topic, data, state, packed):
+    timestamp = parse_wise_time(data["t"])
+
+    # ถ้ามี I/O → จำไว้ (key = topic = ต่อ device) ยังไม่ insert จนกว่า temp/hum จะมา
+    if not WISE4210_IO_KEY_SET.isdisjoint(data):
+        io = extract_wise4210_io(data)
+        if packed:
+            io["io"] = pack_bits(data, WISE4210_IO_KEYS)
+        state.remember(topic, io, timestamp)
+        return []
+
+    # ถ้ามี temp/humidity → รวมกับ I/O ของ device นี้ที่อยู่ใน join window แล้ว insert
+    if "p1v00r0000x00" in data and "p1v00r0000x01" in data:
+        return [{
+            **(state.match(topic, timestamp) or (WISE4210_EMPTY_PACKED if packed else WISE4210_EMPTY_IO)),
+            "timestamp": timestamp,  # ใช้ timestamp ปัจจุบันจาก temp/hum
+            "temp": float(data.get("p1v00r0000x00", 0)) / 10,
+            "humidity": float(data.get("p1v00r0000x01", 0)) / 10
+        }]
+    return []
+
+
+# ---------------------------
+# ECU-1251 tag list
+# ---------------------------
+# data/device_id {"d":[{"tag":"wise4210:temp","value":249.00},{"tag":"wise4210:hum","value":607.00}],"ts":"2025-05-30T04:23:00Z"}
+# CREATE TABLE iotdata.wise4210_ecu1251 (
+#     device_id VARCHAR(50),
+#     temp NUMERIC,
+#     hum NUMERIC,
+#     timestamp TIMESTAMP,
+#     PRIMARY KEY (device_id, timestamp)
+# );
+# tag → column ("wise4210:temp" → "temp"), คำนวณครั้งเดียวต่อ tag
+# tag มาจาก payload → cache จำกัดขนาด (ECU1251_TAG_CACHE) ไม่ให้ tag แปลกๆ ทำ memory โตไม่สิ้นสุด
+ECU1251_TAG_CACHE = int(os.getenv("ECU1251_TAG_CACHE", 1024))
+
+
+@lru_cache(maxsize=ECU1251_TAG_CACHE)
+def ecu1251_column(tag):
+    return "temp" if "temp" in tag else "hum" if "hum" in tag else ""
+
+
+@decoder("ecu1251", ["device_id", "temp", "hum", "timestamp"], ["temp", "hum"], key=("device_id", "timestamp"))
+def decode_ecu1251(topic, data, state):
+    if "d" not in data or "ts" not in data:
+        return []
+
+    row = {"device_id": topic.rpartition("/")[2], "temp": None, "hum": None}  # device_id จาก topic
+    found = False
+    for item in data["d"]:
+        col = ecu1251_column(item.get("tag"))
+        if col:
+            row[col] = item.get("value") / 10  # scale down
+            found = True
+
+    if not found:
+        return []
+    row["timestamp"] = parse_wise_time(data["ts"])
+    return [row]
+
+
+# ---------------------------
+# WISE-6610 / WISE-2200 (RtuRegister)
+# ---------------------------
+# CREATE TABLE iotdata.wise2200_data (
+#     temp FLOAT,
+#     temp_status INTEGER,
+#     humidity FLOAT,
+#     humidity_status INTEGER,
+#     rssi INTEGER,
+#     devaddr VARCHAR(50),
+#     timestamp TIMESTAMP
+# );
+WISE2200_TZ = timezone(timedelta(hours=7))
+WISE2200_SIGNAL_KEYS = ("rssi", "devaddr")
+
+
+# ตรวจสอบว่าเป็นข้อมูลจาก RtuRegister หรือไม่
+def is_valid_wise2200(data):
+    return (
+        "RtuRegister0-0" in data and
+        "RtuRegister0-1" in data and
+        "Device" in data and
+        "Time" in data["Device"] and
+        "Data" in data["RtuRegister0-0"] and
+        "Data" in data["RtuRegister0-1"]
+    )
+
+
+@decoder(
+    "wise2200",
+    ["temp", "temp_status", "humidity", "humidity_status", "rssi", "devaddr", "timestamp"],
+    ["temp", "temp_status", "humidity", "humidity_status", "rssi"],
+    state=StreamJoin, key=("devaddr", "timestamp"),
+)
+def decode_wise2200(topic, data, state):
+    # อัปเดตค่า rssi/devaddr ถ้ามีในข้อมูล (เก็บไว้ต่อ topic ใช้ตอน RtuRegister ของ device เดียวกันมา)
+    signal = {k: data[k] for k in WISE2200_SIGNAL_KEYS if k in data}
+    if signal:
+        state.remember(topic, signal)
+
+    if not is_valid_wise2200(data):
+        return []
+
+    signal = state.match(topic) or {}
+    return [{
+        "temp": float(data["RtuRegister0-0"]["Data"])/10,
+        "temp_status": data["RtuRegister0-0"]["Status"],
+        "humidity": float(data["RtuRegister0-1"]["Data"])/10,
+        "humidity_status": data["RtuRegister0-1"]["Status"],
+        "rssi": signal.get("rssi"),         # ค่าล่าสุดของ device นี้ (ภายใน join window)
+        "devaddr": signal.get("devaddr"),
+        "timestamp": datetime.fromtimestamp(data["Device"]["Time"], WISE2200_TZ),
+    }]
@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from metrics import REGISTRY
+
+# ---------------------------
+# Duplicate suppression ก่อนถึง PostgreSQL
+# ---------------------------
+# ECU-1251 ส่งซ้ำหลัง reconnect → แถวซ้ำไม่ต้องเข้าคิว writer / database เลย
+# ต่อ table: key = column ที่ระบุ reading (เช่น device_id + timestamp) ที่ decoder ประกาศไว้
+#   decoder ที่ payload ไม่มีเวลาของ event (Device_Status) ไม่ประกาศ key → ไม่ตรวจ
+#   จำค่าของ column ที่เหลือ (ยกเว้น ignore เช่นเวลาที่รับ) ของ key ล่าสุด
+#   key เดิม + ค่าเดิม → ซ้ำ (ทิ้ง), key เดิม + ค่าใหม่ → ผ่าน (ON CONFLICT ของ writer ตัดสิน)
+# LRU + TTL: จำไม่เกิน DEDUP_MAX_KEYS key, key ที่ไม่เห็นเกิน DEDUP_TTL วินาทีถูกลืม
+# แถวที่ key มี None → ไม่ตรวจ (ระบุ reading ไม่ได้)
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", 100000))
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", 3600))
+
+DUPLICATES = REGISTRY.counter(
+    "wise_duplicates_total", "Rows dropped as duplicates before reaching PostgreSQL", ["table"])
+
+
+class Deduplicator:
+    def __init__(self, max_keys=DEDUP_MAX_KEYS, ttl=DEDUP_TTL, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.clock = clock
+        self.tables = {}              # table → (key columns, compared columns)
+        self.seen = OrderedDict()     # (table, key values) → (ค่าที่เทียบ, monotonic) หัว = เก่าสุด
+        self.lock = threading.Lock()  # put() มาจากหลาย worker shard
+        self.stats = {"checked": 0, "duplicates": 0, "expired": 0, "evicted": 0}
+
+    def register(self, table, key, columns, ignore=()):
+        key = tuple(key)
+        self.tables[table] = (key, tuple(c for c in columns if c not in key and c not in ignore))
+
+    def duplicate(self, table, row):
+        spec = self.tables.get(table)
+        if spec is None:
+            return False
+        key_columns, compared = spec
+        key = (table,) + tuple(row.get(c) for c in key_columns)
+        if None in key:
+            return False
+        values = tuple(row.get(c) for c in compared)
+        now = self.clock()
+        with self.lock:
+            self.stats["checked"] += 1
+            entry = self.seen.pop(key, None)
+            self.seen[key] = (values, now)
+            self._expire(now)
+            if entry is None or now - entry[1] > self.ttl or entry[0] != values:
+                return False
+            self.stats["duplicates"] += 1
+        DUPLICATES.inc(table)
+        return True
+
+    def _expire(self, now):
+        # เรียกโดยถือ lock อยู่แล้ว
+        while self.seen:
+            key, (_, seen_at) = next(iter(self.seen.items()))
+            if len(self.seen) > self.max_keys:
+                self.stats["evicted"] += 1
+            elif now - seen_at > self.ttl:
+                self.stats["expired"] += 1
+            else:
+                break
+            del self.seen[key]
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, "keys": len(self.seen), "max_keys": self.max_keys, "ttl": self.ttl,
+                    "tables": {t: list(key) for t, (key, _) in self.tables.items()}}
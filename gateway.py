@@ -0,0 +1,474 @@
+from flask import Flask, request, jsonify
+from flask_socketio import SocketIO
+import paho.mqtt.client as mqtt
+import atexit
+import json
+import os
+import sys
+from collections import deque
+from datetime import datetime
+from dotenv import load_dotenv
+from db import Database
+from pg_writer import BatchWriter
+from spool import Spool, SPOOL_ENABLED
+from rollup import RollupSet, ROLLUPS_ENABLED
+from schema import SchemaManager, SCHEMA_ENABLED, LOG_SCHEMA, DECODER_SCHEMAS
+from dedup import Deduplicator, DEDUP_ENABLED
+from compression import CompressionSet, COMPRESSION_ENABLED
+from io_mask import register_packed
+from query_cache import QueryCache, QUERY_CACHE_ENABLED
+from workers import ShardedWorkers
+from history import HistoryStore
+from latest import LatestStore, row_time
+from streaming import flask_history_response
+from http_ingest import LogIngest, BadPayload, parse_records, HTTP_MAX_BODY
+from grafana import grafana_query_map
+from topic_router import TopicRouter
+from decoders import get_decoder
+from broadcast import Broadcaster, subscription_args
+from log import setup_logging, get_logger, topic_log
+from metrics import (
+    instrument_app, stage_start, stage_done,
+    MQTT_RECEIVED, MQTT_UNROUTED, DECODE_ERRORS, SOCKETIO_CLIENTS, WRITER_QUEUE, DB_IN_USE,
+)
+
+# ---------------------------
+# Multi-device MQTT → PostgreSQL gateway
+# ---------------------------
+# process เดียว / MQTT session เดียว / pool เดียว สำหรับทุก device family
+# device map (JSON) บอกว่า topic pattern ไหน → decoder ไหน → table ไหน
+#
+#   python gateway.py devices/all.json
+#   DEVICE_MAP=devices/wise4210.json python gateway.py
+
+load_dotenv()
+postgres_password = os.getenv("PG_PASSWORD")
+postgres_host = os.getenv("PG_HOST")
+postgres_port = os.getenv("PG_PORT", 5432)  # default to 5432 if not set
+postgres_db = os.getenv("PG_DATABASE")
+postgres_user = os.getenv("PG_USER")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEVICE_MAP = os.getenv("DEVICE_MAP", "devices/all.json")
+
+log = get_logger("gateway")
+
+
+class Route:
+    __slots__ = ("pattern", "decoder", "table", "event", "device_level", "state")
+
+    def __init__(self, pattern, decoder, table, event, device_level=None):
+        self.pattern = pattern
+        self.decoder = decoder
+        self.table = table
+        self.event = event
+        self.device_level = device_level   # level ของ topic ที่เป็น device id (None = ทั้ง topic)
+        self.state = decoder.state()    # state ของ decoder ต่อ route (เช่น StreamJoin ของ I/O WISE-4210)
+
+    def device_of(self, topic):
+        if self.device_level is None:
+            return topic
+        levels = topic.split("/")
+        return levels[self.device_level] if -len(levels) <= self.device_level < len(levels) else topic
+
+
+def load_device_map(path):
+    if not os.path.exists(path):
+        path = os.path.join(BASE_DIR, path)
+    with open(path) as f:
+        return json.load(f)
+
+
+# stats ของ StreamJoin ของ route (decoder ที่ไม่มี join → None)
+def route_join(route):
+    snapshot = getattr(route.state, "snapshot", None)
+    return snapshot() if snapshot else None
+
+
+# datetime → ISO string ก่อนส่งออก Socket.IO / JSON
+def jsonable(row):
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()}
+
+
+class Gateway:
+    def __init__(self, device_map):
+        setup_logging()
+        self.device_map = device_map
+        self._init_server()
+        self._init_storage()
+        self._init_routes(device_map)
+
+        # network thread ของ paho แค่ส่ง message เข้า shard, งานจริงอยู่ใน handle()
+        self.workers = ShardedWorkers(self.handle)
+        self.client = mqtt.Client(protocol=mqtt.MQTTv311)
+        self.client.on_message = self.on_message
+
+        SOCKETIO_CLIENTS.set_function(lambda: len(self.broadcaster.subscriptions))
+        WRITER_QUEUE.set_function(self.writer.queue.qsize)
+        DB_IN_USE.set_function(lambda: self.db.stats["in_use"])
+        self._register_routes()
+
+    # Flask + Socket.IO (AsyncGateway ใน aio_gateway.py ใช้ aiohttp + AsyncServer แทน)
+    def _init_server(self):
+        self.app = Flask(__name__)
+        self.app.config["MAX_CONTENT_LENGTH"] = HTTP_MAX_BODY     # body ใหญ่กว่านี้ → 413 ก่อนอ่านเข้า memory
+        self.socketio = SocketIO(self.app, cors_allowed_origins='*')
+        self.broadcaster = Broadcaster(self.socketio)
+        instrument_app(self.app)
+
+    def _init_storage(self):
+        # pool เดียวใช้ร่วมกันทั้ง BatchWriter (MQTT) และ Flask (/query)
+        self.db = Database(
+            host=postgres_host,
+            port=postgres_port,
+            database=postgres_db,
+            user=postgres_user,
+            password=postgres_password
+        )
+        self.app.config['PG_DB'] = self.db
+        # PostgreSQL ล่ม → แถวลง disk spool แล้ว replay เมื่อกลับมา
+        self.spool = Spool() if SPOOL_ENABLED else None
+        self.writer = BatchWriter(self.db, spool=self.spool)
+
+    def _init_routes(self, device_map):
+        # compile device map → trie ของ topic pattern
+        self.router = TopicRouter()
+        self.routes = []
+        fields = []
+        # แถวซ้ำ (ส่งซ้ำหลัง reconnect / retained) ทิ้งก่อนเข้าคิว, ที่หลุดไปใช้ ON CONFLICT ของ primary key
+        self.dedup = Deduplicator() if DEDUP_ENABLED else None
+        self.writer.dedup = self.dedup
+        table_options = device_map.get("tables", {})
+        for entry in device_map["routes"]:
+            dec = get_decoder(entry["decoder"])
+            route = Route(
+                entry["topic"], dec, entry.get("table"), entry.get("event", "mqtt_data"),
+                entry.get("device_level"),
+            )
+            if route.table and route.table not in self.writer.tables:
+                schema = DECODER_SCHEMAS.get(entry["decoder"])
+                self.writer.register(
+                    route.table, dec.columns, schema.primary_key if schema else None,
+                    table_options.get(route.table, {}).get("on_conflict", "nothing"),
+                )
+                if self.dedup and dec.key:
+                    self.dedup.register(route.table, dec.key, dec.columns, dec.ignore)
+                if dec.packed:
+                    register_packed(route.table, dec.packed)    # /query อ่าน di/do จาก bit ของ io
+            self.router.add(route.pattern, route)
+            self.routes.append(route)
+            fields += [f for f in dec.fields if f not in fields]
+
+        self.history = HistoryStore(fields)
+        self.latest = LatestStore(skip=("device_id", "devaddr", "macid"))
+        self.sys_log_events = deque(maxlen=1000)
+        # /io_log, /sys_log: body แบบ array / NDJSON / gzip → memory + คิว writer ลง table log
+        self.http_ingest = LogIngest(self.writer, self.history, self.latest, self.sys_log_events)
+
+        # Grafana: ชื่อ target → (table, column, time column)
+        self.grafana_targets = {}
+        for source in device_map.get("grafana", []):
+            prefix = source.get("prefix", "")
+            for column in source["targets"]:
+                self.grafana_targets[prefix + column] = (
+                    source["table"], column, source.get("time_column", "timestamp")
+                )
+
+        # table ของ route: สร้างเป็น partition ตามเวลา + index, retention (schema.py)
+        self.schema = SchemaManager.from_device_map(
+            device_map, extra=[(t, LOG_SCHEMA) for t in self.http_ingest.tables()]
+        ) if SCHEMA_ENABLED else None
+
+        # rollup 1m / 1h ของ table ใน "grafana" → อัปเดตทุก batch (writer + spool replay), /query อ่านแทนแถวดิบ
+        self.rollups = RollupSet.from_device_map(device_map) if ROLLUPS_ENABLED else None
+        self.writer.rollups = self.rollups
+        if self.spool:
+            self.spool.rollups = self.rollups
+
+        # "compression" ใน device map: เก็บเฉพาะแถวที่มีนัย (change / deadband / swinging door + heartbeat)
+        self.compression = CompressionSet.from_device_map(device_map) if COMPRESSION_ENABLED else None
+        self.grafana_fills = self.compression.fills(self.grafana_targets) if self.compression else {}
+
+        # /query cache: refresh ซ้ำตอบจาก memory, writer บวกแถวใหม่เข้า entry ที่เปิดอยู่
+        self.query_cache = QueryCache() if QUERY_CACHE_ENABLED else None
+        self.writer.cache = self.query_cache
+        if self.spool:
+            self.spool.cache = self.query_cache
+
+    # ---------------------------
+    # MQTT Message Handling
+    # ---------------------------
+    def on_message(self, client, userdata, msg):
+        topic = msg.topic
+        MQTT_RECEIVED.inc(topic)
+        self.workers.submit(topic, msg.payload)
+
+    def handle(self, topic, payload):
+        started = stage_start()
+        try:
+            raw_data = json.loads(payload)   # bytes ตรงๆ ไม่ต้อง decode() ก่อน
+        except Exception as e:
+            DECODE_ERRORS.inc(topic)
+            log.error("❌ Error in on_message (%s): %s", topic, e)
+            return
+        stage_done("parse", started)
+
+        # payload เต็มเฉพาะ topic ที่เปิด trace, ที่เหลือ log สรุปแบบ sample
+        if topic_log.tracing(topic):
+            log.info("✅ Received MQTT from %s: %s", topic, raw_data)
+        else:
+            n = topic_log.sample(topic)
+            if n:
+                log.info("📬 %s: %d messages received", topic, n)
+
+        t = stage_start()
+        routes = self.router.match(topic)
+        stage_done("route", t)
+        if not routes:
+            MQTT_UNROUTED.inc(topic)
+            log.warning("⚠️ Unknown topic: %s, ignoring...", topic)
+            return
+        for route in routes:
+            try:
+                self.dispatch(route, topic, raw_data)
+            except Exception as e:
+                DECODE_ERRORS.inc(topic)
+                log.error("❌ Error in decoder %s (%s): %s", route.decoder.decoder_name, topic, e)
+        stage_done("message", started)
+
+    def dispatch(self, route, topic, data):
+        t = stage_start()
+        rows = route.decoder(topic, data, route.state)
+        stage_done("decode", t)
+        for row in rows:
+            device = row.get("device_id") or row.get("macid") or route.device_of(topic)
+            if route.table:
+                stored = self.compression.filter(route.table, device, row, topic) if self.compression else [row]
+                for r in stored:
+                    self.writer.put(route.table, r, topic)
+            ts_ms = row_time(row)
+            self.history.append(device, row, ts_ms)
+            self.latest.update(device, row, ts_ms)
+            t = stage_start()
+            self.broadcaster.publish(route.event, device, jsonable(row))
+            stage_done("publish", t)
+
+    # ---------------------------
+    # Flask Routes
+    # ---------------------------
+    def _register_routes(self):
+        app = self.app
+        socketio = self.socketio
+
+        @app.route('/')
+        def index():
+            return "✅ MQTT + PostgreSQL Gateway Running"
+
+        # ?since=<seq>&limit=<n> → NDJSON แบบ chunked, ไม่มี → JSON array เดิม (ดู streaming.py)
+        @app.route('/api/data', methods=['GET'])
+        @app.route('/api/tpm', methods=['GET'])
+        def get_data():
+            return flask_history_response(self.history, request)
+
+        # ค่าล่าสุดต่อ device / tag (value, ts, quality) จาก memory
+        @app.route('/api/latest', methods=['GET'])
+        def get_latest():
+            return jsonify(self.latest.snapshot())
+
+        @app.route('/api/latest/<path:device>', methods=['GET'])
+        def get_latest_device(device):
+            tags = self.latest.device(device)
+            if tags is None:
+                return jsonify({"status": "error", "message": f"unknown device {device}"}), 404
+            return jsonify(tags)
+
+        @app.route('/api/history', methods=['GET'])
+        def get_history_info():
+            return jsonify(self.history.info())
+
+        @app.route('/api/writer', methods=['GET'])
+        def get_writer_stats():
+            return jsonify(self.writer.snapshot())
+
+        @app.route('/api/db', methods=['GET'])
+        def get_db_stats():
+            return jsonify(self.db.snapshot())
+
+        @app.route('/api/workers', methods=['GET'])
+        def get_worker_stats():
+            return jsonify(self.workers.snapshot())
+
+        @app.route('/api/spool', methods=['GET'])
+        def get_spool_stats():
+            return jsonify(self.spool.snapshot() if self.spool else {"enabled": False})
+
+        @app.route('/api/schema', methods=['GET'])
+        def get_schema_stats():
+            return jsonify(self.schema.snapshot() if self.schema else {"enabled": False})
+
+        @app.route('/api/query_cache', methods=['GET'])
+        def get_query_cache_stats():
+            return jsonify(self.query_cache.snapshot() if self.query_cache else {"enabled": False})
+
+        @app.route('/api/rollups', methods=['GET'])
+        def get_rollup_stats():
+            return jsonify(self.rollups.snapshot() if self.rollups else {"enabled": False})
+
+        @app.route('/api/compression', methods=['GET'])
+        def get_compression_stats():
+            return jsonify(self.compression.snapshot() if self.compression else {"enabled": False})
+
+        @app.route('/api/dedup', methods=['GET'])
+        def get_dedup_stats():
+            return jsonify(self.dedup.snapshot() if self.dedup else {"enabled": False})
+
+        @app.route('/api/broadcast', methods=['GET'])
+        def get_broadcast_stats():
+            return jsonify(self.broadcaster.snapshot())
+
+        # GET = ดู config, POST {"topic": "...", "enabled": true} = เปิด/ปิด log payload เต็มของ topic/device
+        # (หรือ {"trace": [...]}, {"level": "DEBUG"}, {"sample_every": 100}, {"rate": 1})
+        @app.route('/api/log', methods=['GET', 'POST'])
+        def log_config():
+            if request.method == 'POST':
+                topic_log.configure(request.get_json() or {})
+            return jsonify(topic_log.snapshot())
+
+        @app.route('/api/routes', methods=['GET'])
+        def get_routes():
+            return jsonify([
+                {"topic": r.pattern, "decoder": r.decoder.decoder_name, "table": r.table, "event": r.event,
+                 "device_level": r.device_level, "join": route_join(r)}
+                for r in self.routes
+            ])
+
+        # Grafana SimpleJSON
+        @app.route('/search', methods=['POST'])
+        def search():
+            return jsonify(list(self.grafana_targets))
+
+        @app.route('/query', methods=['POST'])
+        def query():
+            req = request.get_json()
+            try:
+                if self.query_cache:
+                    return jsonify(self.query_cache.query(self.db, req, self.grafana_targets, self.rollups,
+                                                          self.grafana_fills))
+                with self.db.connection() as conn:
+                    results = grafana_query_map(conn, req, self.grafana_targets, self.rollups, self.grafana_fills)
+                return jsonify(results)
+            except Exception as e:
+                log.error("❌ Error in /query: %s", e)
+                return jsonify([])
+
+        # WISE-4012 HTTP push endpoint (object เดียว / array / NDJSON, gzip ได้) → ตอบทันที แล้วค่อยลง database
+        def receive_log(name, ingest):
+            try:
+                records = parse_records(request.get_data(), request.content_type,
+                                        request.headers.get("Content-Encoding"))
+            except BadPayload as e:
+                self.http_ingest.reject()
+                log.warning("⚠️ Bad /%s body from %s: %s", name, request.remote_addr, e)
+                return jsonify({"status": "error", "message": str(e)}), 400
+            try:
+                count = ingest(records, request.remote_addr)
+                log.debug("📥 Received /%s POST: %d record(s)", name, count)
+                return jsonify({"status": "ok", "accepted": count}), 200
+            except Exception as e:
+                log.error("❌ Error in /%s: %s", name, e)
+                return jsonify({"status": "error", "message": str(e)}), 500
+
+        @app.route('/io_log', methods=['POST'])
+        def receive_io_log():
+            return receive_log("io_log", self.http_ingest.io_log)
+
+        # Optional WISE-4012 System Event logging
+        @app.route('/sys_log', methods=['POST'])
+        def receive_sys_log():
+            return receive_log("sys_log", self.http_ingest.sys_log)
+
+        @app.route('/api/http_ingest')
+        def get_http_ingest():
+            return jsonify(self.http_ingest.snapshot())
+
+        @app.route('/sys_log', methods=['GET'])
+        def get_sys_log():
+            return jsonify(list(self.sys_log_events))
+
+        # Socket.IO Events
+        @socketio.on('connect')
+        def handle_connect():
+            log.info("🌐 Client connected (%s)", request.sid)
+            self.broadcaster.connect(request.sid)
+            self.broadcaster.emit_to(request.sid, "latest", self.latest.snapshot())
+
+        @socketio.on('disconnect')
+        def handle_disconnect():
+            log.info("🔌 Client disconnected (%s)", request.sid)
+            self.broadcaster.forget(request.sid)
+
+        # {"event": "mqtt_data", "device": "<device id / MAC / topic>" หรือ "*"}
+        @socketio.on('subscribe')
+        def handle_subscribe(data):
+            event, device = subscription_args(data)
+            self.broadcaster.subscribe(request.sid, event, device)
+            return {"status": "ok", "event": event, "device": device}
+
+        @socketio.on('unsubscribe')
+        def handle_unsubscribe(data):
+            event, device = subscription_args(data)
+            self.broadcaster.unsubscribe(request.sid, event, device)
+            return {"status": "ok", "event": event, "device": device}
+
+    # ---------------------------
+    # Start
+    # ---------------------------
+    def start(self):
+        if self.schema:
+            self.schema.start(self.db)          # table / partition ต้องมีก่อน insert แรก
+            atexit.register(self.schema.stop)
+        if self.rollups:
+            self.rollups.load(self.db)          # rollup ที่สร้างแล้ว + ช่วงที่ครอบคลุม (/query เลือก rollup / แถวดิบ)
+        if self.spool:
+            self.spool.start(self.db)
+            atexit.register(self.spool.stop)    # หลัง writer.stop (atexit เรียกกลับลำดับ)
+        self.writer.start()
+        if self.compression:
+            self.compression.start(self.writer)     # แถวที่ถือไว้ลง writer ตาม heartbeat
+            atexit.register(self.compression.stop)  # หลัง workers.stop ก่อน writer.stop
+        self.workers.start()                    # stop ก่อน writer → แถวที่ค้างใน shard ลง writer ทัน
+        self.broadcaster.start()
+
+        cfg = self.device_map.get("mqtt", {})
+        if cfg.get("username"):
+            self.client.username_pw_set(cfg["username"], cfg.get("password"))
+        self.client.connect(cfg.get("host", "127.0.0.1"), cfg.get("port", 1883), cfg.get("keepalive", 60))
+        topics = self.topic_patterns()
+        self.client.subscribe([(t, 0) for t in topics])
+        self.client.loop_start()
+        log.info("✅ Subscribed to %d topic patterns (%d routes).", len(topics), len(self.routes))
+
+    def topic_patterns(self):
+        topics = []
+        for route in self.routes:
+            if route.pattern not in topics:
+                topics.append(route.pattern)
+        if "#" in topics:
+            topics = ["#"]   # กัน broker ส่งข้อความซ้ำจาก subscription ที่ซ้อนกัน
+        return topics
+
+    def run(self):
+        self.start()
+        self.socketio.run(self.app, host='0.0.0.0', port=self.device_map.get("port", 4000))
+
+
+def main(path=None):
+    path = path or (sys.argv[1] if len(sys.argv) > 1 else DEVICE_MAP)
+    Gateway(load_device_map(path)).run()
+
+
+# ---------------------------
+# Main Entry Point
+# ---------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import math
+from datetime import datetime, timedelta, timezone
+from io_mask import column_sql
+from log import get_logger
+
+# ---------------------------
+# Grafana SimpleJSON /query helper
+# ---------------------------
+# - ใช้ range.from / range.to ที่ Grafana ส่งมา (ไม่ใช่ LIMIT 100 ล่าสุดอีกต่อไป)
+# - รวมเป็น bucket ขนาด max(intervalMs, ช่วงเวลา / maxDataPoints)
+#   → แต่ละ series ได้ไม่เกิน maxDataPoints จุด
+# - ทุก target อยู่ใน SELECT เดียวกัน → 1 round trip ต่อ /query
+# - target ต้องอยู่ในรายการของ /search เท่านั้น (ไม่เอาชื่อ target ไปต่อ SQL ตรงๆ)
+# - ถ้ามี rollups (rollup.py) และ bucket >= 1 นาที → อ่านจาก <table>_1m / <table>_1h แทนแถวดิบ
+#   (resolution ที่หยาบที่สุดที่ <= bucket, แล้วปัด bucket ขึ้นเป็นทวีคูณของ resolution)
+# - table แบบ packed (io_mask.py): ช่อง di/do อ่านจาก bit ของ io
+# - fills = {ชื่อ target: "step" / "linear"} (compression.py) → เติม bucket ว่างของ table ที่เก็บเฉพาะค่าที่เปลี่ยน
+#   เริ่มจากค่าล่าสุดก่อน window (seed_sql) → DI/DO ที่ไม่เปลี่ยนตั้งแต่ก่อน range.from ก็ได้เส้นเต็ม
+
+AGGREGATES = {"avg": "avg", "min": "min", "max": "max", "count": "count", "sum": "sum"}
+DEFAULT_RANGE = timedelta(hours=1)
+DEFAULT_MAX_POINTS = 1000
+EPOCH = datetime(1970, 1, 1)
+
+log = get_logger("grafana")
+
+
+def parse_grafana_time(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def query_window(req):
+    rng = req.get("range") or {}
+    end = parse_grafana_time(rng.get("to")) or datetime.now(timezone.utc)
+    start = parse_grafana_time(rng.get("from")) or end - DEFAULT_RANGE
+    max_points = int(req.get("maxDataPoints") or DEFAULT_MAX_POINTS)
+    interval_s = float(req.get("intervalMs") or 0) / 1000
+    span_s = max((end - start).total_seconds(), 1)
+    bucket_s = max(interval_s, span_s / max(max_points, 1), 1)
+    return start, end, bucket_s
+
+
+def target_aggregate(target):
+    # รองรับ {"target": "temp", "data": {"agg": "max"}} ; ค่า default = avg
+    data = target.get("data") or {}
+    agg = str(data.get("agg", "avg")).lower() if isinstance(data, dict) else "avg"
+    return AGGREGATES.get(agg, "avg")
+
+
+def grafana_query(conn, table, req, allowed, time_col="timestamp"):
+    return grafana_query_map(conn, req, {name: (table, name, time_col) for name in allowed})
+
+
+def grafana_query_map(conn, req, targets, rollups=None, fills=None):
+    # targets = {ชื่อ target ใน /search: (table, column, time column)}
+    # target หลาย table → 1 query ต่อ table (ทุก column ของ table เดียวกันอยู่ใน SELECT เดียว)
+    order, queries = grafana_plan(req, targets, rollups, fills)
+    results = {}
+    for series, sql, params, seed in queries:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            seeds = {}
+            if seed:
+                cursor.execute(seed, params)
+                seeds = seed_points(cursor.fetchall())
+        results.update(fill_results(series, bucketed_results(series, rows), params, fills, seeds))
+    return grafana_response(order, results)
+
+
+# แยกสร้าง SQL / แปลงผลออกจากการ execute → ใช้ร่วมกับ connection แบบ async (aio_gateway.py)
+def grafana_plan(req, targets, rollups=None, fills=None):
+    # → (ลำดับ target, [(series, sql, params, seed sql หรือ None)])
+    start, end, bucket_s = query_window(req)
+    order, by_table = group_targets(req, targets)
+
+    queries = []
+    for (table, time_col), series in by_table.items():
+        rollup_table, bucket, first = query_source(table, series, start, bucket_s, rollups)
+        params = {"bucket": bucket, "start": first, "end": end}
+        filled = [col for name, col, _ in series if fills and name in fills]
+        seed = seed_sql(table, filled, time_col) if filled else None
+        if rollup_table is None:
+            queries.append((series, bucketed_sql(table, series, time_col), params, seed))
+        else:
+            queries.append((series, rollup_sql(rollup_table, series), params, seed))
+    return order, queries
+
+
+def group_targets(req, targets):
+    # → (ลำดับ target, {(table, time column): [(ชื่อ target, column, aggregate)]})
+    by_table = {}
+    order = []
+    for target in req.get("targets", []):
+        name = target.get("target")
+        if name not in targets:
+            log.warning("⚠️ Unknown Grafana target: %s, ignoring...", name)
+            continue
+        table, column, time_col = targets[name]
+        by_table.setdefault((table, time_col), []).append((name, column, target_aggregate(target)))
+        order.append(name)
+    return order, by_table
+
+
+def query_source(table, series, start, bucket_s, rollups=None):
+    # → (rollup table หรือ None = แถวดิบ, bucket ที่ใช้จริง, start ที่ใช้จริง)
+    # rollup ที่ยังไม่ครอบคลุม start (ยังไม่ backfill) → None = แถวดิบ
+    resolution = rollups.resolution_for(table, [col for _, col, _ in series], bucket_s, start) if rollups else None
+    if resolution is None:
+        return None, bucket_s, start
+    rollup_table, res_s = resolution
+    return rollup_table, math.ceil(bucket_s / res_s) * res_s, floor_time(start, res_s)
+
+
+def floor_time(ts, seconds):
+    return datetime.fromtimestamp(math.floor(ts.timestamp() / seconds) * seconds, ts.tzinfo or timezone.utc)
+
+
+def grafana_response(order, results):
+    return [{"target": name, "datapoints": results[name]} for name in order]
+
+
+def bucketed_query(conn, table, series, start, end, bucket_s, time_col="timestamp"):
+    with conn.cursor() as cursor:
+        cursor.execute(bucketed_sql(table, series, time_col), {"bucket": bucket_s, "start": start, "end": end})
+        rows = cursor.fetchall()
+    return bucketed_results(series, rows)
+
+
+def bucketed_sql(table, series, time_col="timestamp"):
+    select = ", ".join(f"{agg}({column_sql(table, col)})" for _, col, agg in series)
+    return f"""
+        SELECT
+            timestamp 'epoch' + floor(extract(epoch FROM {time_col}) / %(bucket)s) * %(bucket)s * interval '1 second' AS bucket,
+            {select}
+        FROM {table}
+        WHERE {time_col} >= %(start)s AND {time_col} < %(end)s
+        GROUP BY 1
+        ORDER BY 1
+    """
+
+
+# rollup (long format): 1 แถวต่อ (bucket, device, field) → aggregate ซ้ำด้วย FILTER ต่อ field
+ROLLUP_AGGREGATES = {
+    "avg": "sum(sum) FILTER (WHERE field = '{0}') / nullif(sum(count) FILTER (WHERE field = '{0}'), 0)",
+    "min": "min(min) FILTER (WHERE field = '{0}')",
+    "max": "max(max) FILTER (WHERE field = '{0}')",
+    "count": "sum(count) FILTER (WHERE field = '{0}')",
+    "sum": "sum(sum) FILTER (WHERE field = '{0}')",
+}
+
+
+def rollup_sql(rollup_table, series):
+    select = ", ".join(ROLLUP_AGGREGATES[agg].format(col) for _, col, agg in series)
+    fields = ", ".join(f"'{col}'" for col in dict.fromkeys(col for _, col, _ in series))
+    return f"""
+        SELECT
+            timestamp 'epoch' + floor(extract(epoch FROM bucket) / %(bucket)s) * %(bucket)s * interval '1 second' AS bucket,
+            {select}
+        FROM {rollup_table}
+        WHERE bucket >= %(start)s AND bucket < %(end)s AND field IN ({fields})
+        GROUP BY 1
+        ORDER BY 1
+    """
+
+
+# ---------------------------
+# เติม bucket ว่าง (table ที่บีบอัดด้วย compression.py)
+# ---------------------------
+# เวลาของ bucket แปลงแบบเดียวกับ bucketed_results (timestamp 'epoch' + ... → datetime ไม่มี timezone)
+def bucket_ms(idx, bucket):
+    return int((EPOCH + timedelta(seconds=idx * bucket)).timestamp() * 1000)
+
+
+def utc_seconds(ts):
+    return (ts - EPOCH).total_seconds() if ts.tzinfo is None else ts.timestamp()
+
+
+def seed_sql(table, columns, time_col="timestamp"):
+    # ค่าล่าสุดก่อน window ของแต่ละ column → แถว (column, ค่า, เวลา) ; LIMIT 1 ตาม index ของ time column
+    return " UNION ALL ".join(
+        f"(SELECT '{col}', {column_sql(table, col)}, {time_col} FROM {table}"
+        f" WHERE {time_col} < %(start)s AND {column_sql(table, col)} IS NOT NULL"
+        f" ORDER BY {time_col} DESC LIMIT 1)"
+        for col in dict.fromkeys(columns)
+    )
+
+
+def seed_points(rows):
+    # → {column: [ค่า, ms]} (ms แปลงแบบเดียวกับ bucketed_results)
+    return {col: [float(value), int(ts.timestamp() * 1000)] for col, value, ts in rows}
+
+
+def fill_datapoints(points, mode, first, last, bucket, seed=None):
+    # points = [[value, ms]] เรียงเวลา ของ bucket index first..last-1 ; seed = [value, ms] ก่อน window หรือ None
+    # step   → bucket ว่างหลังจุดแรก (หรือหลัง seed) ใช้ค่าก่อนหน้า
+    # linear → bucket ว่างระหว่างสองจุดใช้ค่าบนเส้นตรง, หลังจุดสุดท้ายใช้ค่าสุดท้าย
+    # ไม่มี seed → ไม่เติมก่อนจุดแรก ; ไม่เกินเวลาปัจจุบัน
+    if not points and seed is None:
+        return points
+    last = min(last, math.ceil(datetime.now().timestamp() / bucket))
+    known = {ms: value for value, ms in points}
+    grid = [bucket_ms(i, bucket) for i in range(first, last)]
+    filled, prev, nxt = [], tuple(seed) if seed else None, 0
+    for ms in grid:
+        if ms in known:
+            prev = (known[ms], ms)
+            filled.append([known[ms], ms])
+            continue
+        if prev is None:
+            continue
+        value = prev[0]
+        if mode == "linear":
+            while nxt < len(points) and points[nxt][1] <= ms:
+                nxt += 1
+            if nxt < len(points):
+                v1, ms1 = points[nxt]
+                value = prev[0] + (v1 - prev[0]) * (ms - prev[1]) / (ms1 - prev[1])
+        filled.append([value, ms])
+    return filled
+
+
+def fill_results(series, results, params, fills, seeds=None):
+    # seeds = {column: [ค่า, ms]} จาก seed_sql
+    if not fills:
+        return results
+    bucket = params["bucket"]
+    first = math.floor(utc_seconds(params["start"]) / bucket)
+    last = math.ceil(utc_seconds(params["end"]) / bucket)
+    for name, column, _ in series:
+        mode = fills.get(name)
+        if mode:
+            results[name] = fill_datapoints(results[name], mode, first, last, bucket, (seeds or {}).get(column))
+    return results
+
+
+def bucketed_results(series, rows):
+    results = {name: [] for name, _, _ in series}
+    names = [name for name, _, _ in series]
+    for row in rows:
+        ts = int(row[0].timestamp() * 1000)  # แปลงเป็น epoch ms
+        for name, value in zip(names, row[1:]):
+            if value is not None:
+                results[name].append([float(value), ts])
+    return results
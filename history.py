@@ -0,0 +1,363 @@
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+import numpy as np
+
+# ---------------------------
+# Bounded in-memory history
+# ---------------------------
+# แทน data_storage = [] ที่โตไปเรื่อยๆ
+# เก็บเป็น ring buffer ต่อ device, แต่ละ field เป็น column float64 ที่จองไว้ล่วงหน้า
+# (timestamp เป็น int64 epoch ms, seq int64) → ใช้ 16 + 8 * len(fields) bytes ต่อ sample
+#   float64 = ค่าเดิมทุกตัว (24.9 ยังเป็น 24.9, counter integer ถึง 2^53 ไม่เพี้ยน)
+# HISTORY_RAW=1: เก็บ payload เดิมเป็น JSON bytes ด้วย → GET /api/data แบบไม่มี since / limit
+#   ได้ array ของ payload เดิมเรียงตามลำดับที่รับ เหมือน data_storage (client เดิมไม่ต้องแก้)
+#   bytes ต่อ payload เล็กกว่า dict หลายเท่า และส่งออกได้เลยไม่ต้อง json.dumps ซ้ำ
+#
+# eviction:
+#   - capacity: เต็มแล้วเขียนทับตัวเก่าสุด
+#   - max_age:  ตัดของที่เก่ากว่า max_age วินาทีทิ้ง (ถ้าตั้งไว้)
+#   - max_devices: device ใหม่เกินจำนวนนี้จะไม่ถูกเก็บ (กัน subscribe "#")
+#
+# ทุก sample มี seq (เพิ่มขึ้นเรื่อยๆ ทั้ง store) → page(since=seq, limit) ดึงเฉพาะของใหม่ด้วย binary search
+
+HISTORY_CAPACITY = int(os.getenv("HISTORY_CAPACITY", 10000))
+HISTORY_MAX_AGE = float(os.getenv("HISTORY_MAX_AGE", 0)) or None   # วินาที, 0 = ไม่จำกัด
+HISTORY_MAX_DEVICES = int(os.getenv("HISTORY_MAX_DEVICES", 256))
+HISTORY_RAW = os.getenv("HISTORY_RAW", "1") == "1"
+HISTORY_LATE_BATCH = int(os.getenv("HISTORY_LATE_BATCH", 256))
+
+
+def raw_json(data):
+    # payload → JSON bytes (datetime ของ row ที่ decode แล้ว → isoformat เหมือน gateway.jsonable)
+    return json.dumps(data, default=lambda v: v.isoformat() if hasattr(v, "isoformat") else str(v)).encode()
+
+
+def to_number(value):
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+class RingBuffer:
+    def __init__(self, fields, capacity, max_age=None, keep_raw=False):
+        self.fields = list(fields)
+        self.index = {f: i for i, f in enumerate(self.fields)}
+        self.capacity = capacity
+        self.max_age = max_age
+        self.ts = np.zeros(capacity, dtype=np.int64)
+        self.seq = np.zeros(capacity, dtype=np.int64)
+        self.cols = np.full((len(self.fields), capacity), np.nan, dtype=np.float64)
+        self.raw = [None] * capacity if keep_raw else None     # JSON bytes ของ payload เดิม
+        self.raw_bytes = 0
+        self.head = 0      # ตำแหน่งที่จะเขียนถัดไป
+        self.size = 0
+        self.evicted = 0
+
+    def append(self, ts_ms, values, seq=0, raw=None):
+        i = self.head
+        self.ts[i] = ts_ms
+        self.seq[i] = seq
+        if self.raw is not None:
+            old = self.raw[i]
+            self.raw_bytes += len(raw or b"") - len(old or b"")
+            self.raw[i] = raw
+        col = self.cols[:, i]
+        col.fill(np.nan)
+        for name, value in values.items():
+            j = self.index.get(name)
+            if j is not None:
+                col[j] = value
+        self.head = (i + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.evicted += 1
+        if self.max_age:
+            self.expire(ts_ms - int(self.max_age * 1000))
+
+    def expire(self, cutoff_ms):
+        while self.size:
+            tail = (self.head - self.size) % self.capacity
+            if self.ts[tail] >= cutoff_ms:
+                break
+            self.size -= 1
+            self.evicted += 1
+
+    def order(self):
+        # index เรียงจากเก่าสุด → ใหม่สุด
+        start = (self.head - self.size) % self.capacity
+        return (start + np.arange(self.size)) % self.capacity
+
+    def rows(self, idx=None):
+        if idx is None:
+            idx = self.order()
+        ts = self.ts[idx].tolist()
+        seqs = self.seq[idx].tolist()
+        cols = self.cols[:, idx].tolist()
+        out = []
+        for k, t in enumerate(ts):
+            row = {"seq": seqs[k], "timestamp": t}
+            for j, name in enumerate(self.fields):
+                v = cols[j][k]
+                if v == v:  # ข้าม NaN (field ที่ไม่มีใน sample นี้)
+                    row[name] = v
+            out.append(row)
+        return out
+
+    def raw_rows(self):
+        # [(seq, JSON bytes)] เรียงจากเก่าสุด
+        idx = self.order()
+        return [(s, self.raw[i]) for s, i in zip(self.seq[idx].tolist(), idx.tolist()) if self.raw[i] is not None]
+
+    def since(self, seq, limit=None):
+        # sample ที่ seq > seq (ring เรียงตาม seq อยู่แล้ว → searchsorted)
+        idx = self.order()
+        start = int(np.searchsorted(self.seq[idx], seq, side="right"))
+        end = len(idx) if limit is None else start + limit
+        return self.rows(idx[start:end])
+
+    def nbytes(self):
+        return self.ts.nbytes + self.seq.nbytes + self.cols.nbytes + self.raw_bytes
+
+
+class HistoryStore:
+    def __init__(self, fields, capacity=HISTORY_CAPACITY, max_age=HISTORY_MAX_AGE,
+                 max_devices=HISTORY_MAX_DEVICES, keep_raw=HISTORY_RAW):
+        self.fields = list(fields)
+        self.keep_raw = keep_raw
+        self.capacity = capacity
+        self.max_age = max_age
+        self.max_devices = max_devices
+        self.buffers = {}
+        self.rejected_devices = 0
+        self.seq = 0                  # seq ของ sample ล่าสุด
+        self.lock = threading.Lock()
+
+    def append(self, device, data, ts_ms=None):
+        values = {}
+        for name in self.fields:
+            if name in data:
+                v = to_number(data[name])
+                if v is not None:
+                    values[name] = v
+        if not values and not self.keep_raw:
+            return False
+        if ts_ms is None:
+            ts_ms = int(time.time() * 1000)
+        raw = raw_json(data) if self.keep_raw else None
+
+        with self.lock:
+            buf = self.buffers.get(device)
+            if buf is None:
+                if len(self.buffers) >= self.max_devices:
+                    self.rejected_devices += 1
+                    return False
+                buf = self.buffers[device] = RingBuffer(self.fields, self.capacity, self.max_age, self.keep_raw)
+            self.seq += 1
+            buf.append(ts_ms, values, self.seq, raw)
+        return True
+
+    def _expire(self):
+        if self.max_age:
+            cutoff = int(time.time() * 1000) - int(self.max_age * 1000)
+            for buf in self.buffers.values():
+                buf.expire(cutoff)
+
+    def records(self, device=None):
+        with self.lock:
+            self._expire()
+            devices = [device] if device is not None else list(self.buffers)
+            out = []
+            for name in devices:
+                buf = self.buffers.get(name)
+                if buf is None:
+                    continue
+                for row in buf.rows():
+                    row["device"] = name
+                    out.append(row)
+        out.sort(key=lambda r: r["timestamp"])
+        return out
+
+    def raw_records(self, device=None):
+        # payload เดิม (JSON bytes) เรียงตามลำดับที่รับ → /api/data แบบเดิม
+        with self.lock:
+            self._expire()
+            devices = [device] if device is not None else list(self.buffers)
+            parts = [self.buffers[name].raw_rows() for name in devices if name in self.buffers]
+        return [raw for _, raw in heapq.merge(*parts)]
+
+    def page(self, since=0, limit=None, device=None):
+        # sample ที่ seq > since เรียงตาม seq ไม่เกิน limit แถว → (rows, seq ของแถวสุดท้าย ใช้เป็น since ครั้งถัดไป)
+        with self.lock:
+            self._expire()
+            devices = [device] if device is not None else list(self.buffers)
+            parts = []
+            for name in devices:
+                buf = self.buffers.get(name)
+                if buf is None:
+                    continue
+                rows = buf.since(since, limit)
+                for row in rows:
+                    row["device"] = name
+                parts.append(rows)
+        rows = list(islice(heapq.merge(*parts, key=lambda r: r["seq"]), limit))
+        return rows, rows[-1]["seq"] if rows else since
+
+    def version(self):
+        # เปลี่ยนเมื่อมี sample ใหม่หรือมีของถูกตัดทิ้ง → ใช้ทำ ETag
+        with self.lock:
+            self._expire()
+            return self.seq, sum(buf.evicted for buf in self.buffers.values())
+
+    def info(self):
+        with self.lock:
+            devices = {
+                name: {"samples": buf.size, "evicted": buf.evicted, "bytes": buf.nbytes()}
+                for name, buf in self.buffers.items()
+            }
+        return {
+            "policy": {
+                "capacity": self.capacity,
+                "max_age_seconds": self.max_age,
+                "max_devices": self.max_devices,
+            },
+            "fields": self.fields,
+            "raw_payloads": self.keep_raw,
+            "bytes_per_sample": 16 + 8 * len(self.fields),
+            "bytes_total": sum(d["bytes"] for d in devices.values()),
+            "rejected_devices": self.rejected_devices,
+            "devices": devices,
+        }
+
+
+# ---------------------------
+# Per-channel time index (aiN)
+# ---------------------------
+# append-only array ของ timestamp (epoch ms) / value / status ต่อ (device, channel)
+# เรียงตามเวลาเสมอ → query ช่วงเวลาใช้ binary search แทนการวนทั้ง history
+# ถ้าเกิน max_points จะตัดส่วนที่เก่าสุดทิ้งเป็นก้อน (amortized)
+# จุดที่มาช้า (เช่น io_log ย้อนหลัง) พักไว้ใน late แล้ว merge ทีเดียว (sort + merge เฉพาะส่วนท้าย)
+#   ตอน query / trim หรือเมื่อค้างถึง HISTORY_LATE_BATCH จุด → ไม่ต้อง array.insert O(n) ทีละจุด
+
+AI_KEY = re.compile(r"ai(\d+)$")
+
+
+class ChannelSeries:
+    def __init__(self, late_batch=HISTORY_LATE_BATCH):
+        self.ts = array("q")
+        self.values = array("d")
+        self.status = array("d")
+        self.late = []          # [(ts, value, status)] ที่ยังไม่ได้ merge
+        self.late_batch = late_batch
+
+    def __len__(self):
+        return len(self.ts) + len(self.late)
+
+    def add(self, ts_ms, value, status):
+        if not self.ts or ts_ms >= self.ts[-1]:
+            self.ts.append(ts_ms)
+            self.values.append(value)
+            self.status.append(status)
+        else:
+            self.late.append((ts_ms, value, status))
+            if len(self.late) >= self.late_batch:
+                self.merge()
+
+    def merge(self):
+        if not self.late:
+            return
+        late = sorted(self.late, key=lambda p: p[0])
+        self.late = []
+        # เขียนใหม่เฉพาะส่วนท้ายตั้งแต่จุดที่มาช้าที่เก่าสุด (เวลาเท่ากัน: จุดเดิมมาก่อน)
+        i = bisect_right(self.ts, late[0][0])
+        tail = list(zip(self.ts[i:], self.values[i:], self.status[i:]))
+        merged = list(heapq.merge(tail, late, key=lambda p: p[0]))
+        del self.ts[i:]
+        del self.values[i:]
+        del self.status[i:]
+        self.ts.extend(p[0] for p in merged)
+        self.values.extend(p[1] for p in merged)
+        self.status.extend(p[2] for p in merged)
+
+    def trim(self, keep):
+        self.merge()
+        drop = len(self.ts) - keep
+        if drop > 0:
+            del self.ts[:drop]
+            del self.values[:drop]
+            del self.status[:drop]
+
+    def window(self, start=None, end=None, limit=None):
+        self.merge()
+        lo = 0 if start is None else bisect_left(self.ts, start)
+        hi = len(self.ts) if end is None else bisect_right(self.ts, end)
+        if limit and hi - lo > limit:
+            lo = hi - limit   # เอาล่าสุด limit จุด
+        return lo, hi
+
+
+class ChannelIndex:
+    def __init__(self, max_points=HISTORY_CAPACITY):
+        self.max_points = max_points
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def add(self, device, data, ts_ms=None):
+        if ts_ms is None:
+            ts_ms = int(time.time() * 1000)
+        added = 0
+        with self.lock:
+            for key, value in data.items():
+                m = AI_KEY.match(key)
+                if m is None:
+                    continue
+                v = to_number(value)
+                if v is None:
+                    continue
+                status = to_number(data.get(f"ai_st{m.group(1)}"))
+                series = self.series.get((device, int(m.group(1))))
+                if series is None:
+                    series = self.series[(device, int(m.group(1)))] = ChannelSeries()
+                series.add(ts_ms, v, float("nan") if status is None else status)
+                if len(series) > self.max_points + self.max_points // 4:
+                    series.trim(self.max_points)
+                added += 1
+        return added
+
+    def query(self, device, channel, start=None, end=None, limit=None):
+        with self.lock:
+            series = self.series.get((device, channel))
+            if series is None:
+                return []
+            lo, hi = series.window(start, end, limit)
+            ts = series.ts[lo:hi]
+            values = series.values[lo:hi]
+            status = series.status[lo:hi]
+        out = []
+        for t, v, st in zip(ts, values, status):
+            row = {"timestamp": t, "value": v}
+            if st == st:
+                row["status"] = st
+            out.append(row)
+        return out
+
+    def channels(self):
+        with self.lock:
+            return [
+                {"device": device, "channel": channel, "points": len(series)}
+                for (device, channel), series in self.series.items()
+            ]
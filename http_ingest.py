@@ -0,0 +1,165 @@
+import json
+import os
+import zlib
+from datetime import datetime, timezone
+from latest import epoch_ms, row_time
+
+# ---------------------------
+# Bulk HTTP ingest: WISE-4012 /io_log, /sys_log
+# ---------------------------
+# WISE-4012 reconnect แล้ว flush log buffer → POST ถี่ๆ / ก้อนใหญ่
+# body รับได้ทั้ง
+#   - JSON object เดียว (แบบเดิม)
+#   - JSON array ของ record
+#   - NDJSON (1 record ต่อบรรทัด)
+#   - Content-Encoding: gzip / deflate (หรือ body ที่ขึ้นต้นด้วย gzip magic)
+#     คลายได้ไม่เกิน HTTP_MAX_BODY byte (gzip bomb ก้อนเล็กไม่กิน memory ก่อนถึงการเช็ค HTTP_MAX_RECORDS)
+# parse ทั้งก้อนครั้งเดียว แล้ว put ลง BatchWriter (คิว, ไม่รอ database) → ตอบกลับทันที
+# แถวลง table log (JSONB ทั้ง record) แบบ multi-row INSERT ตาม batch ของ writer
+#
+# CREATE TABLE iotdata.wise4012_io_log / iotdata.wise4012_sys_log (   -- schema.py สร้างให้
+#     received_at TIMESTAMP, device VARCHAR(100), ts TIMESTAMP, payload JSONB
+# );
+
+IO_LOG_TABLE = os.getenv("IO_LOG_TABLE", "iotdata.wise4012_io_log")      # ว่าง = ไม่ลง PostgreSQL
+SYS_LOG_TABLE = os.getenv("SYS_LOG_TABLE", "iotdata.wise4012_sys_log")
+HTTP_MAX_RECORDS = int(os.getenv("HTTP_MAX_RECORDS", 10000))
+HTTP_MAX_BODY = int(os.getenv("HTTP_MAX_BODY", 16 * 1024 * 1024))     # ก่อน / หลังคลาย gzip, Flask MAX_CONTENT_LENGTH
+LOG_COLUMNS = ["received_at", "device", "ts", "payload"]
+
+DEVICE_KEYS = ("UID", "MAC", "uid", "mac", "device")
+TIME_KEYS = ("TIM", "t", "timestamp", "time")
+
+
+class BadPayload(ValueError):
+    pass
+
+
+def decode_body(body, content_encoding=""):
+    encoding = (content_encoding or "").lower()
+    if "gzip" not in encoding and "deflate" not in encoding and body[:2] != b"\x1f\x8b":
+        return body
+    d = zlib.decompressobj(wbits=47)      # 32 + 15 → gzip หรือ zlib ตาม header
+    try:
+        text = d.decompress(body, HTTP_MAX_BODY + 1)
+    except zlib.error as e:
+        raise BadPayload(f"cannot decompress body: {e}")
+    if len(text) > HTTP_MAX_BODY:
+        raise BadPayload(f"decompressed body exceeds {HTTP_MAX_BODY} bytes")
+    if not d.eof:
+        raise BadPayload("cannot decompress body: truncated stream")
+    return text
+
+
+def parse_records(body, content_type="", content_encoding=""):
+    # → list ของ dict (record ที่ไม่ใช่ object ถูกข้าม)
+    text = decode_body(body, content_encoding).strip()
+    if not text:
+        return []
+    if "ndjson" in (content_type or "") or "x-json-stream" in (content_type or ""):
+        docs = ndjson_docs(text)
+    else:
+        try:
+            docs = json.loads(text)
+        except ValueError:
+            docs = ndjson_docs(text)      # หลาย object ต่อกันโดยไม่บอก content type
+    if isinstance(docs, dict):
+        docs = [docs]
+    if not isinstance(docs, list):
+        raise BadPayload("expected a JSON object, array or NDJSON")
+    if len(docs) > HTTP_MAX_RECORDS:
+        raise BadPayload(f"too many records ({len(docs)} > {HTTP_MAX_RECORDS})")
+    return [d for d in docs if isinstance(d, dict)]
+
+
+def ndjson_docs(text):
+    docs = []
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            docs.append(json.loads(line))
+        except ValueError as e:
+            raise BadPayload(f"invalid JSON on line {n}: {e}")
+    return docs
+
+
+def record_time(record):
+    for key in TIME_KEYS:
+        value = record.get(key)
+        if isinstance(value, str):
+            try:
+                ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                continue
+            if ts.tzinfo is not None:
+                ts = ts.astimezone(timezone.utc).replace(tzinfo=None)     # column เป็น TIMESTAMP (UTC)
+            return ts
+    return None
+
+
+def record_device(record, default=None):
+    return next((record[k] for k in DEVICE_KEYS if record.get(k)), default)
+
+
+def log_row(record, remote=None, received_at=None):
+    device = record_device(record, remote)
+    return {
+        "received_at": received_at or datetime.utcnow(),
+        "device": str(device) if device is not None else None,
+        "ts": record_time(record),
+        "payload": json.dumps(record),     # text literal → JSONB
+    }
+
+
+class LogIngest:
+    # /io_log, /sys_log ของทั้ง Flask และ aiohttp gateway: memory (history / latest / sys_log) + คิว writer
+    def __init__(self, writer=None, history=None, latest=None, sys_log_events=None,
+                 io_table=IO_LOG_TABLE, sys_table=SYS_LOG_TABLE):
+        self.writer = writer
+        self.history = history
+        self.latest = latest
+        self.sys_log_events = sys_log_events
+        self.io_table = io_table if writer is not None else None
+        self.sys_table = sys_table if writer is not None else None
+        for table in (self.io_table, self.sys_table):
+            if table and table not in writer.tables:
+                writer.register(table, LOG_COLUMNS)
+        self.stats = {"requests": 0, "io_log": 0, "sys_log": 0, "rejected": 0}
+
+    def tables(self):
+        return [t for t in (self.io_table, self.sys_table) if t]
+
+    def io_log(self, records, remote=None):
+        received_at = datetime.utcnow()
+        for record in records:
+            key = f"io_log/{record_device(record, remote)}"     # แยกต่อ device ไม่ปนกันใน history / latest
+            ts = record_time(record)
+            ts_ms = epoch_ms(ts) if ts is not None else row_time(record)     # parse ครั้งเดียว ใช้ทั้ง history / latest
+            if self.history is not None:
+                self.history.append(key, record, ts_ms)
+            if self.latest is not None:
+                self.latest.update(key, record, ts_ms)
+            if self.io_table:
+                self.writer.put(self.io_table, log_row(record, remote, received_at), "/io_log")
+        self.stats["requests"] += 1
+        self.stats["io_log"] += len(records)
+        return len(records)
+
+    def sys_log(self, records, remote=None):
+        received_at = datetime.utcnow()
+        for record in records:
+            if self.sys_log_events is not None:
+                self.sys_log_events.append({"data": record, "timestamp": received_at.isoformat()})
+            if self.sys_table:
+                self.writer.put(self.sys_table, log_row(record, remote, received_at), "/sys_log")
+        self.stats["requests"] += 1
+        self.stats["sys_log"] += len(records)
+        return len(records)
+
+    def reject(self):
+        self.stats["rejected"] += 1
+
+    def snapshot(self):
+        return {**self.stats, "tables": self.tables(), "max_records": HTTP_MAX_RECORDS}
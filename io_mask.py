@@ -0,0 +1,123 @@
+import argparse
+import sys
+import psycopg2
+from log import get_logger, setup_logging
+
+# ---------------------------
+# Packed digital I/O (di/do → bitmask "io")
+# ---------------------------
+# decoder wise4210_packed / wise4012_io_packed เก็บทุกช่อง di/do ใน column เดียว io SMALLINT
+#   (bit i = ช่องที่ i ตาม WISE4210_IO_KEYS / WISE4012_IO_KEYS ใน decoders.py)
+#   → แถวแคบลง, index / WAL เล็กลง
+# อ่านแบบเดิมได้ 2 ทาง:
+#   view <table>_io = SELECT *, di1, di2, ... (unpack จาก io, type เดิมของช่อง)  ← schema.py สร้างให้
+#   /query: target di1 ของ table packed → SQL ((io >> 0) & 1) แทน column (column_sql)
+#
+# ข้อมูลเดิม (column แยก): เปลี่ยน decoder ใน device map เป็น *_packed แล้ว
+#   python io_mask.py convert devices/all.json [--table iotdata.wise4210_data] [--keep-columns]
+#   → ADD COLUMN io, UPDATE io จาก di/do เดิม, DROP column di/do, สร้าง view
+#   (พื้นที่ของ column ที่ drop คืนหลัง VACUUM FULL / rewrite ของ partition นั้น)
+
+PACKED_TABLES = {}    # table → (ช่อง ตามลำดับ bit, type เดิม "integer" / "boolean")
+
+log = get_logger("io_mask")
+
+
+def register_packed(table, packed):
+    # เรียกจาก Gateway._init_routes ต่อ route ที่ decoder มี packed
+    PACKED_TABLES[table] = (tuple(packed[0]), packed[1])
+
+
+def column_sql(table, column):
+    # column ของ target → SQL (ช่องของ table packed = bit ของ io เป็น 0/1)
+    packed = PACKED_TABLES.get(table)
+    if packed is None or column not in packed[0]:
+        return column
+    return f"((io >> {packed[0].index(column)}) & 1)"
+
+
+def view_name(table):
+    return f"{table}_io"
+
+
+def view_sql(table, keys, kind):
+    if kind == "boolean":
+        cols = ", ".join(f"(io & {1 << i}) <> 0 AS {k}" for i, k in enumerate(keys))
+    else:
+        cols = ", ".join(f"(io >> {i}) & 1 AS {k}" for i, k in enumerate(keys))
+    return f"CREATE OR REPLACE VIEW {view_name(table)} AS SELECT *, {cols} FROM {table}"
+
+
+def pack_sql(keys):
+    # column แยกเดิม (INTEGER หรือ BOOLEAN) → bitmask
+    return " + ".join(f"(CASE WHEN COALESCE({k}::int, 0) <> 0 THEN {1 << i} ELSE 0 END)"
+                      for i, k in enumerate(keys))
+
+
+# ---------------------------
+# Conversion: column แยก → io
+# ---------------------------
+def table_columns(conn, table):
+    schema, _, name = table.rpartition(".")
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s",
+            (schema or "public", name.lower()))
+        columns = {r[0] for r in cursor.fetchall()}
+    conn.rollback()
+    return columns
+
+
+def convert(conn, table, keys, kind, keep_columns=False):
+    columns = table_columns(conn, table)
+    if not columns:
+        log.warning("⚠️ %s does not exist, skipping", table)
+        return 0
+    present = [k for k in keys if k in columns]
+    converted = 0
+    with conn.cursor() as cursor:
+        if "io" not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN io SMALLINT")
+        if present:
+            if len(present) < len(keys):
+                raise ValueError(f"{table} has only {', '.join(present)} of {', '.join(keys)}")
+            cursor.execute(f"UPDATE {table} SET io = {pack_sql(keys)} WHERE io IS NULL")
+            converted = cursor.rowcount
+            if not keep_columns:
+                cursor.execute(f"ALTER TABLE {table} " + ", ".join(f"DROP COLUMN {k}" for k in keys))
+        if keep_columns and present:
+            log.info("%s still has %s, skipping view %s", table, ", ".join(keys), view_name(table))
+        else:
+            cursor.execute(view_sql(table, keys, kind))
+    conn.commit()
+    log.info("🗜️ Packed %d rows of %s into io (%s)%s", converted, table, ", ".join(keys),
+             ", kept old columns" if keep_columns and present else "")
+    return converted
+
+
+def main():
+    from gateway import Gateway, load_device_map, DEVICE_MAP
+
+    parser = argparse.ArgumentParser(description="Convert di/do columns to a packed io bitmask")
+    parser.add_argument("command", choices=["convert"])
+    parser.add_argument("device_map", nargs="?", default=DEVICE_MAP)
+    parser.add_argument("--table", action="append", help="only these tables")
+    parser.add_argument("--keep-columns", action="store_true", help="keep di/do columns after packing")
+    args = parser.parse_args()
+
+    setup_logging()
+    gw = Gateway(load_device_map(args.device_map))
+    tables = {t: p for t, p in PACKED_TABLES.items() if not args.table or t in args.table}
+    if not tables:
+        sys.exit("no routes with a *_packed decoder in the device map")
+    with gw.db.connection(statement_timeout_ms=0) as conn:
+        for table, (keys, kind) in tables.items():
+            try:
+                convert(conn, table, keys, kind, args.keep_columns)
+            except (psycopg2.Error, ValueError) as e:
+                conn.rollback()
+                log.error("❌ Converting %s failed: %s", table, e)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+# ---------------------------
+# Latest-value store (ค่าล่าสุดต่อ device / tag)
+# ---------------------------
+# แทน global แบบ latest_io / latest_signal_info ของแต่ละ script
+#   device → {tag: [value, ts epoch ms, quality]}   อัปเดตบน ingest path (O(1) ต่อ tag)
+# quality ของ tag: "<tag>_status" (WISE-2200), "ai_stN" ของ "aiN" (WISE-4012) หรือ "q" ของทั้งแถว (WISE-4012/4210)
+# เวลา: "timestamp" / "time" / "t" ของแถว ถ้าไม่มีใช้เวลาที่รับ
+# dashboard เปิดใหม่ได้ snapshot จาก memory (GET /api/latest, Socket.IO "latest" ตอน connect) ไม่ต้อง query PostgreSQL
+
+TIME_KEYS = ("timestamp", "time", "t")
+SCALAR = (str, int, float, bool, type(None))
+
+
+def epoch_ms(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp() * 1000)
+    if isinstance(value, str):
+        try:
+            return epoch_ms(datetime.fromisoformat(value.replace("Z", "+00:00")))
+        except ValueError:
+            return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    return None
+
+
+def row_time(row):
+    for key in TIME_KEYS:
+        if key in row:
+            ts_ms = epoch_ms(row[key])
+            if ts_ms is not None:
+                return ts_ms
+    return int(time.time() * 1000)
+
+
+def tag_quality(tag, row):
+    q = row.get(tag + "_status")
+    if q is None and tag.startswith("ai") and tag[2:].isdigit():
+        q = row.get("ai_st" + tag[2:])
+    if q is None:
+        q = row.get("q")
+    return q
+
+
+class LatestStore:
+    def __init__(self, skip=()):
+        self.skip = set(TIME_KEYS) | set(skip)    # key ที่ไม่ใช่ tag (เวลา, device id)
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.stats = {"updates": 0}
+
+    def update(self, device, row, ts_ms=None):
+        if ts_ms is None:
+            ts_ms = row_time(row)
+        with self.lock:
+            tags = self.devices.get(device)
+            if tags is None:
+                tags = self.devices[device] = {}
+            for tag, value in row.items():
+                if tag in self.skip or not isinstance(value, SCALAR):
+                    continue
+                current = tags.get(tag)
+                if current is not None and current[1] > ts_ms:
+                    continue      # ข้อมูลที่มาช้ากว่าค่าที่มีอยู่ ไม่ทับ
+                tags[tag] = [value, ts_ms, tag_quality(tag, row)]
+            self.stats["updates"] += 1
+
+    def device(self, device):
+        with self.lock:
+            tags = self.devices.get(device)
+            if tags is None:
+                return None
+            return {tag: {"value": v, "ts": ts, "quality": q} for tag, (v, ts, q) in tags.items()}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                device: {tag: {"value": v, "ts": ts, "quality": q} for tag, (v, ts, q) in tags.items()}
+                for device, tags in self.devices.items()
+            }
+
+    def info(self):
+        with self.lock:
+            return {**self.stats, "devices": len(self.devices),
+                    "tags": sum(len(tags) for tags in self.devices.values())}
@@ -0,0 +1,159 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# ---------------------------
+# Logging
+# ---------------------------
+# แทน print() บน hot path (thread ของ paho):
+# - logger.xxx() แค่ใส่ record ลง queue (เต็ม = ทิ้ง + นับ) แล้ว QueueListener เขียน stdout ใน thread แยก
+# - ข้อความเดิมซ้ำๆ (เช่น SQL error ทุก message) ถูกจำกัดที่ LOG_BURST บรรทัดต่อ LOG_BURST_INTERVAL วินาที
+# - payload เต็มของ MQTT log เฉพาะ topic ที่เปิด trace ไว้ (เปิด/ปิดได้ตอน runtime ผ่าน /api/log)
+#   topic อื่น log แค่สรุป 1 บรรทัดทุก LOG_SAMPLE_EVERY message และไม่เกิน LOG_TOPIC_RATE บรรทัด/วินาที
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", 100))
+LOG_TOPIC_RATE = float(os.getenv("LOG_TOPIC_RATE", 1))
+LOG_BURST = int(os.getenv("LOG_BURST", 5))
+LOG_BURST_INTERVAL = float(os.getenv("LOG_BURST_INTERVAL", 10))
+LOG_TRACE_TOPICS = [t for t in os.getenv("LOG_TRACE_TOPICS", "").split(",") if t]
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+class DropQueueHandler(logging.handlers.QueueHandler):
+    # queue เต็ม → ทิ้ง record (ไม่ block thread ที่ log)
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BurstFilter(logging.Filter):
+    # ข้อความ template เดียวกัน (logger + msg) ได้ไม่เกิน burst บรรทัดต่อ interval วินาที
+    def __init__(self, burst=LOG_BURST, interval=LOG_BURST_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.windows = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            started, count, hidden = self.windows.get(key, (now, 0, 0))
+            if now - started >= self.interval:
+                if hidden:
+                    record.msg = f"{record.msg} (+{hidden} similar suppressed)"
+                started, count, hidden = now, 0, 0
+            if count < self.burst:
+                self.windows[key] = (started, count + 1, hidden)
+                return True
+            self.windows[key] = (started, count, hidden + 1)
+            self.suppressed += 1
+            return False
+
+
+_queue_handler = None
+_burst_filter = BurstFilter()
+
+
+def setup_logging(level=LOG_LEVEL):
+    global _listener, _queue_handler
+    with _setup_lock:
+        if _listener is not None:
+            return
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s"))
+        _queue_handler = DropQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        _queue_handler.addFilter(_burst_filter)
+
+        root = logging.getLogger("wise")
+        root.setLevel(level)
+        root.addHandler(_queue_handler)
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(name):
+    return logging.getLogger(f"wise.{name}")
+
+
+# ---------------------------
+# Per-topic sampling / trace
+# ---------------------------
+class TopicLog:
+    def __init__(self, sample_every=LOG_SAMPLE_EVERY, rate=LOG_TOPIC_RATE, trace=LOG_TRACE_TOPICS):
+        self.sample_every = sample_every
+        self.rate = rate
+        self.trace = set(trace)          # topic/device ที่ log payload เต็ม ("*" = ทุก topic)
+        self.counts = {}
+        self.last_line = {}
+        self.lock = threading.Lock()
+
+    # trace ได้ทั้งชื่อ topic เต็ม หรือ level ใด level หนึ่งของ topic (เช่น MAC)
+    def tracing(self, topic):
+        if not self.trace:
+            return False
+        trace = self.trace
+        return topic in trace or "*" in trace or any(level in trace for level in topic.split("/"))
+
+    # คืนจำนวน message ของ topic ถ้ารอบนี้ควร log สรุป, ไม่งั้น 0
+    def sample(self, topic):
+        with self.lock:
+            n = self.counts.get(topic, 0) + 1
+            self.counts[topic] = n
+            if self.sample_every <= 0 or (n - 1) % self.sample_every:
+                return 0
+            now = time.monotonic()
+            if self.rate > 0 and now - self.last_line.get(topic, 0.0) < 1.0 / self.rate:
+                return 0
+            self.last_line[topic] = now
+            return n
+
+    def configure(self, data):
+        if "trace" in data:
+            self.trace = set(data["trace"] or [])
+        if data.get("topic"):
+            if data.get("enabled", True):
+                self.trace.add(data["topic"])
+            else:
+                self.trace.discard(data["topic"])
+        if "sample_every" in data:
+            self.sample_every = int(data["sample_every"])
+        if "rate" in data:
+            self.rate = float(data["rate"])
+        if "level" in data:
+            logging.getLogger("wise").setLevel(str(data["level"]).upper())
+
+    def snapshot(self):
+        return {
+            "level": logging.getLevelName(logging.getLogger("wise").level),
+            "trace": sorted(self.trace),
+            "sample_every": self.sample_every,
+            "rate": self.rate,
+            "topics": len(self.counts),
+            "dropped": _queue_handler.dropped if _queue_handler else 0,
+            "suppressed": _burst_filter.suppressed,
+        }
+
+
+topic_log = TopicLog()
@@ -0,0 +1,237 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, g, request
+
+# ---------------------------
+# Prometheus metrics (text format 0.0.4)
+# ---------------------------
+# ไม่ใช้ prometheus_client: metric แต่ละตัว = dict ต่อชุด label + lock 1 ตัว
+# inc()/observe() บน hot path จึงมีแค่ dict lookup + bisect (ไม่กี่ร้อย ns) → เปิดทิ้งไว้ใน production ได้
+#
+#   GET /metrics      (instrument_app(app) เพิ่ม route นี้ + วัด latency ของทุก Flask route)
+#
+# label ที่เป็น topic มีได้ไม่เกิน METRICS_MAX_SERIES ชุดต่อ metric ที่เกินจะรวมไว้ที่ "other"
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", 1000))
+
+# วินาที: 50 µs … 10 s
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    parts = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), max_series=METRICS_MAX_SERIES):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self.series = {}      # label values (tuple) → ค่า
+        self.lock = threading.Lock()
+
+    def _key(self, values):
+        # เรียกภายใต้ self.lock
+        if values in self.series or len(self.series) < self.max_series:
+            return values
+        return ("other",) * len(self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.series.items())
+        lines += self._samples(items)
+        return lines
+
+    def _samples(self, items):
+        return [f"{self.name}{format_labels(self.labels, k)} {format_value(v)}" for k, v in items]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values, n=1):
+        with self.lock:
+            key = self._key(values)
+            self.series[key] = self.series.get(key, 0) + n
+
+    def value(self, *values):
+        return self.series.get(values, 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn          # fn() → ค่า หรือ {label values: ค่า} อ่านตอน scrape
+
+    def set(self, value, *values):
+        with self.lock:
+            self.series[self._key(values)] = value
+
+    def set_function(self, fn):
+        self.fn = fn
+        return self
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                value = self.fn()
+                if isinstance(value, dict):      # {label values: ค่า} สำหรับ gauge ที่มี label
+                    for values, v in value.items():
+                        self.set(v, *values)
+                else:
+                    self.set(value)
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *values):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            key = self._key(values)
+            s = self.series.get(key)
+            if s is None:
+                # [count ต่อ bucket (+Inf ท้ายสุด), sum, count]
+                s = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def _samples(self, items):
+        lines = []
+        bounds = self.buckets + (float("inf"),)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for le, c in zip(bounds, counts):
+                cumulative += c
+                le_label = 'le="%s"' % format_value(le)
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.metrics.get(name) or self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.metrics.get(name) or self.register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.metrics.get(name) or self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ---------------------------
+# Ingest pipeline metrics
+# ---------------------------
+# stage: queue (รอใน shard ของ worker), parse (json.loads), route (topic trie), decode (decoder),
+#        publish (ส่งเข้า Broadcaster), insert / commit (BatchWriter ต่อ batch), emit (Socket.IO ต่อ tick),
+#        message (Gateway.handle ทั้งหมด)
+STAGE_SECONDS = REGISTRY.histogram(
+    "wise_stage_seconds", "Time spent in each ingest pipeline stage", ["stage"])
+MQTT_RECEIVED = REGISTRY.counter(
+    "wise_mqtt_received_total", "MQTT messages received", ["topic"])
+MQTT_UNROUTED = REGISTRY.counter(
+    "wise_mqtt_unrouted_total", "MQTT messages that matched no route", ["topic"])
+DECODE_ERRORS = REGISTRY.counter(
+    "wise_decode_errors_total", "Payloads that failed to parse or decode", ["topic"])
+ROWS_INSERTED = REGISTRY.counter(
+    "wise_rows_inserted_total", "Rows committed to PostgreSQL", ["topic", "table"])
+ROWS_DROPPED = REGISTRY.counter(
+    "wise_rows_dropped_total", "Rows dropped before reaching PostgreSQL", ["topic", "table", "reason"])
+SQL_ERRORS = REGISTRY.counter(
+    "wise_sql_errors_total", "SQL errors while inserting", ["table"])
+BATCH_ROWS = REGISTRY.histogram(
+    "wise_batch_rows", "Rows per INSERT batch", ["table"],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+SOCKETIO_CLIENTS = REGISTRY.gauge(
+    "wise_socketio_clients", "Connected Socket.IO clients")
+WRITER_QUEUE = REGISTRY.gauge(
+    "wise_writer_queue_depth", "Rows waiting in the BatchWriter queue")
+DB_IN_USE = REGISTRY.gauge(
+    "wise_db_connections_in_use", "PostgreSQL pool connections checked out")
+SOCKETIO_FRAMES = REGISTRY.counter(
+    "wise_socketio_frames_total", "Socket.IO frames emitted", ["event"])
+HTTP_SECONDS = REGISTRY.histogram(
+    "wise_http_request_seconds", "HTTP request latency", ["route", "method", "status"])
+
+
+# timer สำหรับ hot path: ถ้าปิด metrics ไว้ observe() จะไม่ถูกเรียก
+def stage_start():
+    return time.perf_counter() if METRICS_ENABLED else 0.0
+
+
+def stage_done(stage, started):
+    if started:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage)
+
+
+# ---------------------------
+# Flask
+# ---------------------------
+def instrument_app(app, registry=REGISTRY):
+    @app.before_request
+    def _metrics_start():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _metrics_done(response):
+        started = g.pop("metrics_started", None)
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        if started is not None and METRICS_ENABLED and rule != "/metrics":
+            HTTP_SECONDS.observe(time.perf_counter() - started, rule, request.method, str(response.status_code))
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+    return app
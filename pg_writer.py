@@ -0,0 +1,397 @@
+import os
+import queue
+import threading
+import time
+import atexit
+import psycopg2
+from psycopg2.extras import execute_values
+from db import DatabaseUnavailable
+from log import get_logger
+from metrics import ROWS_INSERTED, ROWS_DROPPED, SQL_ERRORS, BATCH_ROWS, stage_start, stage_done
+
+# ---------------------------
+# Batched PostgreSQL writer
+# ---------------------------
+# on_message แค่ put() แถวลงคิว แล้ว thread นี้จะรวมแถวต่อ table
+# และ flush ด้วย execute_values (multi-row INSERT) ใน transaction เดียว
+# เมื่อครบ batch_size หรือครบ flush_interval วินาที
+# ถ้ามี spool (spool.py): database ล่ม / คิวเต็ม → แถวลง disk แทนการทิ้ง แล้วค่อย replay ทีหลัง
+# ถ้ามี rollups (rollup.py): upsert rollup 1m/1h ของ batch ใน transaction เดียวกับแถวดิบ
+# ถ้ามี cache (query_cache.py): แถวที่ commit แล้วถูกบวกเข้า /query cache ที่เปิดอยู่
+# ถ้ามี dedup (dedup.py): แถวซ้ำถูกทิ้งตั้งแต่ put() ไม่เข้าคิว
+# table ที่มี conflict key (primary key): INSERT ... ON CONFLICT DO NOTHING / DO UPDATE ทั้ง batch
+#   แทนการให้ทั้ง batch พังแล้วไล่ insert ทีละแถว; RETURNING → rollup / cache บวกเฉพาะแถวที่ insert ใหม่
+#   แถวที่ DO UPDATE ทับแถวเดิม → rollup recompute bucket นั้น, /query cache ของ table ถูก invalidate
+# stats ถูกแก้จากหลาย thread (put จาก paho / worker, flush จาก writer thread) → เปลี่ยนผ่าน _count() ภายใต้ lock
+# log ต่อ flush เป็น DEBUG ; INFO สรุปทุก WRITER_LOG_INTERVAL วินาที (0 = ไม่สรุป)
+
+WRITER_LOG_INTERVAL = float(os.getenv("WRITER_LOG_INTERVAL", 60))
+
+log = get_logger("writer")
+
+
+# นับแถวต่อ topic ทีละ batch (inc ครั้งเดียวต่อ topic ไม่ใช่ต่อแถว)
+def count_topics(metric, topics, *labels):
+    counts = {}
+    for topic in topics:
+        counts[topic] = counts.get(topic, 0) + 1
+    for topic, n in counts.items():
+        metric.inc(topic, *labels, n=n)
+
+
+def insert_sql(table, columns, conflict_key=None, on_conflict="nothing"):
+    # → (sql, returning) ; returning = ได้ key ของแถวที่เข้า table กลับมา
+    #   DO NOTHING: เฉพาะแถวที่ insert จริง ; DO UPDATE: ทุกแถว + (xmax = 0) = insert ใหม่ / false = ทับแถวเดิม
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s"
+    if not conflict_key:
+        return sql, False
+    key = ", ".join(conflict_key)
+    if on_conflict == "update":
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns if c not in conflict_key)
+        return f"{sql} ON CONFLICT ({key}) DO UPDATE SET {updates} RETURNING {key}, (xmax = 0)", True
+    return f"{sql} ON CONFLICT ({key}) DO NOTHING RETURNING {key}", True
+
+
+def collapse(rows, topics, conflict_key, keep_last):
+    # key ซ้ำใน batch เดียวกัน: DO UPDATE แก้แถวเดิมซ้ำไม่ได้, DO NOTHING + RETURNING จะนับซ้ำ → เหลือแถวเดียว
+    picked = {}
+    for i, row in enumerate(rows):
+        key = tuple(row.get(c) for c in conflict_key)
+        if keep_last or key not in picked:
+            picked[key] = i
+    if len(picked) == len(rows):
+        return rows, topics
+    keep = sorted(picked.values())
+    return [rows[i] for i in keep], [topics[i] for i in keep]
+
+
+def returned_rows(rows, conflict_key, returned):
+    # → (แถวที่ insert ใหม่, แถวที่ DO UPDATE ทับแถวเดิม)
+    n = len(conflict_key)
+    inserted, updated = set(), set()
+    for r in returned:
+        (updated if len(r) > n and not r[n] else inserted).add(tuple(r[:n]))
+    new, replaced = [], []
+    for row in rows:
+        key = tuple(row.get(c) for c in conflict_key)
+        if key in inserted:
+            new.append(row)
+        elif key in updated:
+            replaced.append(row)
+    return new, replaced
+
+
+class BatchWriter:
+    def __init__(self, db, batch_size=500, flush_interval=1.0, max_queue=10000, spool=None, rollups=None):
+        self.db = db                      # db.Database (connection pool)
+        self.spool = spool                # spool.Spool หรือ None (ทิ้งแถวแบบเดิม)
+        self.rollups = rollups            # rollup.RollupSet หรือ None
+        self.cache = None                 # query_cache.QueryCache หรือ None
+        self.dedup = None                 # dedup.Deduplicator หรือ None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.tables = {}                  # table -> (columns, sql, template)
+        self.conflicts = {}               # table -> (conflict key, keep last, returning)
+        self.buffers = {}                 # table -> [row, ...]
+        self.buffer_topics = {}           # table -> [MQTT topic ของแต่ละแถว] (สำหรับ metrics ต่อ topic)
+        self.first_row_at = {}            # table -> monotonic time ของแถวแรกใน buffer
+        self.stats = {
+            "queued": 0, "dropped": 0, "duplicates": 0, "conflicts": 0, "updated": 0, "spooled": 0,
+            "flushed_rows": 0, "flushes": 0, "errors": 0,
+            "last_flush_rows": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0,
+        }
+        self.lock = threading.Lock()      # ป้องกัน stats
+        self.log_interval = WRITER_LOG_INTERVAL
+        self._logged = (time.monotonic(), 0, 0)     # (เวลา, flushes, flushed_rows) ตอนสรุปครั้งก่อน
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pg-writer", daemon=True)
+
+    def register(self, table, columns, conflict_key=None, on_conflict="nothing"):
+        sql, returning = insert_sql(table, columns, conflict_key, on_conflict)
+        template = "(" + ", ".join(f"%({c})s" for c in columns) + ")"
+        self.tables[table] = (columns, sql, template)
+        if conflict_key:
+            self.conflicts[table] = (tuple(conflict_key), on_conflict == "update", returning)
+            if self.spool is not None:
+                self.spool.conflicts[table] = (tuple(conflict_key), on_conflict)    # replay ใช้ policy เดียวกัน
+        self.buffers[table] = []
+        self.buffer_topics[table] = []
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self, timeout=5.0):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def put(self, table, row, topic=None):
+        if table not in self.tables:
+            log.warning("⚠️ BatchWriter: table %s is not registered, ignoring...", table)
+            return False
+        if self._duplicate(table, row, topic):
+            return True
+        try:
+            self.queue.put_nowait((table, row, topic))
+            self._count(queued=1)
+            return True
+        except queue.Full:
+            # ไม่ block thread ของ paho — ลง spool (ถ้ามี) ไม่งั้นทิ้งแถวแล้วนับไว้
+            if self._spool(table, [row]):
+                return True
+            self._count(dropped=1)
+            ROWS_DROPPED.inc(topic or "", table, "queue_full")
+            return False
+
+    def _duplicate(self, table, row, topic):
+        if self.dedup is None or not self.dedup.duplicate(table, row):
+            return False
+        self._count(duplicates=1)
+        ROWS_DROPPED.inc(topic or "", table, "duplicate")
+        return True
+
+    # ---------------------------
+    # Writer thread
+    # ---------------------------
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                table, row, topic = self.queue.get(timeout=self._next_timeout())
+                self._buffer(table, row, topic)
+                # ดึงที่ค้างในคิวมาให้หมดก่อน เพื่อให้ได้ batch ใหญ่
+                while True:
+                    try:
+                        table, row, topic = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._buffer(table, row, topic)
+            except queue.Empty:
+                pass
+            self._flush_due()
+
+        # drain ก่อนปิด process
+        while True:
+            try:
+                table, row, topic = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self._buffer(table, row, topic)
+        for table in self.buffers:
+            self._flush(table)
+
+    def _buffer(self, table, row, topic=None):
+        buf = self.buffers[table]
+        if not buf:
+            self.first_row_at[table] = time.monotonic()
+        buf.append(row)
+        self.buffer_topics[table].append(topic or "")
+        if len(buf) >= self.batch_size:
+            self._flush(table)
+
+    def _next_timeout(self):
+        if not self.first_row_at:
+            return self.flush_interval
+        oldest = min(self.first_row_at.values())
+        return max(0.01, self.flush_interval - (time.monotonic() - oldest))
+
+    def _flush_due(self):
+        now = time.monotonic()
+        for table, started in list(self.first_row_at.items()):
+            if now - started >= self.flush_interval:
+                self._flush(table)
+
+    def _take(self, table):
+        # ดึงแถวที่รออยู่ของ table ออกจาก buffer → (rows, topics)
+        rows, topics = self.buffers[table], self.buffer_topics[table]
+        self.first_row_at.pop(table, None)
+        self.buffers[table] = []
+        self.buffer_topics[table] = []
+        return rows, topics
+
+    def _take_unique(self, table):
+        rows, topics = self._take(table)
+        conflict = self.conflicts.get(table)
+        if conflict and rows:
+            n = len(rows)
+            rows, topics = collapse(rows, topics, conflict[0], conflict[1])
+            self._count(duplicates=n - len(rows))
+        return rows, topics
+
+    def _inserted(self, table, rows, returned):
+        # RETURNING → (แถวที่ insert ใหม่, แถวที่ทับแถวเดิม) ; ที่เหลือชน key แล้วถูกข้าม (DO NOTHING)
+        inserted, updated = returned_rows(rows, self.conflicts[table][0], returned)
+        self._count(conflicts=len(rows) - len(inserted) - len(updated), updated=len(updated))
+        return inserted, updated
+
+    def _flush(self, table):
+        rows, topics = self._take_unique(table)
+        if not rows:
+            return
+
+        columns, sql, template = self.tables[table]
+        returning = self.conflicts.get(table, (None, False, False))[2]
+        started = time.perf_counter()
+        inserted, updated = rows, []
+        one_by_one = False
+        try:
+            with self.db.connection() as conn:
+                try:
+                    t = stage_start()
+                    with conn.cursor() as cursor:
+                        returned = execute_values(cursor, sql, rows, template=template,
+                                                  page_size=self.batch_size, fetch=returning)
+                        if returning:
+                            inserted, updated = self._inserted(table, rows, returned)
+                        if self.rollups:
+                            self.rollups.apply(cursor, table, inserted, updated)
+                    stage_done("insert", t)
+                    t = stage_start()
+                    committed_at = time.monotonic()
+                    conn.commit()
+                    stage_done("commit", t)
+                    if self.rollups:
+                        self.rollups.committed(table)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except Exception as sql_err:
+                    log.error("❌ SQL Error flushing %d rows into %s: %s", len(rows), table, sql_err)
+                    self._count(errors=1)
+                    SQL_ERRORS.inc(table)
+                    conn.rollback()
+                    one_by_one = True
+                    self._insert_one_by_one(conn, table, rows, topics)
+                    return
+        except (DatabaseUnavailable, psycopg2.Error) as e:
+            if not one_by_one:      # ทีละแถว: แถวที่เหลือลง spool ไปแล้วใน _insert_one_by_one
+                self._unavailable(table, rows, topics, e)
+            return
+
+        self._flushed(table, rows, topics, (time.perf_counter() - started) * 1000, committed_at, inserted, updated)
+
+    def _unavailable(self, table, rows, topics, e):
+        self._count(errors=1)
+        SQL_ERRORS.inc(table)
+        if self._spool(table, rows):
+            log.warning("💾 PostgreSQL unavailable, spooled %d rows for %s: %s", len(rows), table, e)
+            return
+        log.error("❌ PostgreSQL unavailable, dropped %d rows for %s: %s", len(rows), table, e)
+        self._count(dropped=len(rows))
+        count_topics(ROWS_DROPPED, topics, table, "db_unavailable")
+
+    def _flushed(self, table, rows, topics, elapsed_ms, committed_at, inserted=None, updated=()):
+        # inserted = แถวที่ insert ใหม่ (ไม่นับที่ชน key) ถ้าไม่ระบุ = rows ทั้งหมด ; updated = แถวที่ทับแถวเดิม
+        if inserted is not None and len(inserted) + len(updated) < len(rows):
+            written = {id(r) for r in inserted} | {id(r) for r in updated}
+            topics = [t for r, t in zip(rows, topics) if id(r) in written]     # ROWS_INSERTED ไม่นับแถวที่ชน key
+        written = len(rows) if inserted is None else len(inserted) + len(updated)
+        self._record_flush(len(rows), written, elapsed_ms)
+        BATCH_ROWS.observe(len(rows), table)
+        count_topics(ROWS_INSERTED, topics, table)
+        self._committed(table, rows if inserted is None else inserted, committed_at, updated)
+        log.debug("📥 Flushed %d rows into %s in %.1f ms", len(rows), table, elapsed_ms)
+        self._log_summary()
+
+    def _committed(self, table, rows, committed_at, updated=()):
+        # committed_at = time.monotonic() ก่อน commit (query_cache แยกแถวที่ SQL ที่ค้างอยู่เห็นแล้ว)
+        if self.cache is None:
+            return
+        if updated:
+            self.cache.invalidate(table)
+        elif rows:
+            self.cache.apply(table, rows, committed_at)
+
+    def _insert_one_by_one(self, conn, table, rows, topics):
+        # batch พังเพราะแถวเดียว (เช่น duplicate key) → ไม่อยากเสียทั้ง batch
+        columns, sql, template = self.tables[table]
+        returning = self.conflicts.get(table, (None, False, False))[2]
+        ok, replaced = [], []
+        committed_at = time.monotonic()
+        for i, (row, topic) in enumerate(zip(rows, topics)):
+            left = i                  # แถวแรกที่ยังไม่ได้ commit / ทิ้ง
+            try:
+                try:
+                    with conn.cursor() as cursor:
+                        inserted, updated = [row], []
+                        returned = execute_values(cursor, sql, [row], template=template, fetch=returning)
+                        if returning:
+                            inserted, updated = self._inserted(table, inserted, returned)
+                        elif cursor.rowcount == 0:
+                            inserted = []     # ON CONFLICT DO NOTHING ข้ามแถวนี้
+                            self._count(conflicts=1)
+                        if self.rollups:
+                            self.rollups.apply(cursor, table, inserted, updated)
+                    conn.commit()
+                    if self.rollups:
+                        self.rollups.committed(table)
+                    ok += inserted
+                    replaced += updated
+                    if inserted or updated:
+                        ROWS_INSERTED.inc(topic, table)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except Exception as sql_err:
+                    log.error("❌ SQL Error inserting into %s: %s", table, sql_err)
+                    self._count(dropped=1)
+                    SQL_ERRORS.inc(table)
+                    ROWS_DROPPED.inc(topic, table, "sql_error")
+                    left = i + 1
+                    conn.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # connection หลุดกลางทาง → แถวที่ commit แล้วไปต่อตามปกติ, spool เฉพาะแถวนี้เป็นต้นไป
+                # แล้ว raise ต่อให้ db.connection() ทิ้ง connection ที่เสีย
+                self._count(flushed_rows=len(ok) + len(replaced))
+                self._committed(table, ok, committed_at, replaced)
+                self._unavailable(table, rows[left:], topics[left:], e)
+                raise
+        self._count(flushed_rows=len(ok) + len(replaced))
+        self._committed(table, ok, committed_at, replaced)
+
+    def _spool(self, table, rows):
+        if self.spool is None:
+            return False
+        try:
+            ok = self.spool.append(table, self.tables[table][0], rows)
+        except OSError as e:
+            log.error("❌ Spool write failed for %s: %s", table, e)
+            return False
+        if ok:
+            self._count(spooled=len(rows))
+        return ok
+
+    def _count(self, **deltas):
+        with self.lock:
+            for key, n in deltas.items():
+                self.stats[key] += n
+
+    def _record_flush(self, n, written, elapsed_ms):
+        # n = แถวใน batch, written = แถวที่ insert / update จริง (ไม่นับที่ชน key)
+        with self.lock:
+            s = self.stats
+            s["flushes"] += 1
+            s["flushed_rows"] += written
+            s["last_flush_rows"] = n
+            s["last_flush_ms"] = round(elapsed_ms, 2)
+            s["max_flush_ms"] = max(s["max_flush_ms"], round(elapsed_ms, 2))
+
+    def _log_summary(self):
+        if self.log_interval <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            at, flushes, rows = self._logged
+            if now - at < self.log_interval:
+                return
+            s = self.stats
+            self._logged = (now, s["flushes"], s["flushed_rows"])
+            summary = (s["flushes"] - flushes, s["flushed_rows"] - rows, now - at, s["max_flush_ms"])
+        log.info("📥 Flushed %d batches / %d rows in the last %.0f s (max flush %.1f ms)", *summary)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return {**stats, "queue_depth": self.queue.qsize()}
@@ -0,0 +1,358 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from grafana import (
+    query_window, group_targets, query_source, grafana_response, fill_datapoints, seed_sql, seed_points, bucket_ms,
+)
+from history import to_number
+from io_mask import column_sql
+from log import get_logger
+from metrics import REGISTRY
+
+# ---------------------------
+# /query result cache (Grafana refresh ซ้ำๆ ไม่ต้องถึง PostgreSQL)
+# ---------------------------
+# key = (table, column, time column, bucket) → state ต่อ bucket [count, sum, min, max]
+#   เก็บ state แทนค่า aggregate → avg / min / max / count / sum ของ target เดียวกันใช้ entry เดียว
+# request ใหม่ที่ start (ปัดลง bucket) >= start ของ entry → ตอบจาก cache ทั้งหมด (hit)
+#   window เลื่อนไปข้างหน้า → bucket ที่หลุดจาก start ถูกตัดทิ้ง
+# BatchWriter commit แถวใหม่ → apply() บวกเข้า bucket ของทุก entry ของ table นั้น (ขยาย ไม่ invalidate)
+#   entry ที่ SQL ยังไม่เสร็จ (pending): แถวที่ apply() เข้ามาพักไว้พร้อมเวลาเริ่ม commit ของ writer
+#   finish() → แถวที่ commit ก่อน snapshot ของ SQL อยู่ในผล SQL แล้ว (ทิ้ง), ที่ commit หลังจากนั้นบวกเพิ่ม
+#   (เวลาทั้งสองฝั่งเป็น monotonic ก่อนส่ง statement → คลาดได้ไม่เกิน round trip ของ commit)
+# แถวที่ ON CONFLICT DO UPDATE ทับแถวเดิม → invalidate() ทิ้ง entry ของ table (บวกซ้ำไม่ได้ ลบค่าเก่าก็ไม่ได้)
+# target ที่เติม bucket ว่าง (compression.py): entry จำค่าก่อน bucket แรก (seed) ด้วย
+#   ครั้งแรกจาก seed_sql (แถวดิบล่าสุดก่อน window), window เลื่อน → bucket ล่าสุดที่ถูกตัดทิ้งเป็น seed แทน
+# แถวที่ไม่ได้มาทาง writer (spool replay, process อื่น) → entry อายุเกิน QUERY_CACHE_MAX_AGE จะ query ใหม่
+# LRU + เพดานหน่วยความจำโดยประมาณ QUERY_CACHE_MAX_BYTES
+#
+# เวลาใน table เป็น TIMESTAMP (ไม่มี timezone) ตีความเป็น UTC แบบเดียวกับ extract(epoch ...) ใน SQL
+
+QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE_ENABLED", "1") == "1"
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+QUERY_CACHE_MAX_AGE = float(os.getenv("QUERY_CACHE_MAX_AGE", 300))
+BUCKET_BYTES = 200            # dict slot + key + list 4 ตัว (ประมาณ)
+ENTRY_BYTES = 600
+
+EPOCH = datetime(1970, 1, 1)
+
+log = get_logger("query_cache")
+
+QUERY_CACHE_REQUESTS = REGISTRY.counter(
+    "wise_query_cache_total", "Grafana /query series answered from cache or PostgreSQL", ["result"])
+QUERY_CACHE_BYTES = REGISTRY.gauge(
+    "wise_query_cache_bytes", "Estimated memory held by the /query cache")
+
+
+def utc_seconds(ts):
+    if ts.tzinfo is None:
+        return (ts - EPOCH).total_seconds()
+    return ts.timestamp()
+
+
+def state_value(state, agg):
+    count, total, lo, hi = state
+    if agg == "avg":
+        return total / count if count else None
+    if agg == "min":
+        return lo
+    if agg == "max":
+        return hi
+    if agg == "count":
+        return count
+    return total
+
+
+def merge_state(state, count, total, lo, hi):
+    state[0] += count
+    state[1] += total
+    if lo is not None and (state[2] is None or lo < state[2]):
+        state[2] = lo
+    if hi is not None and (state[3] is None or hi > state[3]):
+        state[3] = hi
+
+
+class CacheEntry:
+    __slots__ = ("key", "first", "buckets", "built", "pending", "seed")
+
+    def __init__(self, key, first):
+        self.key = key                # (table, column, time column, bucket วินาที)
+        self.first = first            # index ของ bucket แรกที่ครบ
+        self.buckets = {}             # index ของ bucket → [count, sum, min, max]
+        self.built = time.monotonic()
+        self.pending = []             # SQL ยังไม่เสร็จ: [(เวลาเริ่ม commit, index, ค่า)] ; None = ครบแล้ว
+        self.seed = None              # (ms, [count, sum, min, max]) ล่าสุดก่อน bucket first (target ที่เติม)
+
+    def size(self):
+        return ENTRY_BYTES + len(self.buckets) * BUCKET_BYTES
+
+
+def state_sql(table, time_col, columns, rollup_table=None):
+    # แถวดิบ → count/sum/min/max ต่อ column ; rollup → รวม state ของ rollup ต่อ field
+    if rollup_table is None:
+        exprs = [column_sql(table, c) for c in columns]
+        select = ", ".join(f"count({c}), sum({c}), min({c}), max({c})" for c in exprs)
+        source, time_col, where = table, time_col, ""
+    else:
+        select = ", ".join(
+            f"sum(count) FILTER (WHERE field = '{c}'), sum(sum) FILTER (WHERE field = '{c}'), "
+            f"min(min) FILTER (WHERE field = '{c}'), max(max) FILTER (WHERE field = '{c}')"
+            for c in columns
+        )
+        fields = ", ".join(f"'{c}'" for c in columns)
+        source, time_col, where = rollup_table, "bucket", f"AND field IN ({fields})"
+    return f"""
+        SELECT
+            floor(extract(epoch FROM {time_col}) / %(bucket)s) AS bucket,
+            {select}
+        FROM {source}
+        WHERE {time_col} >= %(start)s AND {time_col} < %(end)s {where}
+        GROUP BY 1
+    """
+
+
+class QueryPlan:
+    # ผลของ QueryCache.plan(): SQL ที่ยังต้องยิง (เฉพาะ series ที่ไม่อยู่ใน cache) + วิธีประกอบ response
+    def __init__(self, cache, order, series, queries, fills=None):
+        self.cache = cache
+        self.order = order
+        self.fills = fills or {}      # ชื่อ target → "step" / "linear" (compression.py)
+        self.series = series          # [(ชื่อ target, agg, entry, index แรก, index สุดท้าย)]
+        self.queries = queries        # [(sql, params, [entry ต่อ column], seed query?)]
+
+    def finish(self, results, snapshots):
+        # results = rows ของแต่ละ query ตามลำดับ self.queries
+        # snapshots = time.monotonic() ก่อน execute ของแต่ละ query (snapshot ของ SQL)
+        with self.cache.lock:
+            for (_, _, entries, seed), rows, snapshot_at in zip(self.queries, results, snapshots):
+                if seed:
+                    self.cache.seed(entries, rows)
+                    continue
+                for row in rows:
+                    idx = int(row[0])
+                    for i, entry in enumerate(entries):
+                        count, total, lo, hi = row[1 + i * 4: 5 + i * 4]
+                        if not count or idx < entry.first:
+                            continue
+                        state = entry.buckets.setdefault(idx, [0, 0.0, None, None])
+                        merge_state(state, int(count), float(total), float(lo), float(hi))
+                for entry in entries:
+                    self.cache.settle(entry, snapshot_at)
+            out = {name: self.cache.datapoints(entry, agg, first, last)
+                   for name, agg, entry, first, last in self.series}
+            seeds = {name: [state_value(entry.seed[1], agg), entry.seed[0]]
+                     for name, agg, entry, _, _ in self.series if name in self.fills and entry.seed}
+            self.cache.evict()
+        for name, _, entry, first, last in self.series:
+            if name in self.fills:
+                out[name] = fill_datapoints(out[name], self.fills[name], first, last, entry.key[3], seeds.get(name))
+        return grafana_response(self.order, out)
+
+    def fail(self):
+        self.cache.discard(entries for _, _, entries, _ in self.queries)
+
+
+class QueryCache:
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, max_age=QUERY_CACHE_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()      # key → CacheEntry (ท้าย = ใช้ล่าสุด)
+        self.by_table = {}                # table → {key}
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "extended_rows": 0, "evictions": 0, "expired": 0,
+                      "invalidated": 0}
+        QUERY_CACHE_BYTES.set_function(lambda: self.bytes)
+
+    # ---------------------------
+    # Read side
+    # ---------------------------
+    def plan(self, req, targets, rollups=None, fills=None):
+        start, end, bucket_s = query_window(req)
+        order, by_table = group_targets(req, targets)
+        series, queries = [], []
+        now = time.monotonic()
+        with self.lock:
+            for (table, time_col), group in by_table.items():
+                rollup_table, bucket, _ = query_source(table, group, start, bucket_s, rollups)
+                first = math.floor(utc_seconds(start) / bucket)
+                last = math.ceil(utc_seconds(end) / bucket)
+                missing, seeded = {}, {}
+                for name, column, agg in group:
+                    key = (table, column, time_col, bucket)
+                    entry = self.entries.get(key)
+                    if entry is not None and now - entry.built > self.max_age:
+                        self._remove(key)
+                        self.stats["expired"] += 1
+                        entry = None
+                    if entry is not None and entry.pending is None and first >= entry.first:
+                        self.entries.move_to_end(key)
+                        self._trim(entry, first)
+                        self.stats["hits"] += 1
+                        QUERY_CACHE_REQUESTS.inc("hit")
+                    elif column in missing:
+                        entry = missing[column]
+                    else:
+                        entry = missing[column] = self._add(CacheEntry(key, first))
+                        if fills and name in fills:
+                            seeded[column] = entry
+                        self.stats["misses"] += 1
+                        QUERY_CACHE_REQUESTS.inc("miss")
+                    series.append((name, agg, entry, first, last))
+                if missing:
+                    # ถึงปัจจุบันเสมอ (ไม่ใช่แค่ end ของ request) → refresh ถัดไปตอบจาก cache ได้
+                    params = {
+                        "bucket": bucket,
+                        "start": EPOCH + timedelta(seconds=first * bucket),
+                        "end": max(end, datetime.now(timezone.utc)),
+                    }
+                    queries.append((state_sql(table, time_col, list(missing), rollup_table), params,
+                                    list(missing.values()), False))
+                if seeded:
+                    params = {"start": EPOCH + timedelta(seconds=first * bucket)}
+                    queries.append((seed_sql(table, list(seeded), time_col), params, list(seeded.values()), True))
+        return QueryPlan(self, order, series, queries, fills)
+
+    def query(self, db, req, targets, rollups=None, fills=None):
+        plan = self.plan(req, targets, rollups, fills)
+        if not plan.queries:
+            return plan.finish([], [])
+        results, snapshots = [], []
+        try:
+            with db.connection() as conn:
+                for sql, params, *_ in plan.queries:
+                    with conn.cursor() as cursor:
+                        snapshots.append(time.monotonic())
+                        cursor.execute(sql, params)
+                        results.append(cursor.fetchall())
+                conn.rollback()
+        except Exception:
+            plan.fail()
+            raise
+        return plan.finish(results, snapshots)
+
+    def datapoints(self, entry, agg, first, last):
+        # เวลาของ bucket แปลงแบบเดียวกับ bucketed_results (datetime ไม่มี timezone → timestamp())
+        bucket = entry.key[3]
+        points = []
+        for idx in sorted(i for i in entry.buckets if first <= i < last):
+            value = state_value(entry.buckets[idx], agg)
+            if value is not None:
+                ts = EPOCH + timedelta(seconds=idx * bucket)
+                points.append([float(value), int(ts.timestamp() * 1000)])
+        return points
+
+    # ---------------------------
+    # Write side (BatchWriter หลัง commit)
+    # ---------------------------
+    def apply(self, table, rows, committed_at):
+        # committed_at = time.monotonic() ก่อน commit ของ rows
+        keys = self.by_table.get(table)
+        if not keys:
+            return
+        with self.lock:
+            for key in list(keys):
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                _, column, time_col, bucket = key
+                added = 0
+                for row in rows:
+                    ts = row.get(time_col)
+                    v = to_number(row.get(column))
+                    if ts is None or v is None or math.isnan(v):
+                        continue
+                    idx = math.floor(utc_seconds(ts) / bucket)
+                    if idx < entry.first:
+                        continue
+                    if entry.pending is not None:
+                        entry.pending.append((committed_at, idx, v))
+                    else:
+                        self._sample(entry, idx, v)
+                    added += 1
+                self.stats["extended_rows"] += added
+
+    def seed(self, entries, rows):
+        # เรียกโดยถือ lock อยู่แล้ว ; rows ของ seed_sql → seed ของ entry ตาม column
+        by_column = {entry.key[1]: entry for entry in entries}
+        for column, (value, ms) in seed_points(rows).items():
+            by_column[column].seed = (ms, [1, value, value, value])
+
+    def settle(self, entry, snapshot_at):
+        # เรียกโดยถือ lock อยู่แล้ว หลัง merge ผล SQL ของ entry
+        for committed_at, idx, v in entry.pending or ():
+            if committed_at >= snapshot_at and idx >= entry.first:
+                self._sample(entry, idx, v)
+        entry.pending = None
+
+    def _sample(self, entry, idx, v):
+        state = entry.buckets.get(idx)
+        if state is None:
+            entry.buckets[idx] = [1, v, v, v]
+            self.bytes += BUCKET_BYTES
+        else:
+            merge_state(state, 1, v, v, v)
+
+    def invalidate(self, table):
+        # แถวเดิมถูกแทนค่า (ON CONFLICT DO UPDATE) → entry ของ table นี้ query ใหม่ครั้งหน้า
+        with self.lock:
+            for key in list(self.by_table.get(table, ())):
+                self._remove(key)
+                self.stats["invalidated"] += 1
+
+    # ---------------------------
+    # LRU / memory cap
+    # ---------------------------
+    def _add(self, entry):
+        self._remove(entry.key)
+        self.entries[entry.key] = entry
+        self.by_table.setdefault(entry.key[0], set()).add(entry.key)
+        self.bytes += entry.size()
+        return entry
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.by_table.get(key[0], set()).discard(key)
+            self.bytes -= entry.size()
+
+    def _trim(self, entry, first):
+        if first <= entry.first:
+            return
+        dropped = [i for i in entry.buckets if i < first]
+        if dropped:
+            idx = max(dropped)
+            entry.seed = (bucket_ms(idx, entry.key[3]), entry.buckets[idx])
+        for idx in dropped:
+            del entry.buckets[idx]
+            self.bytes -= BUCKET_BYTES
+        entry.first = first
+
+    def evict(self):
+        # เรียกโดยถือ lock อยู่แล้ว; ไม่ทิ้ง entry ล่าสุด (เพิ่งตอบ request นี้)
+        self.bytes = sum(e.size() for e in self.entries.values())
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            self.by_table.get(key[0], set()).discard(key)
+            self.bytes -= entry.size()
+            self.stats["evictions"] += 1
+
+    def discard(self, groups):
+        with self.lock:
+            for entries in groups:
+                for entry in entries:
+                    if self.entries.get(entry.key) is entry:
+                        self._remove(entry.key)
+
+    def snapshot(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else None,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
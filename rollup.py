@@ -0,0 +1,357 @@
+import argparse
+import math
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+import psycopg2
+from psycopg2.extras import execute_values
+from db import DatabaseUnavailable
+from history import to_number
+from io_mask import column_sql
+from log import get_logger, setup_logging
+
+# ---------------------------
+# Rollup tables (1 นาที / 1 ชั่วโมง)
+# ---------------------------
+# ทุก table ที่อยู่ใน "grafana" ของ device map มี rollup <table>_1m / <table>_1h แบบ long format:
+#   (bucket, device, field) → count, sum, min, max, last, last_ts      avg = sum / count
+# BatchWriter รวมค่าใน batch ต่อ bucket ด้วย Python แล้ว upsert ใน transaction เดียวกับแถวดิบ
+#   ON CONFLICT → count/sum บวกเพิ่ม, min/max เทียบ, last ใช้ค่าที่ last_ts ใหม่กว่า
+# → ไม่ต้อง recompute, ข้อมูลที่มาช้า (timestamp เก่า) ก็ลง bucket ของมันเองและแก้ค่า bucket นั้น
+# แถวดิบที่ ON CONFLICT DO UPDATE ทับแถวเดิม → บวกเพิ่มไม่ได้ (นับซ้ำ) → recompute ช่วง bucket นั้นจากแถวดิบ
+# /query เลือก resolution ที่หยาบที่สุดที่ยัง <= bucket ที่ Grafana ขอ (grafana.py)
+#
+# device = ค่าของ "device_column" ใน device map (ไม่มี = '' รวมทุก device)
+# ข้อมูลเก่าก่อนเปิดใช้: python rollup.py backfill devices/all.json --since 2025-01-01
+#
+# ROLLUP_WATERMARKS: rollup table → covered_since = bucket แรกที่ rollup มีข้อมูลครบ
+#   batch แรกที่สร้าง rollup → bucket ถัดจากแถวแรกของ batch (bucket นั้นขาดแถวดิบที่เขียนก่อนหน้า)
+#   backfill → ลดลงเป็น --since (ไม่ใส่ = ทั้ง table → datetime.min)
+# /query ที่ range.from เก่ากว่า covered_since อ่านแถวดิบแทน (rollup ที่ยังไม่ backfill ไม่ทำให้ panel ว่าง)
+# ตอน start โหลด watermark → rollup ที่มีอยู่แล้วไม่ต้อง CREATE TABLE IF NOT EXISTS ซ้ำทุก restart
+
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "1") == "1"
+ROLLUP_RESOLUTIONS = (("1m", 60), ("1h", 3600))
+ROLLUP_WATERMARKS = os.getenv("ROLLUP_WATERMARKS", "iotdata.rollup_watermarks")
+
+log = get_logger("rollup")
+
+
+def watermark_ddl():
+    return [
+        f"CREATE SCHEMA IF NOT EXISTS {ROLLUP_WATERMARKS.rpartition('.')[0] or 'public'}",
+        f"CREATE TABLE IF NOT EXISTS {ROLLUP_WATERMARKS} "
+        f"(rollup_table VARCHAR(200) PRIMARY KEY, covered_since TIMESTAMP NOT NULL)",
+    ]
+
+
+def watermark_sql(lower=False):
+    # lower = backfill (ขยายช่วงที่ครอบคลุมลงไป), ไม่งั้นตั้งครั้งแรกเท่านั้น
+    action = "UPDATE SET covered_since = LEAST(w.covered_since, EXCLUDED.covered_since)" if lower else "NOTHING"
+    return (f"INSERT INTO {ROLLUP_WATERMARKS} AS w (rollup_table, covered_since) VALUES (%(table)s, %(since)s) "
+            f"ON CONFLICT (rollup_table) DO {action}")
+
+
+def as_utc(ts):
+    # TIMESTAMP (naive) ของ table = UTC เหมือน query_cache.utc_seconds
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+def truncate(ts, seconds):
+    # ตัด datetime ลง bucket (seconds ต้องหาร 1 วันลงตัว)
+    if seconds == 60:
+        return ts.replace(second=0, microsecond=0)
+    if seconds == 3600:
+        return ts.replace(minute=0, second=0, microsecond=0)
+    secs = ts.hour * 3600 + ts.minute * 60 + ts.second
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(seconds=secs - secs % seconds)
+
+
+class Rollup:
+    def __init__(self, table, time_column, fields, device_column=None, resolutions=ROLLUP_RESOLUTIONS):
+        self.table = table
+        self.time_column = time_column
+        self.fields = list(fields)
+        self.device_column = device_column
+        self.resolutions = list(resolutions)
+
+    def table_for(self, suffix):
+        return f"{self.table}_{suffix}"
+
+    def ddl(self):
+        return [
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.table_for(suffix)} (
+                bucket TIMESTAMP NOT NULL,
+                device VARCHAR(50) NOT NULL DEFAULT '',
+                field VARCHAR(50) NOT NULL,
+                count BIGINT NOT NULL,
+                sum DOUBLE PRECISION NOT NULL,
+                min DOUBLE PRECISION,
+                max DOUBLE PRECISION,
+                last DOUBLE PRECISION,
+                last_ts TIMESTAMP,
+                PRIMARY KEY (bucket, device, field)
+            )"""
+            for suffix, _ in self.resolutions
+        ]
+
+    def aggregate(self, rows):
+        # → {suffix: {(bucket, device, field): [count, sum, min, max, last, last_ts]}}
+        out = {suffix: {} for suffix, _ in self.resolutions}
+        time_col, device_col = self.time_column, self.device_column
+        for row in rows:
+            ts = row.get(time_col)
+            if ts is None:
+                continue
+            device = str(row.get(device_col) or "") if device_col else ""
+            for field in self.fields:
+                v = to_number(row.get(field))
+                if v is None or math.isnan(v):
+                    continue
+                for suffix, seconds in self.resolutions:
+                    key = (truncate(ts, seconds), device, field)
+                    acc = out[suffix].get(key)
+                    if acc is None:
+                        out[suffix][key] = [1, v, v, v, v, ts]
+                        continue
+                    acc[0] += 1
+                    acc[1] += v
+                    if v < acc[2]:
+                        acc[2] = v
+                    if v > acc[3]:
+                        acc[3] = v
+                    if ts >= acc[5]:
+                        acc[4], acc[5] = v, ts
+        return out
+
+    def statements(self, rows):
+        # → [(sql, template, values)] สำหรับ execute_values / insert_values (async)
+        stmts = []
+        for suffix, buckets in self.aggregate(rows).items():
+            if not buckets:
+                continue
+            sql = f"""
+                INSERT INTO {self.table_for(suffix)} AS r (bucket, device, field, count, sum, min, max, last, last_ts)
+                VALUES %s
+                ON CONFLICT (bucket, device, field) DO UPDATE SET
+                    count = r.count + EXCLUDED.count,
+                    sum = r.sum + EXCLUDED.sum,
+                    min = LEAST(r.min, EXCLUDED.min),
+                    max = GREATEST(r.max, EXCLUDED.max),
+                    last = CASE WHEN EXCLUDED.last_ts >= r.last_ts THEN EXCLUDED.last ELSE r.last END,
+                    last_ts = GREATEST(r.last_ts, EXCLUDED.last_ts)
+            """
+            values = [(b, d, f, *acc) for (b, d, f), acc in buckets.items()]
+            stmts.append((sql, "(%s, %s, %s, %s, %s, %s, %s, %s, %s)", values))
+        return stmts
+
+    def watermarks(self, rows):
+        # batch แรกของ rollup → {rollup table: bucket ถัดจากแถวที่เก่าที่สุด}
+        times = [row[self.time_column] for row in rows if row.get(self.time_column) is not None]
+        if not times:
+            return {}
+        first = min(as_utc(ts).astimezone(timezone.utc).replace(tzinfo=None) for ts in times)
+        return {self.table_for(suffix): truncate(first, seconds) + timedelta(seconds=seconds)
+                for suffix, seconds in self.resolutions}
+
+    def refresh_statements(self, rows):
+        # แถวดิบที่ถูกแทนค่า → recompute ทุก bucket ตั้งแต่ bucket ของแถวแรกถึงแถวสุดท้าย
+        times = [row[self.time_column] for row in rows if row.get(self.time_column) is not None]
+        if not times:
+            return []
+        stmts = []
+        for suffix, seconds in self.resolutions:
+            params = {"since": truncate(min(times), seconds),
+                      "until": truncate(max(times), seconds) + timedelta(seconds=seconds)}
+            stmts += [(sql, params, None) for sql in self.backfill_sql(suffix, seconds, since=True, until=True)]
+        return stmts
+
+    def backfill_sql(self, suffix, seconds, since=None, until=None):
+        # recompute จากแถวดิบ (แทนค่าเดิมใน bucket) — 1 statement ต่อ field
+        unit = {60: "minute", 3600: "hour"}.get(seconds)
+        if unit:
+            bucket = f"date_trunc('{unit}', {self.time_column})"
+        else:
+            bucket = (f"timestamp 'epoch' + floor(extract(epoch FROM {self.time_column}) / {seconds}) * {seconds}"
+                      f" * interval '1 second'")
+        device = f"coalesce({self.device_column}::text, '')" if self.device_column else "''"
+        where = f"AND {self.time_column} >= %(since)s" if since else ""
+        if until:
+            where += f" AND {self.time_column} < %(until)s"
+        for field in self.fields:
+            value = f"({column_sql(self.table, field)})::double precision"
+            yield f"""
+                INSERT INTO {self.table_for(suffix)} AS r (bucket, device, field, count, sum, min, max, last, last_ts)
+                SELECT {bucket}, {device}, '{field}', count({value}), sum({value}), min({value}), max({value}),
+                       (array_agg({value} ORDER BY {self.time_column} DESC))[1], max({self.time_column})
+                FROM {self.table}
+                WHERE {value} IS NOT NULL AND {self.time_column} IS NOT NULL {where}
+                GROUP BY 1, 2
+                ON CONFLICT (bucket, device, field) DO UPDATE SET
+                    count = EXCLUDED.count, sum = EXCLUDED.sum, min = EXCLUDED.min, max = EXCLUDED.max,
+                    last = EXCLUDED.last, last_ts = EXCLUDED.last_ts
+            """
+
+
+class RollupSet:
+    def __init__(self, rollups=()):
+        self.rollups = {r.table: r for r in rollups}
+        self.created = set()      # table ที่ CREATE TABLE rollup + watermark แล้ว (หลัง commit / load)
+        self.covered = {}         # rollup table → covered_since (ROLLUP_WATERMARKS)
+        self.pending = {}         # table → watermark ของ batch แรกที่ยังไม่ commit
+        self.stats = {"rows": 0, "buckets": 0, "refreshed_rows": 0, "errors": 0, "raw_fallbacks": 0}
+
+    @classmethod
+    def from_device_map(cls, device_map):
+        rollups = []
+        for source in device_map.get("grafana", []):
+            if source.get("rollup", True):
+                rollups.append(Rollup(
+                    source["table"], source.get("time_column", "timestamp"), source["targets"],
+                    source.get("device_column"),
+                ))
+        return cls(rollups)
+
+    def get(self, table):
+        return self.rollups.get(table)
+
+    def load(self, db):
+        # ตอน start: watermark ที่มีอยู่ → rollup ไหนสร้างแล้ว / ครอบคลุมตั้งแต่เมื่อไร
+        if not self.rollups:
+            return self
+        try:
+            with db.connection() as conn:
+                with conn.cursor() as cursor:
+                    for sql in watermark_ddl():
+                        cursor.execute(sql)
+                    cursor.execute(f"SELECT rollup_table, covered_since FROM {ROLLUP_WATERMARKS}")
+                    covered = dict(cursor.fetchall())
+                conn.commit()
+        except (DatabaseUnavailable, psycopg2.Error) as e:
+            log.error("❌ Cannot load rollup watermarks, /query reads raw rows until rollups are written: %s", e)
+            return self
+        self.covered.update(covered)
+        for table, rollup in self.rollups.items():
+            if all(rollup.table_for(suffix) in covered for suffix, _ in rollup.resolutions):
+                self.created.add(table)
+        log.info("✅ Loaded rollup watermarks for %d tables", len(self.created))
+        return self
+
+    def statements(self, table, rows, updated=()):
+        # DDL (ครั้งแรกของ table) + upsert ของ batch นี้ + recompute ช่วงของแถวที่ถูกแทนค่า
+        # → [(sql, template, values)] ; values เป็น None = execute(sql, template) (template เป็น params หรือ None)
+        rollup = self.rollups.get(table)
+        if rollup is None:
+            return []
+        stmts = []
+        if table not in self.created:
+            watermarks = rollup.watermarks(rows)
+            if watermarks:
+                self.pending[table] = watermarks
+                stmts = [(sql, None, None) for sql in watermark_ddl() + rollup.ddl()]
+                stmts += [(watermark_sql(), {"table": t, "since": since}, None) for t, since in watermarks.items()]
+            else:
+                stmts = [(sql, None, None) for sql in rollup.ddl()]
+        upserts = rollup.statements(rows)
+        self.stats["rows"] += len(rows)
+        self.stats["buckets"] += sum(len(values) for _, _, values in upserts)
+        refresh = rollup.refresh_statements(updated) if updated else []
+        self.stats["refreshed_rows"] += len(updated)
+        return stmts + upserts + refresh
+
+    def apply(self, cursor, table, rows, updated=()):
+        # เรียกก่อน commit ของ batch แถวดิบ (transaction เดียวกัน)
+        # rollup พัง → rollback แค่ savepoint แถวดิบยัง commit ได้ (แก้ทีหลังด้วย backfill)
+        stmts = self.statements(table, rows, updated)
+        if not stmts:
+            return
+        cursor.execute("SAVEPOINT rollup")
+        try:
+            for sql, template, values in stmts:
+                if values is None:
+                    cursor.execute(sql, template)
+                else:
+                    execute_values(cursor, sql, values, template=template, page_size=len(values))
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except psycopg2.Error as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT rollup")
+            self.failed(table, e)
+
+    def failed(self, table, e):
+        self.pending.pop(table, None)     # DDL / watermark ถูก rollback ไปด้วย → batch หน้าสร้างใหม่
+        self.stats["errors"] += 1
+        log.error("❌ Rollup update failed for %s (run rollup.py backfill to repair): %s", table, e)
+
+    def committed(self, table):
+        watermarks = self.pending.pop(table, None)
+        if watermarks is None:
+            return
+        self.created.add(table)
+        for rollup_table, since in watermarks.items():
+            # ON CONFLICT DO NOTHING: ถ้ามีอยู่แล้ว (load ไม่สำเร็จตอน start) ค่าจริงเก่ากว่า → ค่านี้ระวังกว่า
+            self.covered.setdefault(rollup_table, since)
+
+    def resolution_for(self, table, columns, bucket_s, start=None):
+        # resolution ที่หยาบที่สุดที่ <= bucket ที่ขอ, มีทุก column และครอบคลุมตั้งแต่ start → (rollup table, วินาที)
+        # หรือ None = แถวดิบ (ไม่มี resolution ไหนครอบคลุม start)
+        rollup = self.rollups.get(table)
+        if rollup is None or not set(columns) <= set(rollup.fields):
+            return None
+        fits = sorted((seconds, suffix) for suffix, seconds in rollup.resolutions if seconds <= bucket_s)
+        for seconds, suffix in reversed(fits):
+            since = self.covered.get(rollup.table_for(suffix))
+            if start is None or (since is not None and as_utc(start) >= as_utc(since)):
+                return rollup.table_for(suffix), seconds
+        if fits:
+            self.stats["raw_fallbacks"] += 1
+        return None
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "tables": {t: [r.table_for(s) for s, _ in r.resolutions] for t, r in self.rollups.items()},
+            "covered_since": {t: since.isoformat() for t, since in self.covered.items()},
+        }
+
+
+# ---------------------------
+# CLI: สร้าง table + backfill จากข้อมูลดิบที่มีอยู่แล้ว
+# ---------------------------
+def main():
+    from gateway import Gateway, load_device_map, DEVICE_MAP
+
+    parser = argparse.ArgumentParser(description="Create and backfill rollup tables")
+    parser.add_argument("command", choices=["create", "backfill"])
+    parser.add_argument("device_map", nargs="?", default=DEVICE_MAP)
+    parser.add_argument("--since", help="only recompute buckets from this timestamp (ISO)")
+    args = parser.parse_args()
+
+    setup_logging()
+    gw = Gateway(load_device_map(args.device_map))
+    if not gw.rollups or not gw.rollups.rollups:
+        sys.exit("no rollups configured (grafana sources in the device map)")
+    since = datetime.fromisoformat(args.since) if args.since else None
+    with gw.db.connection(statement_timeout_ms=0) as conn:
+        with conn.cursor() as cursor:
+            for rollup in gw.rollups.rollups.values():
+                for sql in watermark_ddl() + rollup.ddl():
+                    cursor.execute(sql)
+                conn.commit()
+                if args.command != "backfill":
+                    continue
+                for suffix, seconds in rollup.resolutions:
+                    for sql in rollup.backfill_sql(suffix, seconds, since):
+                        cursor.execute(sql, {"since": since})
+                    # ครอบคลุมตั้งแต่ bucket แรกที่ recompute ครบ (ไม่ใส่ --since = ทั้ง table)
+                    covered = truncate(since, seconds) if since else datetime.min
+                    if since and covered < since:
+                        covered += timedelta(seconds=seconds)
+                    cursor.execute(watermark_sql(lower=True), {"table": rollup.table_for(suffix), "since": covered})
+                    conn.commit()
+                    log.info("✅ Backfilled %s", rollup.table_for(suffix))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+import argparse
+import os
+import re
+import sys
+import threading
+from datetime import datetime, timedelta
+import psycopg2
+from db import DatabaseUnavailable
+from decoders import WISE4012_IO_KEYS, WISE4210_IO_KEYS
+from io_mask import view_sql
+from log import get_logger, setup_logging
+
+# ---------------------------
+# Schema manager: table แบบ partition ตามเวลา + index
+# ---------------------------
+# ตอน start gateway สร้าง table ของทุก route ที่ยังไม่มี เป็น declarative range partition ตาม time column
+#   <table>_pYYYYMM (month) หรือ <table>_pYYYYMMDD (day) + <table>_default (timestamp NULL / นอกช่วง)
+# index บน parent (PostgreSQL สร้างให้ทุก partition เอง):
+#   time column → BRIN (ข้อมูลเข้าเรียงตามเวลา, index เล็กมาก) หรือ btree (SCHEMA_INDEX=btree)
+#   device column (ถ้ามี) → btree (device, time)
+# thread "pg-schema" ทุก SCHEMA_INTERVAL วินาที: สร้าง partition ล่วงหน้า SCHEMA_AHEAD ช่วง
+#   และ drop (หรือ detach) partition ที่เก่ากว่า retention → ขนาด partition คงที่, vacuum ไม่โตตามข้อมูล
+#
+# table เดิมที่ไม่ได้ partition: แค่สร้าง index (CONCURRENTLY ไม่ lock การ insert) ไม่แตะข้อมูล
+#   ทำใน thread "pg-schema" ไม่ใช่ตอน start (table ใหญ่ build นานหลายนาที → ไม่ขวาง MQTT / ingest)
+#   index ที่ build CONCURRENTLY ไม่สำเร็จค้างเป็น INVALID (pg_index.indisvalid) → drop แล้ว build ใหม่รอบถัดไป
+#   build ทันทีแบบรอจนเสร็จ: python schema.py maintain devices/all.json
+#   แปลงเป็น partition: python schema.py migrate devices/all.json
+#   (rename เป็น <table>_legacy แล้ว attach เป็น partition ก้อนแรก)
+#
+# ตั้งค่าต่อ table ใน device map:
+#   "tables": {"iotdata.wise2200_data": {"partition": "day", "retention_days": 90, "index": "btree"}}
+
+SCHEMA_ENABLED = os.getenv("SCHEMA_ENABLED", "1") == "1"
+SCHEMA_PARTITION = os.getenv("SCHEMA_PARTITION", "month")          # month | day
+SCHEMA_INDEX = os.getenv("SCHEMA_INDEX", "brin")                    # brin | btree
+SCHEMA_RETENTION_DAYS = int(os.getenv("SCHEMA_RETENTION_DAYS", 0))  # 0 = เก็บตลอด
+SCHEMA_RETENTION_ACTION = os.getenv("SCHEMA_RETENTION_ACTION", "drop")   # drop | detach
+SCHEMA_AHEAD = int(os.getenv("SCHEMA_AHEAD", 3))
+SCHEMA_INTERVAL = float(os.getenv("SCHEMA_INTERVAL", 3600))
+
+log = get_logger("schema")
+
+
+# ---------------------------
+# Column ของแต่ละ decoder (ตรงกับ comment CREATE TABLE ใน decoders.py)
+# ---------------------------
+class TableSchema:
+    __slots__ = ("columns", "time_column", "device_column", "primary_key", "packed")
+
+    def __init__(self, columns, time_column="timestamp", device_column=None, primary_key=None, packed=None):
+        self.columns = columns
+        self.time_column = time_column
+        self.device_column = device_column
+        self.primary_key = primary_key     # ต้องมี time column (partition key) อยู่ด้วย
+        self.packed = packed               # (ช่อง di/do, type เดิม) → view <table>_io (io_mask.py)
+
+
+DECODER_SCHEMAS = {
+    "device_status": TableSchema(
+        "status VARCHAR(50), name VARCHAR(100), macid VARCHAR(50), ipaddr VARCHAR(50), timestamp TIMESTAMP",
+        device_column="macid",
+    ),
+    "wise4012_io": TableSchema(
+        "time TIMESTAMP, s INTEGER, q INTEGER, c INTEGER, "
+        "di1 BOOLEAN, di2 BOOLEAN, di3 BOOLEAN, di4 BOOLEAN, do1 BOOLEAN, do2 BOOLEAN",
+        time_column="time",
+    ),
+    "wise4012_io_packed": TableSchema(
+        "time TIMESTAMP, s INTEGER, q INTEGER, c INTEGER, io SMALLINT",
+        time_column="time", packed=(WISE4012_IO_KEYS, "boolean"),
+    ),
+    "wise4210": TableSchema(
+        "s INTEGER, c INTEGER, q INTEGER, rssi INTEGER, "
+        "di1 INTEGER, di2 INTEGER, di3 INTEGER, di4 INTEGER, di5 INTEGER, di6 INTEGER, "
+        "do1 INTEGER, do2 INTEGER, timestamp TIMESTAMP, temp FLOAT, humidity FLOAT",
+    ),
+    "wise4210_packed": TableSchema(
+        "s INTEGER, c INTEGER, q INTEGER, rssi INTEGER, io SMALLINT, timestamp TIMESTAMP, temp FLOAT, humidity FLOAT",
+        packed=(WISE4210_IO_KEYS, "integer"),
+    ),
+    "ecu1251": TableSchema(
+        "device_id VARCHAR(50), temp NUMERIC, hum NUMERIC, timestamp TIMESTAMP",
+        device_column="device_id", primary_key=("device_id", "timestamp"),
+    ),
+    "wise2200": TableSchema(
+        "temp FLOAT, temp_status INTEGER, humidity FLOAT, humidity_status INTEGER, rssi INTEGER, "
+        "devaddr VARCHAR(50), timestamp TIMESTAMP",
+        device_column="devaddr",
+    ),
+}
+
+# table log ของ /io_log, /sys_log (http_ingest.py) — record ทั้งก้อนเป็น JSONB, partition ตามเวลาที่รับ
+LOG_SCHEMA = TableSchema(
+    "received_at TIMESTAMP, device VARCHAR(100), ts TIMESTAMP, payload JSONB",
+    time_column="received_at", device_column="device",
+)
+
+
+# ---------------------------
+# ช่วงเวลาของ partition
+# ---------------------------
+def period_start(ts, unit):
+    if unit == "day":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_period(start, unit):
+    if unit == "day":
+        return start + timedelta(days=1)
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+
+def period_suffix(start, unit):
+    return start.strftime("%Y%m%d" if unit == "day" else "%Y%m")
+
+
+def parse_suffix(suffix):
+    if len(suffix) == 8:
+        return datetime.strptime(suffix, "%Y%m%d"), "day"
+    return datetime.strptime(suffix, "%Y%m"), "month"
+
+
+def split_table(table):
+    schema, _, name = table.rpartition(".")
+    return schema or "public", name
+
+
+class ManagedTable:
+    def __init__(self, table, schema, partition=SCHEMA_PARTITION, index=SCHEMA_INDEX,
+                 retention_days=SCHEMA_RETENTION_DAYS):
+        self.table = table
+        self.schema = schema
+        self.partition = partition
+        self.index = index
+        self.retention_days = retention_days
+        self.namespace, self.name = split_table(table)
+        self.partition_re = re.compile(re.escape(self.name) + r"_p(\d{6}|\d{8})$", re.IGNORECASE)
+
+    def partition_name(self, start):
+        return f"{self.table}_p{period_suffix(start, self.partition)}"
+
+    def create_sql(self):
+        cols = self.schema.columns
+        if self.schema.primary_key:
+            cols += f", PRIMARY KEY ({', '.join(self.schema.primary_key)})"
+        return (f"CREATE TABLE IF NOT EXISTS {self.table} ({cols}) "
+                f"PARTITION BY RANGE ({self.schema.time_column})")
+
+    def indexes(self):
+        # [(ชื่อ index, method, column)]
+        time_col, device_col = self.schema.time_column, self.schema.device_column
+        method = "brin" if self.index == "brin" else "btree"
+        found = [(f"{self.name}_{time_col}_{method}", method, time_col)]
+        if device_col:
+            found.append((f"{self.name}_{device_col}_{time_col}", "btree", f"{device_col}, {time_col}"))
+        return found
+
+    def index_sql(self, concurrently=False):
+        how = "CONCURRENTLY " if concurrently else ""
+        return [f"CREATE INDEX {how}IF NOT EXISTS {name} ON {self.table} USING {method} ({columns})"
+                for name, method, columns in self.indexes()]
+
+    def partition_sql(self, start):
+        end = next_period(start, self.partition)
+        return (f"CREATE TABLE IF NOT EXISTS {self.partition_name(start)} PARTITION OF {self.table} "
+                f"FOR VALUES FROM ('{start.isoformat(' ')}') TO ('{end.isoformat(' ')}')")
+
+    def default_sql(self):
+        return f"CREATE TABLE IF NOT EXISTS {self.table}_default PARTITION OF {self.table} DEFAULT"
+
+    def expired(self, partitions, now):
+        # partition ที่ช่วงเวลาจบก่อน now - retention ทั้งช่วง
+        if not self.retention_days:
+            return []
+        cutoff = now - timedelta(days=self.retention_days)
+        old = []
+        for name in partitions:
+            m = self.partition_re.match(name)
+            if not m:
+                continue
+            start, unit = parse_suffix(m.group(1))
+            if next_period(start, unit) <= cutoff:
+                old.append(f"{self.namespace}.{name}")
+        return sorted(old)
+
+
+class SchemaManager:
+    def __init__(self, tables=(), ahead=SCHEMA_AHEAD, interval=SCHEMA_INTERVAL,
+                 retention_action=SCHEMA_RETENTION_ACTION):
+        self.tables = {t.table: t for t in tables}
+        self.ahead = ahead
+        self.interval = interval
+        self.retention_action = retention_action
+        self.stats = {"runs": 0, "created_tables": 0, "created_partitions": 0, "dropped_partitions": 0,
+                      "errors": 0, "failed_tables": {}, "unpartitioned": [], "built_indexes": 0,
+                      "rebuilt_indexes": 0, "last_run": None}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_device_map(cls, device_map, extra=()):
+        # table ของทุก route ที่ decoder มี schema (+ extra = [(table, TableSchema)]) → ตั้งค่าเพิ่มได้ใน "tables"
+        options = device_map.get("tables", {})
+        tables = []
+        seen = set()
+        sources = [(e.get("table"), DECODER_SCHEMAS.get(e["decoder"])) for e in device_map["routes"]]
+        for table, schema in sources + list(extra):
+            if not table or schema is None or table in seen:
+                continue
+            seen.add(table)
+            opts = options.get(table, {})
+            tables.append(ManagedTable(
+                table, schema,
+                partition=opts.get("partition", SCHEMA_PARTITION),
+                index=opts.get("index", SCHEMA_INDEX),
+                retention_days=int(opts.get("retention_days", SCHEMA_RETENTION_DAYS)),
+            ))
+        return cls(tables)
+
+    # ---------------------------
+    # Maintenance
+    # ---------------------------
+    def start(self, db):
+        # รอบแรกทำทันที (table ต้องมีก่อน insert แรก) แล้วค่อยทำซ้ำใน thread
+        # index ของ table เดิมที่ไม่ได้ partition → รอบแรกของ thread (ไม่ขวาง start)
+        try:
+            self.maintain(db, build_indexes=False)
+        except (DatabaseUnavailable, psycopg2.Error) as e:
+            self.stats["errors"] += 1
+            log.error("❌ Schema maintenance failed, will retry: %s", e)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(db,), name="pg-schema", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, db):
+        wait = 0 if self.stats["unpartitioned"] else self.interval
+        while not self._stop.wait(wait):
+            wait = self.interval
+            try:
+                self.maintain(db)
+            except Exception as e:
+                self.stats["errors"] += 1
+                log.error("❌ Schema maintenance failed: %s", e)
+
+    def maintain(self, db, now=None, build_indexes=True):
+        # table ที่พัง (เช่น แถวค้างใน <table>_default ชน partition ใหม่, lock timeout) → rollback แล้วทำ table ถัดไป
+        # connection เสีย → หยุดทั้งรอบ (table ถัดไปก็ทำไม่ได้) แล้วลองใหม่รอบหน้า
+        now = now or datetime.utcnow()
+        with db.connection(statement_timeout_ms=0) as conn:
+            for t in self.tables.values():
+                try:
+                    self.maintain_table(conn, t, now, build_indexes)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    self.stats["errors"] += 1
+                    self.stats["failed_tables"][t.table] = str(e).strip()
+                    log.error("❌ Schema maintenance of %s failed, continuing: %s", t.table, e)
+                else:
+                    self.stats["failed_tables"].pop(t.table, None)
+        self.stats["runs"] += 1
+        self.stats["last_run"] = now.isoformat()
+
+    def maintain_table(self, conn, t, now, build_indexes=True):
+        kind = self.relkind(conn, t)
+        if kind is None:
+            self.create(conn, t)
+            kind = "p"
+        if kind != "p":
+            if t.table not in self.stats["unpartitioned"]:
+                self.stats["unpartitioned"].append(t.table)
+                log.warning("⚠️ %s is not partitioned (python schema.py migrate to convert), indexing only", t.table)
+            if build_indexes:
+                self.index_plain(conn, t)
+            return
+        self.create_partitions(conn, t, now)
+        self.expire(conn, t, now)
+
+    def relkind(self, conn, t):
+        # 'p' = partitioned, 'r' = table ธรรมดา, None = ยังไม่มี
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname = %s AND c.relname = %s", (t.namespace, t.name.lower()))
+            row = cursor.fetchone()
+        conn.rollback()
+        return row[0] if row else None
+
+    def create(self, conn, t):
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {t.namespace}")
+            cursor.execute(t.create_sql())
+            cursor.execute(t.default_sql())
+            for sql in t.index_sql():
+                cursor.execute(sql)
+            if t.schema.packed:
+                cursor.execute(view_sql(t.table, *t.schema.packed))
+        conn.commit()
+        self.stats["created_tables"] += 1
+        log.info("🗂️ Created partitioned table %s (%s, %s index)", t.table, t.partition, t.index)
+
+    def index_plain(self, conn, t):
+        # table เดิม (ไม่ partition): CREATE INDEX CONCURRENTLY ต้องอยู่นอก transaction
+        # build พัง (deadlock, unique, ยกเลิก) → index ค้างเป็น INVALID, IF NOT EXISTS จะข้ามไปเฉยๆ
+        #   → เช็ค indisvalid ก่อน, INVALID = drop แล้ว build ใหม่
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for (name, _, _), sql in zip(t.indexes(), t.index_sql(concurrently=True)):
+                    valid = self.index_valid(cursor, t, name)
+                    if valid:
+                        continue
+                    if valid is False:
+                        log.warning("⚠️ Index %s on %s is INVALID, rebuilding", name, t.table)
+                        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {t.namespace}.{name}")
+                        self.stats["rebuilt_indexes"] += 1
+                    log.info("🗂️ Building index %s on %s (CONCURRENTLY)", name, t.table)
+                    cursor.execute(sql)
+                    self.stats["built_indexes"] += 1
+        finally:
+            conn.autocommit = False
+
+    def index_valid(self, cursor, t, name):
+        # True / False (INVALID) / None = ยังไม่มี
+        cursor.execute(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = %s AND c.relname = %s",
+            (t.namespace, name.lower()))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def partitions(self, conn, t):
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass", (t.table,))
+            names = [r[0] for r in cursor.fetchall()]
+        conn.rollback()
+        return names
+
+    def legacy_bound(self, conn, t):
+        # ขอบบนของ <table>_legacy (หลัง migrate) → ห้ามสร้าง partition ที่ทับช่วงนั้น
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_class c "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = %s AND c.relname = %s",
+                (t.namespace, f"{t.name}_legacy".lower()))
+            row = cursor.fetchone()
+        conn.rollback()
+        m = re.search(r"TO \('([^']+)'\)", row[0] or "") if row else None
+        return datetime.fromisoformat(m.group(1)) if m else None
+
+    def create_partitions(self, conn, t, now):
+        existing = {name.lower() for name in self.partitions(conn, t)}
+        legacy = self.legacy_bound(conn, t)
+        start = period_start(now, t.partition)
+        created = 0
+        with conn.cursor() as cursor:
+            for _ in range(self.ahead + 1):
+                name = t.partition_name(start).rpartition(".")[2].lower()
+                if name not in existing and (legacy is None or start >= legacy):
+                    cursor.execute(t.partition_sql(start))
+                    created += 1
+                start = next_period(start, t.partition)
+        conn.commit()
+        if created:
+            self.stats["created_partitions"] += created
+            log.info("🗂️ Created %d partitions of %s", created, t.table)
+
+    def expire(self, conn, t, now):
+        old = t.expired(self.partitions(conn, t), now)
+        if not old:
+            return
+        with conn.cursor() as cursor:
+            for name in old:
+                if self.retention_action == "detach":
+                    cursor.execute(f"ALTER TABLE {t.table} DETACH PARTITION {name}")
+                else:
+                    cursor.execute(f"DROP TABLE {name}")
+        conn.commit()
+        self.stats["dropped_partitions"] += len(old)
+        log.info("🧹 %s %d partitions of %s older than %d days",
+                 "Detached" if self.retention_action == "detach" else "Dropped", len(old), t.table, t.retention_days)
+
+    # ---------------------------
+    # Migration: table ธรรมดา → partitioned (ข้อมูลเดิมเป็น partition <table>_legacy)
+    # ---------------------------
+    def migrate(self, conn, t, now=None):
+        now = now or datetime.utcnow()
+        time_col = t.schema.time_column
+        legacy = f"{t.table}_legacy"
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT max({time_col}) FROM {t.table}")
+            newest = cursor.fetchone()[0]
+            bound = next_period(period_start(newest, t.partition), t.partition) if newest else \
+                period_start(now, t.partition)
+            cursor.execute(f"ALTER TABLE {t.table} RENAME TO {t.name}_legacy")
+            cursor.execute(t.create_sql())
+            cursor.execute(t.default_sql())
+            # แถว timestamp NULL อยู่ใน range partition ไม่ได้ → ย้ายไป default
+            cursor.execute(f"INSERT INTO {t.table}_default SELECT * FROM {legacy} WHERE {time_col} IS NULL")
+            cursor.execute(f"DELETE FROM {legacy} WHERE {time_col} IS NULL")
+            cursor.execute(f"ALTER TABLE {t.table} ATTACH PARTITION {legacy} "
+                           f"FOR VALUES FROM (MINVALUE) TO ('{bound.isoformat(' ')}')")
+            for sql in t.index_sql():
+                cursor.execute(sql)
+        conn.commit()
+        log.info("🗂️ Migrated %s → partitioned (old rows in %s up to %s)", t.table, legacy, bound)
+        self.create_partitions(conn, t, now)
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "tables": {
+                name: {"partition": t.partition, "index": t.index, "retention_days": t.retention_days}
+                for name, t in self.tables.items()
+            },
+        }
+
+
+# ---------------------------
+# CLI
+# ---------------------------
+def main():
+    from gateway import Gateway, load_device_map, DEVICE_MAP
+
+    parser = argparse.ArgumentParser(description="Create / maintain / migrate partitioned tables")
+    parser.add_argument("command", choices=["maintain", "migrate"])
+    parser.add_argument("device_map", nargs="?", default=DEVICE_MAP)
+    parser.add_argument("--table", action="append", help="only these tables (migrate)")
+    args = parser.parse_args()
+
+    setup_logging()
+    gw = Gateway(load_device_map(args.device_map))
+    manager = gw.schema or SchemaManager.from_device_map(gw.device_map)
+    if args.command == "maintain":
+        manager.maintain(gw.db)
+        return
+    with gw.db.connection(statement_timeout_ms=0) as conn:
+        for t in manager.tables.values():
+            if args.table and t.table not in args.table:
+                continue
+            if manager.relkind(conn, t) != "r":
+                log.info("%s: nothing to migrate", t.table)
+                continue
+            manager.migrate(conn, t)
+    if not manager.tables:
+        sys.exit("no tables in the device map")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+import io
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import psycopg2
+from psycopg2.extras import execute_values
+from db import DatabaseUnavailable
+from pg_writer import insert_sql, collapse, returned_rows
+from log import get_logger
+from metrics import REGISTRY
+
+# ---------------------------
+# Disk spool (write-ahead) สำหรับช่วงที่ PostgreSQL ล่ม / ช้า
+# ---------------------------
+# BatchWriter insert ไม่ได้ (DatabaseUnavailable / connection error) หรือคิวเต็ม → append แถวลง spool แทนการทิ้ง
+# แล้ว thread "pg-spool" จะ replay กลับเข้า PostgreSQL ด้วย COPY (ครั้งละ SPOOL_REPLAY_BATCH แถว,
+# เก่าสุดก่อน, ไม่เกิน SPOOL_REPLAY_RATE แถว/วินาที) เมื่อ database กลับมา
+#
+# โครงสร้างไฟล์: SPOOL_DIR/<table>/<seq>.seg  (seq เรียงทั้ง spool → replay ตามลำดับเวลาที่เขียน)
+#   record = <uint32 length><uint32 crc32><pickle>
+#   record แรกของ segment = tuple ของ column, ที่เหลือ = tuple ค่าของ 1 แถว
+#   <seq>.pos = offset ที่ commit แล้ว (replay ต่อจากเดิมได้หลัง restart ไม่ insert ซ้ำ)
+# segment ที่ replay ครบแล้วจะถูกลบทิ้ง, record ท้ายไฟล์ที่เขียนไม่ครบ (process ตาย) จะถูกข้าม
+# ถ้ามี rollups (rollup.py) แถวที่ replay จะ upsert rollup ใน transaction เดียวกับ COPY ด้วย
+# table ที่มี conflict key (BatchWriter.register) → replay ด้วย INSERT ... ON CONFLICT เดียวกับ writer แทน COPY
+#   (ข้อมูลที่ส่งซ้ำหลัง outage ไม่ทำให้ทั้ง batch พังแล้วต้องไล่ทีละแถว)
+# ถ้ามี cache (query_cache.py) แถวที่ replay แล้วถูกบวกเข้า /query cache แบบเดียวกับ writer (แถวที่ทับของเดิม → invalidate)
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_ENABLED = os.getenv("SPOOL_ENABLED", "1") == "1"
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024))
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", 5000))
+SPOOL_REPLAY_RATE = float(os.getenv("SPOOL_REPLAY_RATE", 20000))   # แถว/วินาที, 0 = ไม่จำกัด
+SPOOL_REPLAY_INTERVAL = float(os.getenv("SPOOL_REPLAY_INTERVAL", 5))
+
+HEADER = struct.Struct("<II")
+
+log = get_logger("spool")
+
+SPOOL_ROWS = REGISTRY.counter(
+    "wise_spool_rows_total", "Rows written to / replayed from the disk spool", ["table", "action"])
+SPOOL_BYTES = REGISTRY.gauge(
+    "wise_spool_bytes", "Bytes waiting in the disk spool")
+
+
+def encode_record(obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def read_records(f):
+    # yield (offset หลัง record, obj) จนจบไฟล์หรือเจอ record ที่เสีย
+    while True:
+        head = f.read(HEADER.size)
+        if len(head) < HEADER.size:
+            return
+        length, crc = HEADER.unpack(head)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(data) != crc:
+            log.warning("⚠️ Spool: truncated/corrupt record in %s at %d, skipping rest", f.name, f.tell())
+            return
+        yield f.tell(), pickle.loads(data)
+
+
+def copy_field(v, tz=timezone.utc):
+    # COPY csv: ช่องว่างไม่มี quote = NULL, string อื่น quote เสมอ ("" = string ว่าง)
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return "t" if v else "f"
+    if isinstance(v, (int, float)):
+        return repr(v)
+    if isinstance(v, datetime) and v.tzinfo is not None:
+        # column TIMESTAMP ทิ้ง offset ใน text ของ COPY เฉยๆ แต่ writer ส่งเป็น timestamptz แล้ว cast ด้วย
+        # TimeZone ของ session → แปลงเป็นเวลา session เองก่อน ให้ได้ค่าเดียวกับที่ writer insert
+        v = v.astimezone(tz).replace(tzinfo=None)
+    return '"' + str(v).replace('"', '""') + '"'
+
+
+def session_tz(conn):
+    # TimeZone ของ session (GUC ที่ server ส่งมาตอน connect), ชื่อที่ zoneinfo ไม่รู้จัก → offset ปัจจุบันจาก server
+    name = conn.get_parameter_status("TimeZone")
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT EXTRACT(TIMEZONE FROM now())")
+            return timezone(timedelta(seconds=int(cursor.fetchone()[0])))
+
+
+class Spool:
+    def __init__(self, directory=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES, max_bytes=SPOOL_MAX_BYTES,
+                 replay_batch=SPOOL_REPLAY_BATCH, replay_rate=SPOOL_REPLAY_RATE,
+                 replay_interval=SPOOL_REPLAY_INTERVAL, rollups=None):
+        self.directory = directory
+        self.rollups = rollups            # rollup.RollupSet หรือ None
+        self.cache = None                 # query_cache.QueryCache หรือ None
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.replay_batch = replay_batch
+        self.replay_rate = replay_rate
+        self.replay_interval = replay_interval
+        self.lock = threading.Lock()
+        self.active = {}          # table → [seq, file, size, columns]
+        self.conflicts = {}       # table → (conflict key, "nothing" / "update") ตั้งโดย BatchWriter.register
+        self.stats = {"spooled_rows": 0, "replayed_rows": 0, "dropped_rows": 0, "segments_done": 0,
+                      "conflicts": 0, "replay_errors": 0}
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+        self.seq = max((seq for _, seq, _ in self.segments()), default=0)
+        self.bytes = sum(os.path.getsize(path) for _, _, path in self.segments())
+        SPOOL_BYTES.set_function(lambda: self.bytes)
+        if self.bytes:
+            log.info("💾 Spool has %.1f MB from a previous run, will replay", self.bytes / 1048576)
+
+    # ---------------------------
+    # Write side (BatchWriter)
+    # ---------------------------
+    def append(self, table, columns, rows):
+        # rows = list ของ dict (แบบที่ BatchWriter ถือ) → คืน False ถ้าเกิน max_bytes (ทิ้งแถว)
+        columns = tuple(columns)
+        data = b"".join(encode_record(tuple(row.get(c) for c in columns)) for row in rows)
+        with self.lock:
+            if self.bytes + len(data) > self.max_bytes:
+                self.stats["dropped_rows"] += len(rows)
+                return False
+            seg = self.active.get(table)
+            if seg is None or seg[2] >= self.segment_bytes or seg[3] != columns:
+                seg = self._open_segment(table, columns)
+            seg[1].write(data)
+            seg[1].flush()
+            seg[2] += len(data)
+            self.bytes += len(data)
+            self.stats["spooled_rows"] += len(rows)
+        SPOOL_ROWS.inc(table, "spooled", n=len(rows))
+        return True
+
+    def _open_segment(self, table, columns):
+        self._close_segment(table)
+        self.seq += 1
+        path = self.segment_path(table, self.seq)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, "ab")
+        header = encode_record(columns)
+        f.write(header)
+        self.bytes += len(header)
+        seg = self.active[table] = [self.seq, f, len(header), columns]
+        return seg
+
+    def _close_segment(self, table):
+        seg = self.active.pop(table, None)
+        if seg is not None:
+            seg[1].flush()
+            os.fsync(seg[1].fileno())
+            seg[1].close()
+
+    def segment_path(self, table, seq):
+        return os.path.join(self.directory, table, f"{seq:012d}.seg")
+
+    def segments(self):
+        # [(table, seq, path)] เรียงจากเก่าสุด
+        found = []
+        for table in os.listdir(self.directory):
+            folder = os.path.join(self.directory, table)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.endswith(".seg"):
+                    found.append((table, int(name[:-4]), os.path.join(folder, name)))
+        return sorted(found, key=lambda s: s[1])
+
+    # ---------------------------
+    # Replay side
+    # ---------------------------
+    def start(self, db):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(db,), name="pg-spool", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self.lock:
+            for table in list(self.active):
+                self._close_segment(table)
+
+    def _run(self, db):
+        while not self._stop.wait(self.replay_interval):
+            if not self.bytes:
+                continue
+            try:
+                self.replay(db)
+            except (DatabaseUnavailable, psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                log.debug("💾 Spool replay waiting for PostgreSQL: %s", e)
+            except Exception as e:
+                self.stats["replay_errors"] += 1
+                log.error("❌ Error replaying spool: %s", e)
+
+    def replay(self, db):
+        # replay ทุก segment ที่มีอยู่ตอนเริ่ม (segment ที่ยังเขียนอยู่ถูกปิดก่อน → แถวใหม่ไปลง segment ใหม่)
+        # checkout ก่อนว่า PostgreSQL กลับมาแล้ว → ระหว่าง outage ไม่ปิด / เปิด segment ใหม่ (fsync) ทุก replay_interval
+        with db.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        for table, seq, path in self.segments():
+            if self._stop.is_set():
+                return
+            with self.lock:
+                seg = self.active.get(table)
+                if seg is not None and seg[0] == seq:
+                    self._close_segment(table)
+            self.replay_segment(db, table, path)
+
+    def replay_segment(self, db, table, path):
+        pos_path = path[:-4] + ".pos"
+        done = 0
+        if os.path.exists(pos_path):
+            with open(pos_path) as f:
+                done = int(f.read() or 0)
+        started = time.monotonic()
+        replayed = 0
+        with open(path, "rb") as f:
+            records = read_records(f)
+            header = next(records, None)
+            if header is None:
+                self._remove(path, pos_path)
+                return
+            columns = header[1]
+            if done:
+                f.seek(done)
+                records = read_records(f)
+            batch, offsets = [], []
+            for offset, values in records:
+                batch.append(values)
+                offsets.append(offset)
+                if len(batch) >= self.replay_batch:
+                    self._commit(db, table, columns, batch, offsets, pos_path)
+                    replayed += len(batch)
+                    batch, offsets = [], []
+                    self._throttle(started, replayed)
+                    if self._stop.is_set():
+                        return
+            if batch:
+                self._commit(db, table, columns, batch, offsets, pos_path)
+                replayed += len(batch)
+        self._remove(path, pos_path)
+        self.stats["segments_done"] += 1
+        log.info("💾 Replayed %d spooled rows into %s", replayed, table)
+
+    def _commit(self, db, table, columns, batch, offsets, pos_path):
+        # offsets[i] = offset หลัง record ของ batch[i]
+        conflict = self.conflicts.get(table)
+        with db.connection() as conn:
+            try:
+                if conflict is None:
+                    copy_rows(conn, table, columns, batch, self.rollups, self.cache)
+                else:
+                    self.stats["conflicts"] += upsert_rows(conn, table, columns, batch, conflict,
+                                                           self.rollups, self.cache)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except psycopg2.Error as e:
+                # แถวเสียใน batch → insert ทีละแถว ข้ามแถวที่ insert ไม่ได้
+                log.error("❌ Replay into %s failed, retrying row by row: %s", table, e)
+                conn.rollback()
+                # connection หลุดกลางทาง → checkpoint แถวที่ commit ไปแล้วก่อน raise ไม่งั้นรอบหน้า insert ซ้ำ
+                interrupted = lambda n: n and self._checkpoint(table, pos_path, offsets[n - 1], n)
+                self.stats["dropped_rows"] += insert_one_by_one(conn, table, columns, batch, self.rollups, conflict,
+                                                                 self.cache, interrupted)
+        # checkpoint หลัง commit → ถ้า process ตายตรงนี้อย่างมากแค่ batch นี้ซ้ำ
+        self._checkpoint(table, pos_path, offsets[-1], len(batch))
+
+    def _checkpoint(self, table, pos_path, offset, rows):
+        with open(pos_path, "w") as f:
+            f.write(str(offset))
+        self.stats["replayed_rows"] += rows
+        SPOOL_ROWS.inc(table, "replayed", n=rows)
+
+    def _throttle(self, started, replayed):
+        if self.replay_rate > 0:
+            ahead = replayed / self.replay_rate - (time.monotonic() - started)
+            if ahead > 0:
+                self._stop.wait(ahead)
+
+    def _remove(self, path, pos_path):
+        size = os.path.getsize(path)
+        os.remove(path)
+        if os.path.exists(pos_path):
+            os.remove(pos_path)
+        with self.lock:
+            self.bytes = max(0, self.bytes - size)
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "directory": os.path.abspath(self.directory),
+            "bytes": self.bytes,
+            "segments": len(self.segments()),
+            "max_bytes": self.max_bytes,
+        }
+
+
+def cache_committed(cache, table, rows, committed_at, updated=()):
+    # เหมือน BatchWriter._committed: committed_at = time.monotonic() ก่อน commit
+    if cache is None:
+        return
+    if updated:
+        cache.invalidate(table)
+    elif rows:
+        cache.apply(table, rows, committed_at)
+
+
+def copy_rows(conn, table, columns, rows, rollups=None, cache=None):
+    buf = io.StringIO()
+    tz = session_tz(conn)
+    for values in rows:
+        buf.write(",".join(copy_field(v, tz) for v in values))
+        buf.write("\n")
+    buf.seek(0)
+    dicts = [dict(zip(columns, values)) for values in rows] if rollups or cache else None
+    with conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+        if rollups:
+            rollups.apply(cursor, table, dicts)
+    committed_at = time.monotonic()
+    conn.commit()
+    if rollups:
+        rollups.committed(table)
+    cache_committed(cache, table, dicts, committed_at)
+
+
+def insert_rows(cursor, table, columns, rows, conflict=None, rollups=None):
+    # INSERT ด้วย ON CONFLICT แบบเดียวกับ BatchWriter → (แถวที่ insert ใหม่, แถวที่ทับของเดิม) เป็น dict
+    key, on_conflict = conflict or (None, "nothing")
+    sql, returning = insert_sql(table, columns, key, on_conflict)
+    dicts = [dict(zip(columns, values)) for values in rows]
+    if key:
+        dicts, _ = collapse(dicts, [None] * len(dicts), key, on_conflict == "update")
+    returned = execute_values(cursor, sql, [tuple(d[c] for c in columns) for d in dicts],
+                              page_size=len(dicts), fetch=returning)
+    inserted, updated = returned_rows(dicts, key, returned) if returning else (dicts, [])
+    if rollups:
+        rollups.apply(cursor, table, inserted, updated)
+    return inserted, updated
+
+
+def upsert_rows(conn, table, columns, rows, conflict, rollups=None, cache=None):
+    # → จำนวนแถวที่ชน key แล้วถูกข้าม
+    with conn.cursor() as cursor:
+        inserted, updated = insert_rows(cursor, table, columns, rows, conflict, rollups)
+    committed_at = time.monotonic()
+    conn.commit()
+    if rollups:
+        rollups.committed(table)
+    cache_committed(cache, table, inserted, committed_at, updated)
+    return len(rows) - len(inserted) - len(updated)
+
+
+def insert_one_by_one(conn, table, columns, rows, rollups=None, conflict=None, cache=None, interrupted=None):
+    # → จำนวนแถวที่ insert ไม่ได้ ; connection หลุด → interrupted(จำนวนแถวแรกที่ commit แล้ว) แล้ว raise ต่อ
+    dropped = 0
+    for i, values in enumerate(rows):
+        try:
+            with conn.cursor() as cursor:
+                inserted, updated = insert_rows(cursor, table, columns, [values], conflict, rollups)
+            committed_at = time.monotonic()
+            conn.commit()
+            if rollups:
+                rollups.committed(table)
+            cache_committed(cache, table, inserted, committed_at, updated)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if interrupted is not None:
+                interrupted(i)
+            raise
+        except psycopg2.Error as e:
+            log.error("❌ SQL Error replaying into %s: %s", table, e)
+            conn.rollback()
+            dropped += 1
+    return dropped
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# ---------------------------
+# Keyed, time-windowed stream join
+# ---------------------------
+# แทน global แบบ latest_io (WISE-4210) / latest_signal_info (WISE-2200) ที่ใช้ร่วมกันทุก device
+#   key (topic ของ device) → ค่าฝั่งที่มาก่อน (I/O, rssi/devaddr) + เวลาของ reading + เวลาที่รับ
+#   ฝั่งที่มาทีหลัง (temp/hum, RtuRegister) match() เฉพาะ key เดียวกัน → ไม่จับคู่ข้าม device
+# window: ค่าที่ห่างจากฝั่งที่มาทีหลังเกิน JOIN_WINDOW วินาที ไม่ถูก join
+#   (เทียบเวลาของ reading ถ้ามีทั้งสองฝั่ง ไม่งั้นเทียบเวลาที่รับ)
+# TTL: key ที่ไม่ได้อัปเดตเกิน JOIN_TTL วินาที ถูกลบ, key เกิน JOIN_MAX_KEYS → ลบตัวที่เงียบนานสุด
+#   keys เรียงตามเวลาอัปเดต (OrderedDict) → ลบจากหัวทีละตัว O(1), memory คงที่ต่อ device
+
+JOIN_WINDOW = float(os.getenv("JOIN_WINDOW", 300))
+JOIN_TTL = float(os.getenv("JOIN_TTL", 3600))
+JOIN_MAX_KEYS = int(os.getenv("JOIN_MAX_KEYS", 10000))
+
+
+class JoinSide:
+    __slots__ = ("values", "event_ts", "seen")
+
+    def __init__(self, values, event_ts, seen):
+        self.values = values          # dict ของ column ฝั่งที่จำไว้
+        self.event_ts = event_ts      # เวลาของ reading (datetime) หรือ None
+        self.seen = seen              # เวลาที่รับ (monotonic)
+
+
+class StreamJoin:
+    def __init__(self, window=JOIN_WINDOW, ttl=JOIN_TTL, max_keys=JOIN_MAX_KEYS, clock=time.monotonic):
+        self.window = window
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.clock = clock
+        self.keys = OrderedDict()     # key → JoinSide (หัว = อัปเดตนานสุด)
+        self.lock = threading.Lock()  # topic ต่างกันของ route เดียวกันอยู่คนละ worker shard ได้
+        self.stats = {"remembered": 0, "joined": 0, "unmatched": 0, "outside_window": 0,
+                      "expired": 0, "evicted": 0}
+
+    def remember(self, key, values, event_ts=None):
+        # values ใหม่ทับ field เดิมของ key นี้ (ข้อความที่มีแค่บาง field เช่น rssi อย่างเดียว)
+        now = self.clock()
+        with self.lock:
+            side = self.keys.pop(key, None)
+            if side is None:
+                side = JoinSide(dict(values), event_ts, now)
+            else:
+                side.values.update(values)
+                side.seen = now
+                if event_ts is not None:
+                    side.event_ts = event_ts
+            self.keys[key] = side
+            self.stats["remembered"] += 1
+            self._expire(now)
+
+    def match(self, key, event_ts=None):
+        # → values ของ key ที่ยังอยู่ใน window, ไม่งั้น None
+        now = self.clock()
+        with self.lock:
+            side = self.keys.get(key)
+            if side is None:
+                self.stats["unmatched"] += 1
+                return None
+            if now - side.seen > self.ttl:
+                del self.keys[key]
+                self.stats["expired"] += 1
+                self.stats["unmatched"] += 1
+                return None
+            if event_ts is not None and side.event_ts is not None:
+                gap = abs((event_ts - side.event_ts).total_seconds())
+            else:
+                gap = now - side.seen
+            if gap > self.window:
+                self.stats["outside_window"] += 1
+                return None
+            self.stats["joined"] += 1
+            return dict(side.values)
+
+    def _expire(self, now):
+        # เรียกโดยถือ lock อยู่แล้ว
+        while self.keys:
+            key, side = next(iter(self.keys.items()))
+            if len(self.keys) > self.max_keys:
+                self.stats["evicted"] += 1
+            elif now - side.seen > self.ttl:
+                self.stats["expired"] += 1
+            else:
+                break
+            del self.keys[key]
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, "keys": len(self.keys), "window": self.window, "ttl": self.ttl,
+                    "max_keys": self.max_keys}
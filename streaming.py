@@ -0,0 +1,98 @@
+import json
+import os
+import zlib
+from flask import Response
+
+# ---------------------------
+# Streaming /api/data, /api/tpm
+# ---------------------------
+# แทน jsonify(ทั้ง history) ใน body เดียว:
+#   GET /api/data?since=<seq>&limit=<n>[&device=<id>]
+#     → NDJSON (1 sample ต่อบรรทัด, มี "seq") ส่งแบบ chunked ทีละ STREAM_CHUNK_ROWS แถว
+#     header X-Next-Since = seq ของแถวสุดท้าย → poll ครั้งถัดไปส่ง since นี้ ได้เฉพาะของใหม่
+#   ไม่มี since / limit / format=ndjson → JSON array ของ payload เดิมแบบ data_storage (แต่ stream เป็น chunk)
+#     (HISTORY_RAW=0 → array ของ sample แบบ column แทน)
+#   Accept-Encoding: gzip → บีบอัดทีละ chunk
+#   ETag = (seq ล่าสุด, จำนวนที่ถูกตัดทิ้ง, query) → If-None-Match ตรงกัน = 304 ไม่ต้องสร้าง body เลย
+
+HISTORY_PAGE_LIMIT = int(os.getenv("HISTORY_PAGE_LIMIT", 1000))
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", 10000))
+STREAM_CHUNK_ROWS = 200
+
+
+def page_args(args):
+    # args = query string (dict-like) → (since, limit, device, ndjson)
+    since = args.get("since")
+    limit = args.get("limit")
+    ndjson = since is not None or limit is not None or args.get("format") == "ndjson"
+    since = int(since) if since else 0
+    limit = min(int(limit), HISTORY_PAGE_MAX) if limit else (HISTORY_PAGE_LIMIT if ndjson else None)
+    return since, limit, args.get("device"), ndjson
+
+
+def history_etag(history, since, limit, device, ndjson):
+    seq, evicted = history.version()
+    return f'"h{seq}-{evicted}-{since}-{limit}-{device or ""}-{int(ndjson)}"'
+
+
+def etag_matches(if_none_match, etag):
+    return bool(if_none_match) and (if_none_match.strip() == "*" or etag in if_none_match)
+
+
+def wants_gzip(accept_encoding):
+    return "gzip" in (accept_encoding or "")
+
+
+def ndjson_chunks(rows):
+    for i in range(0, len(rows), STREAM_CHUNK_ROWS):
+        yield "".join(json.dumps(r) + "\n" for r in rows[i:i + STREAM_CHUNK_ROWS]).encode()
+
+
+def json_array_chunks(rows):
+    yield b"["
+    for i in range(0, len(rows), STREAM_CHUNK_ROWS):
+        chunk = ",".join(json.dumps(r) for r in rows[i:i + STREAM_CHUNK_ROWS])
+        yield (("," if i else "") + chunk).encode()
+    yield b"]"
+
+
+def raw_array_chunks(raws):
+    # raws = JSON bytes ของแต่ละ payload (HistoryStore.raw_records) → ไม่ต้อง dumps ซ้ำ
+    yield b"["
+    for i in range(0, len(raws), STREAM_CHUNK_ROWS):
+        yield (b"," if i else b"") + b",".join(raws[i:i + STREAM_CHUNK_ROWS])
+    yield b"]"
+
+
+def gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)     # wbits 31 = gzip header
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def history_body(history, since, limit, device, ndjson):
+    # → (chunks, headers เพิ่มเติม, content type)
+    if ndjson:
+        rows, next_since = history.page(since, limit, device)
+        return ndjson_chunks(rows), {"X-Next-Since": str(next_since)}, "application/x-ndjson"
+    if history.keep_raw:
+        return raw_array_chunks(history.raw_records(device)), {}, "application/json"
+    rows = history.records(device)
+    return json_array_chunks(rows), {}, "application/json"
+
+
+def flask_history_response(history, request):
+    since, limit, device, ndjson = page_args(request.args)
+    etag = history_etag(history, since, limit, device, ndjson)
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers={"ETag": etag})
+    chunks, headers, content_type = history_body(history, since, limit, device, ndjson)
+    headers["ETag"] = etag
+    if wants_gzip(request.headers.get("Accept-Encoding")):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(chunks, headers=headers, content_type=content_type)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# test import module ของ repo ตรงๆ (gateway.py, spool.py, ...) เหมือนรันจาก root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+from broadcast import Broadcaster, room_name
+
+
+class FakeServer:
+    # room ของ socketio แบบย่อ: to = sid / room / list ของ room (รวม participant ไม่ซ้ำ) เหมือน BaseManager
+    def __init__(self):
+        self.rooms = {}
+        self.received = {}
+
+    def enter_room(self, sid, room, namespace="/"):
+        self.rooms.setdefault(room, set()).add(sid)
+
+    def leave_room(self, sid, room, namespace="/"):
+        self.rooms.get(room, set()).discard(sid)
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.server = FakeServer()
+
+    def emit(self, event, data, to=None, skip_sid=None):
+        rooms = self.server.rooms
+        targets = set()
+        for name in (to if isinstance(to, list) else [to]):
+            targets |= rooms.get(name, set()) if ":" in name else {name}     # room = "event:device", ไม่งั้นเป็น sid
+        skip = skip_sid if isinstance(skip_sid, list) else [skip_sid]
+        for sid in targets - set(skip):
+            self.server.received.setdefault(sid, []).append((event, data))
+
+    def start_background_task(self, target):
+        pass
+
+
+def test_hz0_emits_original_payload_once_per_message():
+    sio = FakeSocketIO()
+    b = Broadcaster(sio, hz=0, max_backlog=0)
+    b.publish("mqtt_data", "dev1", {"s": 1})       # event แรก → ยังไม่มี client
+    b.connect("old")                               # dashboard เดิม: ไม่ subscribe
+    b.connect("both")
+    b.subscribe("both", "mqtt_data", "dev1")
+    b.subscribe("both", "mqtt_data", "*")
+    sio.server.received.clear()
+
+    row = {"device_id": "dev1", "s": 2, "ai1": 24.9}
+    b.publish("mqtt_data", "dev1", row)
+    b.publish("mqtt_data", "dev1", row)
+
+    assert sio.server.received["old"] == [("mqtt_data", row), ("mqtt_data", row)]
+    assert sio.server.received["both"] == [("mqtt_data", row), ("mqtt_data", row)]
+
+
+def test_hz0_connect_sends_no_snapshot():
+    sio = FakeSocketIO()
+    b = Broadcaster(sio, hz=0, max_backlog=0)
+    b.publish("mqtt_data", "dev1", {"s": 1})
+    b.connect("old")
+    assert "old" not in sio.server.received
+
+
+def test_coalesced_frame_reaches_device_and_star_subscriber_once():
+    sio = FakeSocketIO()
+    b = Broadcaster(sio, hz=10, max_backlog=0)
+    b.connect("both")
+    b.subscribe("both", "mqtt_data", "dev1")
+    b.subscribe("both", "mqtt_data", "*")
+    b.connect("dev")
+    b.subscribe("dev", "mqtt_data", "dev1")
+    sio.server.received.clear()
+
+    b.publish("mqtt_data", "dev1", {"s": 1})
+    b.publish("mqtt_data", "dev1", {"s": 2})
+    b.tick()
+
+    assert [f["devices"] for _, f in sio.server.received["both"]] == [{"dev1": {"s": 2}}]
+    assert [f["devices"] for _, f in sio.server.received["dev"]] == [{"dev1": {"s": 2}}]
+    assert room_name("mqtt_data", "*") in sio.server.rooms
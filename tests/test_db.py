@@ -0,0 +1,132 @@
+import threading
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+import db
+from db import Database, DatabaseUnavailable
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        if self.conn.fail_sql or (self.conn.fail_set and sql.startswith("SET")):
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConn:
+    def __init__(self):
+        self.closed = 0
+        self.fail_sql = False       # SELECT 1 / rollback พัง (connection เสีย)
+        self.fail_set = FakePool.fail_set     # SET statement_timeout พัง
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        if self.fail_sql:
+            raise psycopg2.OperationalError("connection already closed")
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakePool:
+    # ThreadedConnectionPool แบบย่อ: connect ได้ / ไม่ได้ ตาม down
+    down = False
+    fail_set = False
+    opened = []
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        if FakePool.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        self.idle = []
+
+    def getconn(self):
+        if FakePool.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        if self.idle:
+            return self.idle.pop()
+        conn = FakeConn()
+        FakePool.opened.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.closed = 1
+        else:
+            self.idle.append(conn)
+
+
+@pytest.fixture(autouse=True)
+def fake_pool(monkeypatch):
+    monkeypatch.setattr(db.pool, "ThreadedConnectionPool", FakePool)
+    FakePool.down = False
+    FakePool.fail_set = False
+    FakePool.opened = []
+
+
+def test_pool_exhaustion_times_out_and_recovers():
+    database = Database(minconn=1, maxconn=2)
+    held = [database._checkout(None, 1), database._checkout(None, 1)]
+    with pytest.raises(DatabaseUnavailable, match="exhausted"):
+        with database.connection(timeout=0.05):
+            pass
+    # คืน connection → checkout ที่รออยู่ได้ต่อทันที
+    waiter = threading.Thread(target=lambda: held.append(database._checkout(None, 2)))
+    waiter.start()
+    database._checkin(held.pop(0), broken=False)
+    waiter.join(1)
+    assert not waiter.is_alive() and database.stats["in_use"] == 2
+    for conn in held[:]:
+        database._checkin(conn, broken=False)
+    assert database.stats["in_use"] == 0
+    assert len(FakePool.opened) == 2        # connection ถูกใช้ซ้ำ ไม่ได้เปิดใหม่
+
+
+def test_broken_connections_are_discarded_without_leaking_slots():
+    database = Database(minconn=1, maxconn=1)
+    with pytest.raises(psycopg2.OperationalError):
+        with database.connection() as conn:
+            conn.fail_sql = True            # connection หลุดระหว่างใช้ → rollback ไม่ได้ → ทิ้ง
+            raise psycopg2.OperationalError("lost")
+    assert conn.closed and database.stats["discarded"] == 1
+    # SET statement_timeout พังตอน checkout → ทิ้ง connection และคืน slot
+    FakePool.fail_set = True
+    with pytest.raises(psycopg2.OperationalError):
+        with database.connection():
+            pass
+    assert FakePool.opened[-1].closed and database.stats["discarded"] == 2
+    FakePool.fail_set = False
+    with database.connection(timeout=0.05) as conn:     # maxconn=1: slot ต้องว่างแล้ว
+        assert not conn.closed
+    assert database.stats["in_use"] == 0
+
+
+def test_connect_failure_backs_off_then_recovers(monkeypatch):
+    database = Database(minconn=1, maxconn=2)
+    FakePool.down = True
+    with pytest.raises(DatabaseUnavailable):
+        with database.connection():
+            pass
+    with pytest.raises(DatabaseUnavailable, match="retrying"):     # ระหว่าง backoff ไม่ลอง connect ซ้ำ
+        with database.connection():
+            pass
+    assert database.stats["failed_connects"] == 1
+    FakePool.down = False
+    database._retry_at = 0.0        # backoff หมดเวลา
+    with database.connection() as conn:
+        assert not conn.closed
+    assert database.stats["in_use"] == 0 and database._backoff == db.BACKOFF_MIN
@@ -0,0 +1,25 @@
+import json
+
+from history import ChannelSeries, HistoryStore
+from streaming import history_body
+
+
+def test_late_points_are_merged_in_time_order():
+    s = ChannelSeries(late_batch=3)
+    for i, t in enumerate([10, 20, 30, 15, 5, 40, 25, 20, 35]):
+        s.add(t, float(i), 0.0)
+    lo, hi = s.window()
+    assert list(s.ts[lo:hi]) == [5, 10, 15, 20, 20, 25, 30, 35, 40]
+    # เวลาเท่ากัน: จุดที่มีอยู่ก่อนมาก่อน (เหมือน bisect_right เดิม)
+    assert s.values[s.ts.index(20)] == 1.0
+    assert len(s) == 9 and not s.late
+
+
+def test_history_uses_payload_time_and_keeps_legacy_shape():
+    h = HistoryStore(["temp"], capacity=8, max_age=None)
+    h.append("dev1", {"temp": 24.9, "t": "x"}, ts_ms=2000)
+    h.append("dev1", {"temp": 1}, ts_ms=1000)
+    rows, _ = h.page(0, 10)
+    assert [(r["timestamp"], r["temp"]) for r in rows] == [(2000, 24.9), (1000, 1.0)]
+    body, _, _ = history_body(h, None, None, None, False)
+    assert json.loads(b"".join(body)) == [{"temp": 24.9, "t": "x"}, {"temp": 1}]
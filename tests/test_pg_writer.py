@@ -0,0 +1,88 @@
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+
+from metrics import ROWS_INSERTED
+from pg_writer import BatchWriter
+
+
+class FakeCursor:
+    # INSERT ... ON CONFLICT DO NOTHING แบบย่อ: key ซ้ำ → rowcount 0, batch ที่มีค่า "bad" → SQL error ทั้ง batch
+    def __init__(self, conn):
+        self.conn = self.connection = conn
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, rows):
+        if any(r.get("v") == "bad" for r in rows):
+            raise psycopg2.DataError("bad value")
+        new = [r for r in rows if r["k"] not in self.conn.keys]
+        self.conn.keys.update(r["k"] for r in new)
+        self.rowcount = len(new)
+
+
+class FakeConn:
+    def __init__(self):
+        self.keys = {"dup"}
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeDb:
+    def __init__(self):
+        self.conn = FakeConn()
+
+    @contextmanager
+    def connection(self):
+        yield self.conn
+
+
+def fake_execute_values(cursor, sql, rows, template=None, page_size=100, fetch=False):
+    cursor.execute(sql, rows)
+    return [] if fetch else None
+
+
+def make_writer():
+    writer = BatchWriter(FakeDb(), batch_size=10)
+    writer.register("t", ["k", "v"])
+    return writer
+
+
+def test_row_by_row_counts_only_rows_actually_inserted(monkeypatch):
+    monkeypatch.setattr("pg_writer.execute_values", fake_execute_values)
+    writer = make_writer()
+    before = ROWS_INSERTED.value("topic/a", "t")
+    for k, v in [("a", 1), ("dup", 2), ("b", "bad"), ("c", 3)]:
+        writer._buffer("t", {"k": k, "v": v}, "topic/a")
+    writer._flush("t")
+    assert ROWS_INSERTED.value("topic/a", "t") - before == 2      # a, c ; dup ถูกข้าม, bad ถูกทิ้ง
+    stats = writer.snapshot()
+    assert (stats["flushed_rows"], stats["conflicts"], stats["dropped"]) == (2, 1, 1)
+
+
+def test_stats_are_consistent_across_threads():
+    writer = make_writer()
+
+    def bump():
+        for _ in range(20000):
+            writer._count(queued=1, duplicates=1)
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert writer.snapshot()["queued"] == writer.snapshot()["duplicates"] == 80000
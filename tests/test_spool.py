@@ -0,0 +1,163 @@
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import psycopg2
+import pytest
+from psycopg2.extras import execute_values
+
+from db import DatabaseUnavailable
+from pg_writer import insert_sql
+from spool import Spool, copy_field, copy_rows
+
+PG_TEST_DSN = os.getenv("PG_TEST_DSN")     # เช่น "dbname=test user=postgres" → เปิด test ที่ต้องใช้ PostgreSQL จริง
+
+BANGKOK = timezone(timedelta(hours=7))     # เหมือน decoders.WISE2200_TZ
+
+
+def test_copy_field_converts_aware_datetime_to_session_time():
+    ts = datetime(2025, 5, 30, 11, 23, 0, tzinfo=BANGKOK)
+    assert copy_field(ts) == '"2025-05-30 04:23:00"'
+    assert copy_field(ts, ZoneInfo("Asia/Bangkok")) == '"2025-05-30 11:23:00"'
+    assert copy_field(datetime(2025, 5, 30, 4, 23)) == '"2025-05-30 04:23:00"'
+
+
+def test_copy_field_scalars():
+    assert copy_field(None) == ""
+    assert copy_field(True) == "t"
+    assert copy_field(1.5) == "1.5"
+    assert copy_field('a"b') == '"a""b"'
+
+
+@pytest.mark.skipif(not PG_TEST_DSN, reason="PG_TEST_DSN not set")
+@pytest.mark.parametrize("session_tz", ["UTC", "Asia/Bangkok", "America/New_York"])
+def test_copy_matches_writer_insert(session_tz):
+    # แถวเดียวกันเข้าทาง writer (execute_values) กับทาง spool replay (COPY) ต้องได้ค่าเดียวกัน
+    ts = datetime(2025, 5, 30, 11, 23, 0, tzinfo=BANGKOK)
+    conn = psycopg2.connect(PG_TEST_DSN, options=f"-c TimeZone={session_tz}")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE spool_tz (src TEXT, ts TIMESTAMP, tstz TIMESTAMPTZ)")
+            sql, _ = insert_sql("spool_tz", ["src", "ts", "tstz"])
+            execute_values(cursor, sql, [("writer", ts, ts)])
+        copy_rows(conn, "spool_tz", ["src", "ts", "tstz"], [("copy", ts, ts)])
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT src, ts, tstz FROM spool_tz ORDER BY src")
+            (_, copy_ts, copy_tstz), (_, writer_ts, writer_tstz) = cursor.fetchall()
+        assert copy_ts == writer_ts
+        assert copy_tstz == writer_tstz == ts
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Fake PostgreSQL สำหรับ replay (ไม่ต้องมี server)
+# ---------------------------
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = self.connection = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, sql, buf):
+        if self.conn.copy_error:
+            raise self.conn.copy_error
+        self.conn.pending.extend(line for line in buf.getvalue().splitlines())
+
+    def mogrify(self, template, args):
+        return repr(args).encode()
+
+    def execute(self, sql, params=None):
+        self.conn.pending.append(sql)
+
+
+class FakeConn:
+    encoding = "UTF8"
+
+    def __init__(self, copy_error=None, lose_at=None):
+        self.copy_error = copy_error
+        self.lose_at = lose_at          # commit ครั้งที่เท่านี้ → connection หลุด
+        self.commits = 0
+        self.pending = []
+        self.rows = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_parameter_status(self, name):
+        return "UTC"
+
+    def commit(self):
+        self.commits += 1
+        if self.lose_at is not None and self.commits >= self.lose_at:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.rows.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+class FakeDb:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @contextmanager
+    def connection(self, **kwargs):
+        yield self.conn
+        self.conn.rollback()        # เหมือน Database._checkin: transaction ที่ค้าง rollback ก่อนคืน pool
+
+
+def test_row_by_row_replay_checkpoints_rows_committed_before_connection_loss(tmp_path):
+    spool = Spool(str(tmp_path), replay_rate=0)
+    spool.append("t", ["a"], [{"a": i} for i in range(5)])
+    # COPY พังเพราะแถวเสีย → ทีละแถว, แถวที่ 3 connection หลุด
+    conn = FakeConn(copy_error=psycopg2.DataError("bad row"), lose_at=3)
+    with pytest.raises(psycopg2.OperationalError):
+        spool.replay(FakeDb(conn))
+    assert len(conn.rows) == 2
+    assert spool.stats["replayed_rows"] == 2
+
+    # รอบถัดไปต่อจาก checkpoint → แถว 0, 1 ไม่ถูก insert ซ้ำ
+    conn = FakeConn()
+    spool.replay(FakeDb(conn))
+    assert conn.rows == ["2", "3", "4"]
+    assert spool.stats["replayed_rows"] == 5
+    assert spool.segments() == []
+
+
+def test_restart_after_crash_resumes_from_checkpoint(tmp_path):
+    spool = Spool(str(tmp_path), replay_batch=2, replay_rate=0)
+    spool.append("t", ["a"], [{"a": i} for i in range(5)])
+    # batch แรก commit แล้ว, connection หลุดตอน commit batch ที่สอง → process ตาย
+    conn = FakeConn(lose_at=2)
+    with pytest.raises(psycopg2.OperationalError):
+        spool.replay(FakeDb(conn))
+    assert conn.rows == ["0", "1"]
+
+    # process ใหม่บน directory เดิม → อ่าน .pos แล้วต่อจากแถวที่ 2
+    conn = FakeConn()
+    Spool(str(tmp_path), replay_batch=2, replay_rate=0).replay(FakeDb(conn))
+    assert conn.rows == ["2", "3", "4"]
+
+
+class DownDb:
+    @contextmanager
+    def connection(self, **kwargs):
+        raise DatabaseUnavailable("PostgreSQL unavailable, retrying in 1.0s")
+        yield
+
+
+def test_replay_during_outage_keeps_active_segment(tmp_path):
+    spool = Spool(str(tmp_path), replay_rate=0)
+    spool.append("t", ["a"], [{"a": 1}])
+    for _ in range(3):
+        with pytest.raises(DatabaseUnavailable):
+            spool.replay(DownDb())
+        spool.append("t", ["a"], [{"a": 2}])
+    assert len(spool.segments()) == 1
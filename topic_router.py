@@ -0,0 +1,73 @@
+# ---------------------------
+# MQTT topic router (trie)
+# ---------------------------
+# pattern แบบ MQTT: "+" = 1 level, "#" = ทุก level ที่เหลือ (ต้องอยู่ท้ายสุด)
+# match() เดิน trie ตามจำนวน level ของ topic (ไม่ขึ้นกับจำนวน route)
+# และจำผลของ topic ที่เคยเจอไว้ → topic เดิมซ้ำๆ เป็น dict lookup ครั้งเดียว
+
+MATCH_CACHE_SIZE = 10000
+
+
+class _Node:
+    __slots__ = ("children", "plus", "hash_routes", "routes")
+
+    def __init__(self):
+        self.children = {}
+        self.plus = None
+        self.hash_routes = []
+        self.routes = []
+
+
+class TopicRouter:
+    def __init__(self):
+        self.root = _Node()
+        self.cache = {}
+
+    def add(self, pattern, route):
+        node = self.root
+        levels = pattern.split("/")
+        for i, level in enumerate(levels):
+            if level == "#":
+                if i != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level in {pattern!r}")
+                node.hash_routes.append(route)
+                self.cache.clear()
+                return
+            if level == "+":
+                if node.plus is None:
+                    node.plus = _Node()
+                node = node.plus
+            else:
+                node = node.children.setdefault(level, _Node())
+        node.routes.append(route)
+        self.cache.clear()
+
+    def match(self, topic):
+        found = self.cache.get(topic)
+        if found is not None:
+            return found
+
+        found = []
+        nodes = [self.root]
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                # "a/#" match ทั้ง "a/b" และ "a/b/c"
+                found.extend(node.hash_routes)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                if node.plus is not None:
+                    next_nodes.append(node.plus)
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            found.extend(node.routes)
+            # "a/#" match "a" ด้วย (ตาม spec MQTT)
+            found.extend(node.hash_routes)
+
+        if len(self.cache) >= MATCH_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[topic] = found
+        return found
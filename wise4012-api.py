@@ -2,30 +2,104 @@ from flask import Flask, request, jsonify
 from flask_socketio import SocketIO, emit
 import paho.mqtt.client as mqtt
 import json
-from datetime import datetime
+from datetime import datetime, timezone
+import heapq
+import re
+from collections import deque
+from decoders import parse_wise_time
+from history import HistoryStore, ChannelIndex
+from latest import LatestStore
+from streaming import flask_history_response
+from http_ingest import BadPayload, parse_records, record_device, record_time, HTTP_MAX_BODY
+from broadcast import Broadcaster, subscription_args
+from log import setup_logging, get_logger, topic_log
+from metrics import instrument_app, stage_start, stage_done, MQTT_RECEIVED, DECODE_ERRORS, SOCKETIO_CLIENTS
+
+setup_logging()
+log = get_logger("wise4012-api")
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = HTTP_MAX_BODY     # body ใหญ่กว่านี้ → 413 ก่อนอ่านเข้า memory
 socketio = SocketIO(app, cors_allowed_origins='*')  # allow all origins
+broadcaster = Broadcaster(socketio).start()   # รวม mqtt_data เป็น frame ละ tick
+instrument_app(app)                            # GET /metrics
+SOCKETIO_CLIENTS.set_function(lambda: len(broadcaster.subscriptions))
 
-# ใช้เก็บข้อมูลจาก MQTT และ HTTP POST
-data_storage = []
+# ใช้เก็บข้อมูลจาก MQTT และ HTTP POST (ring buffer ต่อ device, ดู history.py)
+HISTORY_FIELDS = (
+    ["s", "q", "c", "di1", "di2", "di3", "di4", "do1", "do2"]
+    + [f"ai{i}" for i in range(1, 5)]
+    + [f"ai_st{i}" for i in range(1, 5)]
+)
+history = HistoryStore(HISTORY_FIELDS)
+ai_index = ChannelIndex()   # (device, aiN) → timestamp/value arrays สำหรับ query ช่วงเวลา
+latest = LatestStore()      # ค่าล่าสุดต่อ device / tag (value, ts, quality) สำหรับ /api/latest
+sys_log_events = deque(maxlen=1000)
 
 # แปลง timestamp ให้อยู่ในรูปแบบ epoch milliseconds
 def to_epoch_ms(timestamp_str):
     dt = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
     return int(dt.timestamp() * 1000)
 
+# เวลาจาก payload WISE ("t": "2025-05-30T04:23:00Z" เป็น UTC) → epoch ms, ไม่มีก็ใช้เวลาปัจจุบัน
+def payload_epoch_ms(payload):
+    t = payload.get("t")
+    if t:
+        try:
+            return int(parse_wise_time(t).replace(tzinfo=timezone.utc).timestamp() * 1000)
+        except ValueError:
+            pass
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+# record ของ /io_log: เวลาจาก TIM / t (ดู http_ingest.record_time), ไม่มีก็ใช้เวลาปัจจุบัน
+def record_epoch_ms(record):
+    ts = record_time(record)
+    if ts is None:
+        return payload_epoch_ms(record)
+    return int(ts.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+# /io_log เก็บแยกต่อ device ("io_log/<UID หรือ MAC>", ไม่มีก็ใช้ address ผู้ส่ง)
+def io_log_key(record):
+    return f"io_log/{record_device(record, request.remote_addr)}"
+
+# key ของ /io_log ที่เป็นของ device นี้ (UID / MAC มีขีด / colon ได้ → เทียบเฉพาะตัว hex)
+def io_log_keys(mac_suffix):
+    return sorted({
+        c["device"] for c in ai_index.channels()
+        if c["device"].startswith("io_log/") and re.sub(r"[^0-9A-F]", "", c["device"][7:].upper()).endswith(mac_suffix)
+    })
+
+# อ่าน from / to (epoch ms) / limit จาก query string
+def range_args():
+    start = request.args.get("from", type=int)
+    end = request.args.get("to", type=int)
+    limit = request.args.get("limit", default=1000, type=int)
+    return start, end, limit
+
 # ---------------------------
 # MQTT Message Handler
 # ---------------------------
 def on_message(client, userdata, msg):
+    started = stage_start()
+    MQTT_RECEIVED.inc(msg.topic)
     try:
         raw_data = json.loads(msg.payload.decode())
-        print(f"✅ Received MQTT from {msg.topic}: {raw_data}")
-        data_storage.append(raw_data)
-        socketio.emit("mqtt_data", raw_data)
+        stage_done("parse", started)
+        if topic_log.tracing(msg.topic):
+            log.info("✅ Received MQTT from %s: %s", msg.topic, raw_data)
+        else:
+            n = topic_log.sample(msg.topic)
+            if n:
+                log.info("📬 %s: %d messages received", msg.topic, n)
+        ts_ms = payload_epoch_ms(raw_data)
+        history.append(msg.topic, raw_data, ts_ms)
+        ai_index.add(msg.topic, raw_data, ts_ms)
+        latest.update(msg.topic, raw_data, ts_ms)
+        broadcaster.publish("mqtt_data", msg.topic, raw_data)
+        stage_done("message", started)
     except Exception as e:
-        print("❌ Error in on_message:", e)
+        DECODE_ERRORS.inc(msg.topic)
+        log.error("❌ Error in on_message: %s", e)
 
 # ---------------------------
 # MQTT Client
@@ -48,50 +122,104 @@ client.loop_start()
 def index():
     return "✅ MQTT + HTTP API Gateway Running"
 
+# ?since=<seq>&limit=<n> → NDJSON แบบ chunked, ไม่มี → JSON array เดิม (ดู streaming.py)
 @app.route('/api/data', methods=['GET'])
 def get_data():
-    return jsonify(data_storage)
+    return flask_history_response(history, request)
+
+@app.route('/api/latest', methods=['GET'])
+def get_latest():
+    return jsonify(latest.snapshot())
+
+@app.route('/api/latest/<path:device>', methods=['GET'])
+def get_latest_device(device):
+    tags = latest.device(device)
+    if tags is None:
+        return jsonify({"status": "error", "message": f"unknown device {device}"}), 404
+    return jsonify(tags)
+
+@app.route('/api/broadcast', methods=['GET'])
+def get_broadcast_stats():
+    return jsonify(broadcaster.snapshot())
+
+# GET = ดู config, POST {"topic": "...", "enabled": true} = เปิด/ปิด log payload เต็มของ topic
+@app.route('/api/log', methods=['GET', 'POST'])
+def log_config():
+    if request.method == 'POST':
+        topic_log.configure(request.get_json() or {})
+    return jsonify(topic_log.snapshot())
+
+@app.route('/api/history', methods=['GET'])
+def get_history_info():
+    return jsonify(history.info())
+
+# WISE-4012 HTTP push endpoint (object เดียว / array / NDJSON, gzip ได้ — ไม่มี database, เก็บใน memory)
+def read_records(name):
+    records = parse_records(request.get_data(), request.content_type, request.headers.get("Content-Encoding"))
+    log.debug("📥 Received /%s POST: %d record(s)", name, len(records))
+    return records
 
-# WISE-4012 HTTP push endpoint
 @app.route('/io_log', methods=['POST'])
 def receive_io_log():
     try:
-        data = request.get_json()
-        print("📥 Received /io_log POST:", data)
-        data_storage.append({"source": "io_log", "data": data, "timestamp": datetime.utcnow().isoformat()})
-        return jsonify({"status": "ok"}), 200
+        records = read_records("io_log")
+        for data in records:
+            ts_ms = record_epoch_ms(data)
+            key = io_log_key(data)
+            history.append(key, data, ts_ms)
+            ai_index.add(key, data, ts_ms)
+            latest.update(key, data, ts_ms)
+        return jsonify({"status": "ok", "accepted": len(records)}), 200
+    except BadPayload as e:
+        log.warning("⚠️ Bad /io_log body: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
-        print("❌ Error in /io_log:", e)
+        log.error("❌ Error in /io_log: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # Optional WISE-4012 System Event logging
 @app.route('/sys_log', methods=['POST'])
 def receive_sys_log():
     try:
-        data = request.get_json()
-        print("📥 Received /sys_log POST:", data)
-        data_storage.append({"source": "sys_log", "data": data, "timestamp": datetime.utcnow().isoformat()})
-        return jsonify({"status": "ok"}), 200
+        records = read_records("sys_log")
+        received = datetime.utcnow().isoformat()
+        sys_log_events.extend({"data": data, "timestamp": received} for data in records)
+        return jsonify({"status": "ok", "accepted": len(records)}), 200
+    except BadPayload as e:
+        log.warning("⚠️ Bad /sys_log body: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
-        print("❌ Error in /sys_log:", e)
+        log.error("❌ Error in /sys_log: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/feeab5/ai', methods=['GET'])
-def get_feeab5_ai():
-    ai_data = []
-    for item in data_storage:
-        if isinstance(item, dict):
-            payload = item.get("data") if item.get("source") == "io_log" else item
+@app.route('/sys_log', methods=['GET'])
+def get_sys_log():
+    return jsonify(list(sys_log_events))
 
-            # เช็คว่า ai3 และ ai_st3 มีอยู่
-            if "ai3" in payload and "ai_st3" in payload:
-                ai_data.append({
-                    "ai3": payload["ai3"],
-                    "ai_st3": payload["ai_st3"],
-                    "timestamp": payload.get("t", item.get("timestamp"))
-                })
+# GET /api/ai/<device>/<channel>?from=<epoch ms>&to=<epoch ms>&limit=<n>
+@app.route('/api/ai', methods=['GET'])
+def list_ai_channels():
+    return jsonify(ai_index.channels())
 
-    return jsonify(ai_data)
+@app.route('/api/ai/<path:device>/<int:channel>', methods=['GET'])
+def get_ai_channel(device, channel):
+    start, end, limit = range_args()
+    return jsonify(ai_index.query(device, channel, start, end, limit))
+
+@app.route('/feeab5/ai', methods=['GET'])
+def get_feeab5_ai():
+    start, end, limit = range_args()
+    # FEEAB5 ส่งมาทั้งทาง MQTT และ /io_log → รวมชุดที่เรียงเวลาอยู่แล้ว (เฉพาะ /io_log ของ FEEAB5 เอง)
+    merged = heapq.merge(
+        ai_index.query("wise4012_FEEAB5", 3, start, end, limit),
+        *(ai_index.query(key, 3, start, end, limit) for key in io_log_keys("FEEAB5")),
+        key=lambda p: p["timestamp"],
+    )
+    ai_data = [
+        {"ai3": p["value"], "ai_st3": p.get("status"), "timestamp": p["timestamp"]}
+        for p in merged
+    ]
+    return jsonify(ai_data[-limit:] if limit else ai_data)
 
 
 # ---------------------------
@@ -99,11 +227,27 @@ def get_feeab5_ai():
 # ---------------------------
 @socketio.on('connect')
 def handle_connect():
-    print("🌐 Client connected")
+    log.info("🌐 Client connected (%s)", request.sid)
+    broadcaster.connect(request.sid)
+    broadcaster.emit_to(request.sid, "latest", latest.snapshot())
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print("🔌 Client disconnected")
+    log.info("🔌 Client disconnected (%s)", request.sid)
+    broadcaster.forget(request.sid)
+
+# {"event": "mqtt_data", "device": "wise4012_FEEAB5"} หรือ device "*"
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    event, device = subscription_args(data)
+    broadcaster.subscribe(request.sid, event, device)
+    return {"status": "ok", "event": event, "device": device}
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    event, device = subscription_args(data)
+    broadcaster.unsubscribe(request.sid, event, device)
+    return {"status": "ok", "event": event, "device": device}
 
 # ---------------------------
 # Main Entry Point
@@ -0,0 +1,110 @@
+import atexit
+import os
+import queue
+import threading
+from log import get_logger
+from metrics import REGISTRY, stage_start, stage_done
+
+# ---------------------------
+# Sharded message workers
+# ---------------------------
+# on_message ของ paho รันบน network thread เดียว → ถ้างานช้า (decode / history / emit) keepalive PING จะช้าตาม
+# network thread จึงแค่ submit(topic, payload) ลงคิวของ shard แล้วกลับทันที
+#   shard = hash(topic) % MQTT_WORKERS → topic (= device) เดียวกันอยู่ shard เดียวเสมอ ลำดับ message ไม่สลับ
+# คิวของ shard เต็ม (MQTT_SHARD_QUEUE) → ทิ้ง message แล้วนับไว้ (ไม่ block network thread)
+# MQTT_WORKERS=0 → ทำงานบน network thread ตรงๆ แบบเดิม
+
+MQTT_WORKERS = int(os.getenv("MQTT_WORKERS", 4))
+MQTT_SHARD_QUEUE = int(os.getenv("MQTT_SHARD_QUEUE", 1000))
+
+log = get_logger("workers")
+
+SHARD_DEPTH = REGISTRY.gauge(
+    "wise_shard_queue_depth", "Messages waiting per worker shard", ["shard"])
+SHARD_DROPPED = REGISTRY.counter(
+    "wise_shard_dropped_total", "Messages dropped because the shard queue was full", ["shard"])
+
+_STOP = object()
+
+
+class ShardedWorkers:
+    def __init__(self, handler, workers=MQTT_WORKERS, queue_depth=MQTT_SHARD_QUEUE):
+        self.handler = handler            # handler(topic, payload) — เรียกจาก worker thread ของ shard
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.queues = [queue.Queue(maxsize=queue_depth) for _ in range(workers)]
+        self.stats = [{"processed": 0, "dropped": 0, "errors": 0, "max_depth": 0} for _ in range(workers)]
+        self._threads = []
+        SHARD_DEPTH.set_function(lambda: {(str(i),): q.qsize() for i, q in enumerate(self.queues)})
+
+    def start(self):
+        if self._threads or not self.workers:
+            return self
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, args=(i,), name=f"mqtt-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        atexit.register(self.stop)
+        return self
+
+    def shard_of(self, topic):
+        return hash(topic) % self.workers
+
+    def submit(self, topic, payload):
+        if not self.workers:
+            self.handler(topic, payload)
+            return True
+        i = self.shard_of(topic)
+        q = self.queues[i]
+        try:
+            q.put_nowait((topic, payload, stage_start()))
+        except queue.Full:
+            self.stats[i]["dropped"] += 1
+            SHARD_DROPPED.inc(str(i))
+            return False
+        depth = q.qsize()
+        if depth > self.stats[i]["max_depth"]:
+            self.stats[i]["max_depth"] = depth
+        return True
+
+    def _run(self, i):
+        q = self.queues[i]
+        stats = self.stats[i]
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                topic, payload, queued = item
+                stage_done("queue", queued)
+                try:
+                    self.handler(topic, payload)
+                    stats["processed"] += 1
+                except Exception as e:
+                    stats["errors"] += 1
+                    log.error("❌ Error in worker %d (%s): %s", i, topic, e)
+            finally:
+                q.task_done()
+
+    def drain(self):
+        # รอจนทุก shard ทำงานที่ค้างในคิวเสร็จ
+        for q in self.queues:
+            q.join()
+
+    def stop(self, timeout=5.0):
+        if not self._threads:
+            return
+        for q in self.queues:
+            q.put(_STOP)      # ต่อท้ายคิว → งานที่ค้างอยู่ทำเสร็จก่อน
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def snapshot(self):
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "shards": [{"shard": i, "depth": q.qsize(), **s} for i, (q, s) in enumerate(zip(self.queues, self.stats))],
+            "processed": sum(s["processed"] for s in self.stats),
+            "dropped": sum(s["dropped"] for s in self.stats),
+        }